@@ -0,0 +1,123 @@
+import asyncio
+import logging as log
+
+import aio_http
+import discussions
+import gh
+import gl
+import metrics
+import planner
+import state
+import steps
+
+
+def sync_all_mrs(gitlab_repo, gh_owner, gh_repo, concurrency, state_db=None, notes=False):
+    """Run the asyncio engine of `sync --mr-all` to completion. Returns True if every MR was synced."""
+    return asyncio.run(_run(gitlab_repo, gh_owner, gh_repo, concurrency, state_db, notes))
+
+
+async def _run(gitlab_repo, gh_owner, gh_repo, concurrency, state_db, notes):
+    try:
+        return await _sync_all_mrs(gitlab_repo, gh_owner, gh_repo, concurrency, state_db, notes)
+    finally:
+        await aio_http.close_all()
+
+
+async def _sync_all_mrs(gitlab_repo, gh_owner, gh_repo, concurrency, state_db, notes):
+    """Same flow as main._sync_all_mrs on one event loop: every MR page is requested at once, each batch is checked,
+    fetched and pushed while later pages are still arriving, and up to `concurrency` PR calls are in flight. Git still
+    mutates the local clone one batch at a time. With `notes`, comments are copied by discussions.sync_mr_notes in
+    worker threads, one per PR in flight.
+    """
+    store = state.SyncState(state_db, gitlab_repo, f"{gh_owner}/{gh_repo}") if state_db else None
+    updated_after = store.watermark() if store else None
+    started = state.listing_start()
+    skipped = 0
+    total = 0
+    git_lock = asyncio.Lock()
+    slots = asyncio.Semaphore(concurrency)
+    batches = []
+    batch = []
+    closed = []
+    open_iids = set()
+    failures = 0
+    listed = True
+    try:
+        try:
+            async for mr in gl.iter_mrs_async(gitlab_repo, state=planner.listing_state(updated_after),
+                                              updated_after=updated_after):
+                total += 1
+                if mr.get('state') in gl.CLOSED_MR_STATES:
+                    closed.append(mr)
+                if mr.get('state') != 'opened':
+                    continue
+                open_iids.add(mr.get('iid'))
+                if store and store.is_synced(mr):
+                    skipped += 1
+                    continue
+                batch.append(mr)
+                if len(batch) == gl.FETCH_BATCH_SIZE:
+                    batches.append(asyncio.create_task(
+                        _sync_batch(gitlab_repo, batch, gh_owner, gh_repo, store, git_lock, slots, notes)))
+                    batch = []
+        except RuntimeError as e:
+            # As in main._sync_all_mrs: the MRs listed so far are synced, but the watermark stays put.
+            log.error(str(e))
+            failures += 1
+            listed = False
+        if batch:
+            batches.append(asyncio.create_task(
+                _sync_batch(gitlab_repo, batch, gh_owner, gh_repo, store, git_lock, slots, notes)))
+        failures += sum(await asyncio.gather(*batches))
+        failures += await asyncio.to_thread(planner.close_prs_of_closed_mrs, gitlab_repo, gh_owner, gh_repo, closed,
+                                            open_iids if listed and not updated_after else None)
+
+        if skipped:
+            log.info(f"Skipped {skipped} of {total} merge requests unchanged since the last sync")
+        if failures:
+            if listed:
+                log.error(f"Failed to sync {failures} of {total} merge requests")
+            else:
+                log.error(f"Could not list every merge request; {failures - 1} of the {total} listed failed to sync")
+            return False
+        if store:
+            store.set_watermark(started)
+        return True
+    finally:
+        if store:
+            store.close()
+
+
+async def _sync_batch(gitlab_repo, batch, gh_owner, gh_repo, store, git_lock, slots, notes):
+    """Relay one batch of MRs with the steps of planner.prepare_mr_batch. Returns the number of MRs that failed."""
+    failed, todo = await steps.run_async(
+        planner.prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store, keep_current=notes), git_lock)
+    results = await asyncio.gather(*(_sync_mr(gitlab_repo, mr, gh_owner, gh_repo, store, slots, pr, notes)
+                                     for mr, pr in todo))
+    return len(failed) + sum(not ok for ok in results)
+
+
+async def _sync_mr(gitlab_repo, mr, gh_owner, gh_repo, store, slots, pr=None, notes=False):
+    """Open the PR for a single MR whose head branch is already on GitHub, unless its open `pr` is known, and with
+    `notes` copy the MR's comments to it. Returns True on success.
+    """
+    async with slots:
+        try:
+            if pr is None:
+                with metrics.span('phase', 'create_pr', phase='create_pr') as span:
+                    span.set(iid=mr.get('iid'))
+                    pr = await steps.run_async(gh.sync_mr_to_pr_steps(gitlab_repo, mr, gh_owner, gh_repo))
+            if pr is not None and notes:
+                with metrics.span('phase', 'notes', phase='notes') as span:
+                    span.set(iid=mr.get('iid'))
+                    if not await asyncio.to_thread(discussions.sync_mr_notes, gitlab_repo, mr, gh_owner, gh_repo,
+                                                   pr, store):
+                        return False
+        except Exception as e:
+            log.error(f"Unexpected error while syncing MR '{mr.get('web_url')}': {e}")
+            return False
+    if pr is None:
+        return False
+    if store:
+        store.record(mr, pr.get('number'))
+    return True
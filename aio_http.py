@@ -0,0 +1,176 @@
+import asyncio
+import http.client
+import io
+import logging as log
+import ssl
+import urllib.parse
+
+import http_cache
+import http_pool
+import ratelimit
+
+
+MAX_IDLE_PER_HOST = 64
+TIMEOUT = 60
+# How often a request waiting for a free concurrency slot re-checks its host limiter.
+SLOT_POLL_INTERVAL = 0.05
+
+_pools = {}
+
+
+async def request(method, url, body=None, headers=None, identity='', tokens=None):
+    """asyncio twin of http_cache.request: same cache, rate-limit scheduling, retries and (status, headers, body) result.
+
+    The per-host limiters and the response cache are shared with the threaded clients. Responses are read over
+    keep-alive asyncio connections (no http(s)_proxy support).
+    """
+    with http_cache.api_span(method, url) as span:
+        key, cached, req_headers = http_cache.prepare(method, url, headers, identity)
+        attempt = 0
+        while True:
+            token = tokens.pick(method, url) if tokens else ''
+            limiter = ratelimit.limiter_for(url, token)
+            while True:
+                wait = limiter.try_acquire()
+                if wait == 0:
+                    break
+                await asyncio.sleep(SLOT_POLL_INTERVAL if wait is None else wait)
+            try:
+                response = await _send_in_global_slot(method, url, body,
+                                                      tokens.headers(req_headers, token) if tokens else req_headers)
+            except Exception:
+                delay = limiter.failed(method, url, attempt)
+                if delay is None:
+                    raise
+            else:
+                delay = limiter.completed(method, url, attempt, *response)
+                if delay is None:
+                    http_cache.record_response(span, url, body, response[0], response[2])
+                    return http_cache.complete(key, cached, *response)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+async def close_all():
+    """Close every idle connection; call before the event loop that opened them ends."""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.close()
+
+
+async def _send_in_global_slot(method, url, body, headers):
+    """_send while holding a cross-process request slot of `migrate` (see ratelimit.set_global_slots)."""
+    while not ratelimit.try_global_slot():
+        await asyncio.sleep(SLOT_POLL_INTERVAL)
+    try:
+        return await _send(method, url, body, headers)
+    finally:
+        ratelimit.release_global_slot()
+
+
+async def _send(method, url, body, headers):
+    req_headers = {'Accept-Encoding': 'gzip, deflate'}
+    if headers:
+        req_headers.update(headers)
+    for _ in range(http_pool.MAX_REDIRECTS + 1):
+        p = urllib.parse.urlsplit(url)
+        pool = _pools.get((p.scheme, p.netloc))
+        if pool is None:
+            pool = _pools[(p.scheme, p.netloc)] = _AsyncHostPool(p.scheme, p.netloc)
+        status, resp_headers, resp_body = await asyncio.wait_for(pool.request(method, url, body, req_headers), TIMEOUT)
+        location = resp_headers.get('Location')
+        if status in (301, 302, 303, 307, 308) and location and method in ('GET', 'HEAD'):
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return status, resp_headers, resp_body
+    raise http.client.HTTPException(f"Too many redirects for {method} {url}")
+
+
+class _AsyncHostPool:
+    """Idle HTTP/1.1 keep-alive stream pairs to one scheme://host:port."""
+
+    def __init__(self, scheme, netloc):
+        self.scheme = scheme
+        self.netloc = netloc
+        self._idle = []
+
+    async def request(self, method, url, body, headers):
+        p = urllib.parse.urlsplit(url)
+        target = (p.path or '/') + (f"?{p.query}" if p.query else '')
+        while self._idle and self._idle[-1][0].at_eof():
+            # The server closed it while it was idle.
+            self._idle.pop()[1].close()
+        reused = bool(self._idle)
+        reader, writer = self._idle.pop() if reused else await self._connect()
+        try:
+            return await self._exchange(reader, writer, method, target, body, headers)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if not reused or method not in http_pool.IDEMPOTENT_METHODS:
+                # The server may have processed the request before the connection dropped.
+                raise
+            # The server dropped an idle keep-alive connection; retry once on a fresh one.
+            log.debug(f"Stale keep-alive connection to {self.netloc}; reconnecting")
+            reader, writer = await self._connect()
+            try:
+                return await self._exchange(reader, writer, method, target, body, headers)
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            writer.close()
+            raise
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+    async def _connect(self):
+        p = urllib.parse.urlsplit(f"{self.scheme}://{self.netloc}")
+        if self.scheme == 'https':
+            return await asyncio.open_connection(p.hostname, p.port or 443, ssl=ssl.create_default_context())
+        return await asyncio.open_connection(p.hostname, p.port or 80)
+
+    async def _exchange(self, reader, writer, method, target, body, headers):
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.netloc}"]
+        lines += [f"{name}: {value}" for name, value in headers.items()]
+        if body is not None or method in ('POST', 'PUT', 'PATCH'):
+            lines.append(f"Content-Length: {len(body or b'')}")
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b''))
+        await writer.drain()
+
+        head = await reader.readuntil(b'\r\n\r\n')
+        status_line, _, header_block = head.partition(b'\r\n')
+        status = int(status_line.split(b' ', 2)[1])
+        resp_headers = http.client.parse_headers(io.BytesIO(header_block))
+
+        keep_alive = resp_headers.get('Connection', '').lower() != 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif resp_headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = await _read_chunked(reader)
+        elif resp_headers.get('Content-Length') is not None:
+            data = await reader.readexactly(int(resp_headers['Content-Length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        if keep_alive and len(self._idle) < MAX_IDLE_PER_HOST:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status, resp_headers, http_pool.decode_body(data, resp_headers.get('Content-Encoding'))
+
+
+async def _read_chunked(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            while (await reader.readuntil(b'\r\n')) != b'\r\n':
+                pass
+            return b''.join(chunks)
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
@@ -20,6 +20,21 @@ def build_args():
         required=True,
         help="Target GitHub repository in the format owner/repo (e.g. kanataidarov/myrepo)",
     )
+    clone_p.add_argument(
+        "--chunk-mb",
+        dest="chunk_mb",
+        type=int,
+        help="Push branch history in packs of about this many MB before updating the refs, resuming from the last "
+             "pushed chunk after a failure. Use for repositories too large for a single push.",
+    )
+    clone_p.add_argument(
+        "--push-jobs",
+        dest="push_jobs",
+        type=int,
+        default=1,
+        help="Push the mirror in shards over this many connections at once (default: 1, a single push). Branches and "
+             "tags are each split into this many shards by ref name; failed shards are retried on their own.",
+    )
 
     sync_p = subparsers.add_parser('sync', help='Sync Merge Requests from GitLab to GitHub Pull Requests')
     sync_p.add_argument(
@@ -46,5 +61,272 @@ def build_args():
         action='store_true',
         help="When used with 'sync', sync all open Merge Requests for the project.",
     )
+    sync_p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of MRs to sync concurrently with --mr-all (default: 1). Git steps on the local clone still run one at a time.",
+    )
+    sync_p.add_argument(
+        "--engine",
+        dest="engine",
+        choices=('threads', 'asyncio'),
+        default='threads',
+        help="How --mr-all runs concurrent API calls (default: threads). 'asyncio' drives them from one event loop; "
+             "--workers then bounds the number of PRs being created at once.",
+    )
+    sync_p.add_argument(
+        "--state-db",
+        dest="state_db",
+        help="SQLite file remembering previous --mr-all runs. Only MRs updated since the last complete run are listed, "
+             "and MRs whose head commit was already synced are skipped.",
+    )
+    sync_p.add_argument(
+        "--plan",
+        dest="plan",
+        action='store_true',
+        help="Dry run: print the branch pushes and PR creations, updates and closes a sync would make, without "
+             "making them",
+    )
+    sync_p.add_argument(
+        "--notes",
+        dest="notes",
+        action='store_true',
+        help="Also copy the MR's discussions, comments and approvals to the PR. Notes already copied are not posted "
+             "again (tracked in --state-db, or by a marker in each copied comment).",
+    )
+    sync_p.add_argument(
+        "--clone-filter",
+        dest="clone_filter",
+        choices=('blob:none', 'tree:0'),
+        help="Create or update the mirror clone as a partial clone before syncing: 'blob:none' leaves out file "
+             "contents, 'tree:0' also directories. Objects a branch push needs are then fetched from GitLab on demand.",
+    )
+
+    serve_p = subparsers.add_parser('serve', help='Sync Merge Requests to Pull Requests as GitLab webhooks arrive')
+    serve_p.add_argument(
+        "--gitlab-repo",
+        dest="gitlab_repo",
+        required=True,
+        help="GitLab repository path or URL whose Merge Request and Push webhooks are handled",
+    )
+    serve_p.add_argument(
+        "--github-repo",
+        dest="github_repo",
+        required=True,
+        help="Target GitHub repository in the format owner/repo (e.g. kanataidarov/myrepo)",
+    )
+    serve_p.add_argument(
+        "--listen",
+        dest="listen",
+        default="127.0.0.1:8080",
+        help="HOST:PORT the webhook endpoint listens on (default: 127.0.0.1:8080)",
+    )
+    serve_p.add_argument(
+        "--debounce",
+        dest="debounce",
+        type=float,
+        default=2.0,
+        help="Seconds to wait after the last event for an MR (or push) before syncing it (default: 2)",
+    )
+    serve_p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="Number of MRs synced concurrently (default: 1)",
+    )
+    serve_p.add_argument(
+        "--state-db",
+        dest="state_db",
+        help="SQLite file remembering synced MRs, so events that do not change an MR's head are skipped",
+    )
+    serve_p.add_argument(
+        "--notes",
+        dest="notes",
+        action='store_true',
+        help="Also copy MR discussions, comments and approvals; add Comments events to the webhook",
+    )
+    serve_p.add_argument(
+        "--clone-filter",
+        dest="clone_filter",
+        choices=('blob:none', 'tree:0'),
+        help="Keep the mirror clone as a partial clone, as for 'sync --clone-filter'",
+    )
+
+    migrate_p = subparsers.add_parser('migrate', help='Clone and/or sync many projects listed in a manifest')
+    migrate_p.add_argument(
+        "--manifest",
+        dest="manifest",
+        required=True,
+        help="CSV (or YAML, with PyYAML installed) listing gitlab_repo, github_repo and optional steps (clone, sync) per project",
+    )
+    migrate_p.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        default=4,
+        help="Number of projects migrated concurrently, each in its own process (default: 4)",
+    )
+    migrate_p.add_argument(
+        "--max-clones",
+        dest="max_clones",
+        type=int,
+        default=2,
+        help="Maximum number of clone steps (mirror fetch and push) running at once (default: 2)",
+    )
+    migrate_p.add_argument(
+        "--max-api-calls",
+        dest="max_api_calls",
+        type=int,
+        help="Maximum number of API requests in flight across all processes (default: unlimited)",
+    )
+    migrate_p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="MRs synced concurrently within each project, as for 'sync --mr-all' (default: 1)",
+    )
+    migrate_p.add_argument(
+        "--engine",
+        dest="engine",
+        choices=('threads', 'asyncio'),
+        default='threads',
+        help="Engine of the sync step, as for 'sync --mr-all' (default: threads)",
+    )
+    migrate_p.add_argument(
+        "--chunk-mb",
+        dest="chunk_mb",
+        type=int,
+        help="Chunk size in MB of the clone step's push, as for 'clone --chunk-mb' (default: single push)",
+    )
+    migrate_p.add_argument(
+        "--push-jobs",
+        dest="push_jobs",
+        type=int,
+        default=1,
+        help="Connections of the clone step's push, as for 'clone --push-jobs' (default: 1)",
+    )
+    migrate_p.add_argument(
+        "--clone-filter",
+        dest="clone_filter",
+        choices=('blob:none', 'tree:0'),
+        help="Partial-clone filter of the clones made for sync-only projects, as for 'sync --clone-filter' "
+             "(clone steps always make a full mirror)",
+    )
+    migrate_p.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        default="migrate",
+        help="Directory holding one sub-directory (mirror clone, sync state, log) per project (default: migrate)",
+    )
+    migrate_p.add_argument(
+        "--report",
+        dest="report",
+        help="Write a JSON report with the outcome of every project to this file",
+    )
+
+    enqueue_p = subparsers.add_parser('enqueue', help='Queue projects for worker processes to migrate')
+    enqueue_p.add_argument(
+        "--queue",
+        dest="queue",
+        required=True,
+        help="Job queue shared by the workers: a SQLite file path or sqlite:///path",
+    )
+    enqueue_p.add_argument(
+        "--manifest",
+        dest="manifest",
+        help="Manifest of projects to queue, as for 'migrate'",
+    )
+    enqueue_p.add_argument(
+        "--gitlab-repo",
+        dest="gitlab_repo",
+        help="GitLab repository path or URL of a single project to queue (instead of --manifest)",
+    )
+    enqueue_p.add_argument(
+        "--github-repo",
+        dest="github_repo",
+        help="Target GitHub repository (owner/repo) of the single project",
+    )
+    enqueue_p.add_argument(
+        "--steps",
+        dest="steps",
+        nargs='+',
+        choices=('clone', 'sync'),
+        default=['clone', 'sync'],
+        help="Steps queued for the single project (default: clone sync)",
+    )
+    enqueue_p.add_argument(
+        "--max-attempts",
+        dest="max_attempts",
+        type=int,
+        default=3,
+        help="Times a job is tried before it is marked failed, counting expired leases (default: 3)",
+    )
+
+    worker_p = subparsers.add_parser('worker', help='Run jobs from a queue filled by enqueue until it is drained')
+    worker_p.add_argument(
+        "--queue",
+        dest="queue",
+        required=True,
+        help="Job queue shared by the workers: a SQLite file path or sqlite:///path",
+    )
+    worker_p.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        default="worker",
+        help="Directory holding this worker's mirror clones and sync state, one sub-directory per project; "
+             "not shared with other workers (default: worker)",
+    )
+    worker_p.add_argument(
+        "--lease",
+        dest="lease",
+        type=int,
+        default=300,
+        help="Seconds a claimed job stays leased without a heartbeat before another worker may claim it "
+             "(default: 300)",
+    )
+    worker_p.add_argument(
+        "--batch",
+        dest="batch",
+        type=int,
+        default=50,
+        help="MR jobs of one project claimed and synced together (default: 50)",
+    )
+    worker_p.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=1,
+        help="MRs of a batch synced concurrently, as for 'sync --mr-all' (default: 1)",
+    )
+    worker_p.add_argument(
+        "--notes",
+        dest="notes",
+        action='store_true',
+        help="Also copy MR discussions, comments and approvals, as for 'sync --notes'",
+    )
+    worker_p.add_argument(
+        "--chunk-mb",
+        dest="chunk_mb",
+        type=int,
+        help="Chunk size in MB of the clone jobs' push, as for 'clone --chunk-mb' (default: single push)",
+    )
+    worker_p.add_argument(
+        "--push-jobs",
+        dest="push_jobs",
+        type=int,
+        default=1,
+        help="Connections of the clone jobs' push, as for 'clone --push-jobs' (default: 1)",
+    )
+    worker_p.add_argument(
+        "--clone-filter",
+        dest="clone_filter",
+        choices=('blob:none', 'tree:0'),
+        help="Partial-clone filter of the clones made for MR jobs, as for 'sync --clone-filter' "
+             "(clone jobs always make a full mirror)",
+    )
 
     return parser
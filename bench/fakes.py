@@ -0,0 +1,308 @@
+"""Local stand-ins for the GitLab v4 and GitHub REST/GraphQL endpoints gl2gh calls, plus smart-HTTP git hosting.
+
+Each fake serves the bare repositories under its `git_root` through `git http-backend`, answers only the API routes
+the tool uses, counts every API call (and the calls of each token), and can add per-request latency and a per-token
+rate-limit budget that behaves like the real hosts (GitHub: 403 with X-RateLimit-* headers, GitLab: 429 with
+Retry-After).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import collections
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+import urllib.parse
+
+
+class _Forge:
+    def __init__(self, git_root, latency=0.0, rate_limit=None, rate_window=60.0):
+        self.git_root = git_root
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.calls = collections.Counter()
+        self.token_calls = collections.Counter()
+        self.lock = threading.Lock()
+        # Authorization header -> [window start, requests used]
+        self._budgets = {}
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), type('Handler', (_Handler,), {'forge': self}))
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def api_calls(self):
+        return sum(self.calls.values())
+
+    def handle_api(self, method, path, query, body):
+        """Return (status, json_body, headers) for an API request. Implemented by the concrete fakes."""
+        raise NotImplementedError
+
+    def throttle(self, token):
+        """Spend one request of the budget of `token`. Returns (headers, rejected, reset)."""
+        if self.rate_limit is None:
+            return {}, False, None
+        with self.lock:
+            now = time.time()
+            budget = self._budgets.setdefault(token, [now, 0])
+            if now - budget[0] >= self.rate_window:
+                budget[:] = [now, 0]
+            reset = budget[0] + self.rate_window
+            rejected = budget[1] >= self.rate_limit
+            if not rejected:
+                budget[1] += 1
+            return self.rate_headers(self.rate_limit - budget[1], reset), rejected, reset
+
+    def rate_headers(self, remaining, reset):
+        return {}
+
+    def rejection(self, reset):
+        return 429, {'message': 'Too Many Requests'}, {}
+
+
+class FakeGitHub(_Forge):
+    """GitHub stand-in for one owner; repositories are the bare repos `<git_root>/<owner>/<repo>.git`."""
+
+    def __init__(self, git_root, owner, **kwargs):
+        super().__init__(git_root, **kwargs)
+        self.owner = owner
+        self.pulls = {}
+        # (full_name, PR number) -> {'issue_comment' | 'review_comment' | 'review': [dicts]}
+        self.comments = {}
+        self._next_id = 1
+
+    def rate_headers(self, remaining, reset):
+        return {'X-RateLimit-Limit': str(self.rate_limit), 'X-RateLimit-Remaining': str(max(remaining, 0)),
+                'X-RateLimit-Reset': str(int(reset) + 1)}
+
+    def rejection(self, reset):
+        return 403, {'message': 'API rate limit exceeded'}, {}
+
+    def handle_api(self, method, path, query, body):
+        if path == '/user':
+            return 200, {'login': self.owner}, {}
+        if path == '/graphql' and method == 'POST':
+            return 200, self._graphql(body.get('variables') or {}), {}
+        m = re.fullmatch(r'/repos/([^/]+)/([^/]+)(/pulls)?(/.+)?', path)
+        if not m or not os.path.isdir(self._repo_dir(m.group(1), m.group(2))):
+            return 404, {'message': 'Not Found'}, {}
+        full_name = f"{m.group(1)}/{m.group(2)}"
+        if m.group(3) and m.group(4) and re.fullmatch(r'/\d+', m.group(4)):
+            return self._pull(method, body, full_name, int(m.group(4)[1:]))
+        if m.group(4):
+            return self._comments(method, path, query, body, full_name, m.group(4) if m.group(3) else None)
+        if not m.group(3):
+            return 200, {'full_name': full_name}, {}
+        pulls = self.pulls.setdefault(full_name.lower(), [])
+        if method == 'POST':
+            with self.lock:
+                number = len(pulls) + 1
+                pr = {'number': number, 'state': 'open', 'title': body.get('title'), 'body': body.get('body'),
+                      'html_url': f"{self.url}/{full_name}/pull/{number}",
+                      'head': {'ref': body.get('head'), 'repo': {'full_name': full_name}},
+                      'base': {'ref': body.get('base')}}
+                pulls.append(pr)
+            return 201, pr, {}
+        return _paginate(self.url, path, query, [pr for pr in pulls if pr['state'] == 'open'])
+
+    def _pull(self, method, body, full_name, number):
+        pr = next((pr for pr in self.pulls.get(full_name.lower(), []) if pr['number'] == number), None)
+        if pr is None:
+            return 404, {'message': 'Not Found'}, {}
+        if method == 'PATCH':
+            with self.lock:
+                pr.update({key: body[key] for key in ('title', 'body', 'state') if key in body})
+                if 'base' in body:
+                    pr['base'] = {'ref': body['base']}
+        return 200, pr, {}
+
+    def _comments(self, method, path, query, body, full_name, pulls_path):
+        """Issue comments, review comments (with replies) and reviews of a PR."""
+        m = re.fullmatch(r'/(\d+)/(comments|reviews)(?:/(\d+)/replies)?', pulls_path or '')
+        if pulls_path is None:
+            m = re.search(r'/issues/(\d+)/(comments)$', path)
+        if not m:
+            return 404, {'message': 'Not Found'}, {}
+        kind = 'review' if m.group(2) == 'reviews' else 'review_comment' if pulls_path else 'issue_comment'
+        with self.lock:
+            comments = self.comments.setdefault((full_name.lower(), int(m.group(1))), collections.defaultdict(list))
+            if method != 'POST':
+                return _paginate(self.url, path, query, list(comments[kind]))
+            comment = {'id': self._next_id, 'body': body.get('body')}
+            reply_to = m.group(3) if m.re.groups >= 3 else None
+            if reply_to:
+                parent = next((c for c in comments[kind] if c['id'] == int(reply_to)), None)
+                if parent is None:
+                    return 404, {'message': 'Not Found'}, {}
+                comment.update(in_reply_to_id=parent['id'], path=parent['path'], line=parent['line'])
+            elif kind == 'review_comment':
+                if not (body.get('path') and body.get('line') and body.get('commit_id')):
+                    return 422, {'message': 'Validation Failed'}, {}
+                comment.update(path=body['path'], line=body['line'], commit_id=body['commit_id'])
+            self._next_id += 1
+            comments[kind].append(comment)
+        return (200 if kind == 'review' else 201), comment, {}
+
+    def _graphql(self, variables):
+        """Answer the aliased branch-head / open-PR query built by gh._remote_state_query."""
+        full_name = f"{variables.get('owner')}/{variables.get('repo')}"
+        heads = ref_shas(self._repo_dir(variables.get('owner'), variables.get('repo')), 'refs/heads/')
+        pulls = [pr for pr in self.pulls.get(full_name.lower(), []) if pr['state'] == 'open']
+        repository = {}
+        for name, value in variables.items():
+            if re.fullmatch(r'r\d+', name):
+                oid = heads.get(value)
+                repository[f"b{name[1:]}"] = {'target': {'oid': oid}} if oid else None
+            elif re.fullmatch(r'h\d+', name):
+                repository[f"p{name[1:]}"] = {'nodes': [
+                    {'number': pr['number'], 'url': pr['html_url'], 'title': pr['title'], 'body': pr['body'],
+                     'baseRefName': pr['base']['ref'], 'headRefName': pr['head']['ref'],
+                     'headRepository': {'nameWithOwner': full_name}}
+                    for pr in pulls if pr['head']['ref'] == value]}
+        return {'data': {'repository': repository}}
+
+    def _repo_dir(self, owner, repo):
+        return os.path.join(self.git_root, owner, f"{repo}.git")
+
+
+class FakeGitLab(_Forge):
+    """GitLab stand-in serving one project `<git_root>/<project>.git` and its list of MR dicts."""
+
+    def __init__(self, git_root, project, mrs, **kwargs):
+        super().__init__(git_root, **kwargs)
+        self.project = project
+        self.mrs = mrs
+        # MR iid -> list of discussion dicts, and -> list of approving user dicts
+        self.discussions = {}
+        self.approvals = {}
+
+    def rate_headers(self, remaining, reset):
+        return {'RateLimit-Limit': str(self.rate_limit), 'RateLimit-Remaining': str(max(remaining, 0)),
+                'RateLimit-Reset': str(int(reset) + 1)}
+
+    def rejection(self, reset):
+        return 429, {'message': 'Retry later'}, {'Retry-After': str(max(1, int(reset - time.time()) + 1))}
+
+    def handle_api(self, method, path, query, body):
+        m = re.fullmatch(r'/api/v4/projects/([^/]+)/merge_requests(?:/(\d+)(?:/(discussions|approvals))?)?', path)
+        if not m or urllib.parse.unquote(m.group(1)) != self.project:
+            return 404, {'message': '404 Not found'}, {}
+        if m.group(3) == 'discussions':
+            return _paginate(self.url, path, query, self.discussions.get(int(m.group(2)), []), total_pages=True)
+        if m.group(3) == 'approvals':
+            return 200, {'approved_by': [{'user': user} for user in self.approvals.get(int(m.group(2)), [])]}, {}
+        if m.group(2):
+            mr = next((mr for mr in self.mrs if mr['iid'] == int(m.group(2))), None)
+            return (200, mr, {}) if mr else (404, {'message': '404 Not found'}, {})
+        state = query.get('state', 'opened')
+        updated_after = query.get('updated_after', '')
+        mrs = [mr for mr in self.mrs if state in ('all', mr['state']) and mr['updated_at'] > updated_after]
+        return _paginate(self.url, path, query, mrs, total_pages=True)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; without TCP_NODELAY every response waits for a delayed ACK.
+    disable_nagle_algorithm = True
+    forge = None
+
+    def do_GET(self):
+        self._dispatch()
+
+    do_POST = do_PUT = do_PATCH = do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self):
+        body = self._read_body()
+        split = urllib.parse.urlsplit(self.path)
+        if '.git/' in split.path:
+            return self._git(split, body)
+
+        forge = self.forge
+        token = self.headers.get('Authorization', '')
+        with forge.lock:
+            forge.calls[f"{self.command} {re.sub(r'/[0-9]+', '/:n', split.path)}"] += 1
+            forge.token_calls[token.split()[-1] if token else ''] += 1
+        if forge.latency:
+            time.sleep(forge.latency)
+        rate_headers, rejected, reset = forge.throttle(token)
+        if rejected:
+            status, payload, headers = forge.rejection(reset)
+        else:
+            data = json.loads(body) if body else {}
+            query = dict(urllib.parse.parse_qsl(split.query))
+            status, payload, headers = forge.handle_api(self.command, split.path, query, data)
+        out = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in {**rate_headers, **headers, 'Content-Type': 'application/json'}.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';', 1)[0].strip(), 16)
+                if size == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _git(self, split, body):
+        """Run `git http-backend` as a CGI script for smart-HTTP fetch and push."""
+        env = dict(os.environ, GIT_PROJECT_ROOT=self.forge.git_root, GIT_HTTP_EXPORT_ALL='1', REMOTE_USER='bench',
+                   PATH_INFO=urllib.parse.unquote(split.path), QUERY_STRING=split.query,
+                   REQUEST_METHOD=self.command, CONTENT_TYPE=self.headers.get('Content-Type', ''),
+                   CONTENT_LENGTH=str(len(body)), GIT_PROTOCOL=self.headers.get('Git-Protocol', ''),
+                   HTTP_CONTENT_ENCODING=self.headers.get('Content-Encoding', ''))
+        result = subprocess.run(['git', 'http-backend'], input=body, env=env, stdout=subprocess.PIPE, check=False)
+        head, _, out = result.stdout.partition(b'\r\n\r\n')
+        status = 200
+        headers = []
+        for line in head.decode('latin-1').split('\r\n'):
+            name, _, value = line.partition(':')
+            if name.lower() == 'status':
+                status = int(value.split()[0])
+            elif name:
+                headers.append((name, value.strip()))
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def _paginate(base_url, path, query, items, total_pages=False):
+    per_page = int(query.get('per_page', 30))
+    page = int(query.get('page', 1))
+    pages = max(1, -(-len(items) // per_page))
+    headers = {}
+    if total_pages:
+        headers.update({'X-Total': str(len(items)), 'X-Total-Pages': str(pages), 'X-Page': str(page)})
+    if page < pages:
+        next_query = urllib.parse.urlencode({**query, 'page': page + 1})
+        headers['Link'] = f'<{base_url}{path}?{next_query}>; rel="next"'
+    return 200, items[(page - 1) * per_page:page * per_page], headers
+
+
+def ref_shas(git_dir, prefix='refs/'):
+    result = subprocess.run(['git', '-C', git_dir, 'for-each-ref', '--format=%(refname) %(objectname)', prefix],
+                            stdout=subprocess.PIPE, text=True, check=False)
+    return dict(line.split(' ', 1) for line in result.stdout.splitlines())
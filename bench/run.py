@@ -0,0 +1,228 @@
+"""Offline benchmark of `clone` and `sync --mr-all` against local GitLab/GitHub stand-ins.
+
+For every scenario a synthetic GitLab project with N merge requests is generated as a bare repository, the tool is
+run as a subprocess against the fakes in bench/fakes.py, and wall time, MRs/sec, API calls, git subprocesses and
+peak RSS are reported. Results can be saved as a baseline and later runs compared against it:
+
+    python bench/run.py --mrs 10,100,1000 --save-baseline bench/baseline.json
+    python bench/run.py --mrs 10,100,1000 --baseline bench/baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import fakes
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GITLAB_PROJECT = 'bench/project'
+GITHUB_OWNER = 'bench'
+GITHUB_REPO = 'project'
+# Metrics compared against the baseline and whether a higher value is better.
+COMPARED = {'seconds': False, 'mrs_per_sec': True, 'api_calls': False, 'git_calls': False, 'peak_rss_mb': False}
+
+
+def build_args():
+    parser = argparse.ArgumentParser(description="Benchmark gl2gh against local GitLab/GitHub stand-in servers.")
+    parser.add_argument("--mrs", default="10,100,1000",
+                        help="Comma-separated scenario sizes: number of open MRs (default: 10,100,1000)")
+    parser.add_argument("--engine", choices=('threads', 'asyncio'), default='threads', help="sync engine to run")
+    parser.add_argument("--workers", type=int, default=8, help="--workers passed to sync (default: 8)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Latency added to every API request")
+    parser.add_argument("--rate-limit", type=int,
+                        help="API requests each fake allows per --rate-window seconds (default: unlimited)")
+    parser.add_argument("--rate-window", type=float, default=60.0, help="Rate-limit window in seconds (default: 60)")
+    parser.add_argument("--tokens", type=int, default=1,
+                        help="API tokens per host; each gets its own --rate-limit budget (default: 1)")
+    parser.add_argument("--baseline", help="JSON file of a previous run to compare against")
+    parser.add_argument("--save-baseline", dest="save_baseline", help="Write this run's results to a JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="Relative change counted as a regression (default: 0.10)")
+    parser.add_argument("--keep", action='store_true', help="Keep the temporary directories for inspection")
+    return parser
+
+
+def main():
+    args = build_args().parse_args()
+    results = {}
+    for n in [int(n) for n in args.mrs.split(',') if n.strip()]:
+        for command, metrics in run_scenario(n, args).items():
+            results[f"{command}/{n}"] = metrics
+            print(_format_row(f"{command}/{n}", metrics), flush=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        return 1 if compare(baseline, results, args.tolerance) else 0
+    return 0
+
+
+def run_scenario(n, args):
+    """Run `clone` then `sync --mr-all` for a project with `n` MRs. Returns {command: metrics}."""
+    work = tempfile.mkdtemp(prefix=f"gl2gh-bench-{n}-")
+    gitlab = github = None
+    try:
+        gitlab_root = os.path.join(work, 'gitlab')
+        github_root = os.path.join(work, 'github')
+        source = os.path.join(gitlab_root, f"{GITLAB_PROJECT}.git")
+        make_source_repo(source, n)
+        _git('init', '-q', '--bare', os.path.join(github_root, GITHUB_OWNER, f"{GITHUB_REPO}.git"))
+
+        limits = {'latency': args.latency_ms / 1000, 'rate_limit': args.rate_limit, 'rate_window': args.rate_window}
+        gitlab = fakes.FakeGitLab(gitlab_root, GITLAB_PROJECT, [], **limits).start()
+        gitlab.mrs = make_mrs(gitlab.url, n, fakes.ref_shas(source))
+        github = fakes.FakeGitHub(github_root, GITHUB_OWNER, **limits).start()
+
+        env = dict(os.environ, GITLAB_TOKEN='gl-token', GITHUB_TOKEN='gh-token', GITHUB_API_URL=github.url,
+                   GITHUB_URL=github.url, LOCAL_CLONE_DIR=os.path.join(work, 'clone'),
+                   PATH=f"{_git_shim(work)}{os.pathsep}{os.environ.get('PATH', '')}")
+        env.pop('GL2GH_CACHE_DIR', None)
+        if args.tokens > 1:
+            env['GITLAB_TOKENS'] = ','.join(f"gl-token-{n}" for n in range(2, args.tokens + 1))
+            env['GITHUB_TOKENS'] = ','.join(f"gh-token-{n}" for n in range(2, args.tokens + 1))
+        common = ['--gitlab-repo', f"{gitlab.url}/{GITLAB_PROJECT}.git", '--github-repo', f"{GITHUB_OWNER}/{GITHUB_REPO}"]
+        results = {
+            'clone': _measure(work, env, ['clone'] + common, [gitlab, github]),
+            'sync': _measure(work, env, ['sync'] + common + ['--mr-all', '--workers', str(args.workers),
+                                                             '--engine', args.engine], [gitlab, github]),
+        }
+        results['sync']['mrs_per_sec'] = round(n / results['sync']['seconds'], 2) if results['sync']['seconds'] else 0
+        opened = len(github.pulls.get(f"{GITHUB_OWNER}/{GITHUB_REPO}", []))
+        if opened != n:
+            print(f"warning: {n} MRs but {opened} PRs were opened (see {work} with --keep)", file=sys.stderr)
+        return results
+    finally:
+        for forge in (gitlab, github):
+            if forge:
+                forge.stop()
+        if args.keep:
+            print(f"Kept {work}")
+        else:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+def make_source_repo(git_dir, n):
+    """Create a bare repo with a `main` branch and `n` MR heads, each one commit ahead, in one fast-import.
+    Even MRs come from a branch of the project; odd ones from a fork, so their head only exists as the MR ref and
+    sync has to fetch and push it.
+    """
+    _git('init', '-q', '--bare', '--initial-branch=main', git_dir)
+    lines = []
+    stamp = 1700000000
+
+    def commit(ref, mark, parent, path, content):
+        data = f"{content}\n".encode()
+        lines.append(f"commit {ref}\nmark :{mark}\ncommitter Bench <bench@example.com> {stamp} +0000\n"
+                     f"data 6\nbench\n".encode())
+        if parent:
+            lines.append(f"from :{parent}\n".encode())
+        lines.append(f"M 644 inline {path}\ndata {len(data)}\n".encode() + data + b"\n")
+
+    commit('refs/heads/main', 1, None, 'README', 'bench')
+    for iid in range(1, n + 1):
+        commit(f"refs/heads/mr-{iid}" if iid % 2 == 0 else f"refs/merge-requests/{iid}/head",
+               iid + 1, 1, f"change-{iid}.txt", f"change {iid}")
+        if iid % 2 == 0:
+            lines.append(f"reset refs/merge-requests/{iid}/head\nfrom :{iid + 1}\n\n".encode())
+    subprocess.run(['git', '-C', git_dir, 'fast-import', '--quiet'], input=b''.join(lines), check=True)
+
+
+def make_mrs(gitlab_url, n, shas):
+    """Return GitLab MR dicts for the branches created by make_source_repo; `shas` maps refs to their commits."""
+    return [{
+        'iid': iid,
+        'project_id': 1,
+        'source_project_id': 1 if iid % 2 == 0 else 2,
+        'state': 'opened',
+        'title': f"Change {iid}",
+        'description': f"Synthetic merge request {iid}",
+        'source_branch': f"mr-{iid}",
+        'target_branch': 'main',
+        'sha': shas.get(f"refs/merge-requests/{iid}/head"),
+        'author': {'name': 'Bench', 'username': 'bench'},
+        'updated_at': f"2024-01-01T00:00:{iid % 60:02d}.{iid:06d}Z",
+        'web_url': f"{gitlab_url}/{GITLAB_PROJECT}/-/merge_requests/{iid}",
+    } for iid in range(1, n + 1)]
+
+
+def compare(baseline, results, tolerance):
+    """Print the relative change of every metric. Returns True if any metric regressed beyond `tolerance`."""
+    regressed = False
+    for key in sorted(results):
+        before = baseline.get(key)
+        if not before:
+            print(f"{key}: not in baseline")
+            continue
+        changes = []
+        for metric, higher_is_better in COMPARED.items():
+            old, new = before.get(metric), results[key].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change < -tolerance if higher_is_better else change > tolerance
+            regressed |= worse
+            changes.append(f"{metric} {change:+.0%}{' REGRESSION' if worse else ''}")
+        print(f"{key}: {', '.join(changes)}")
+    return regressed
+
+
+def _measure(work, env, argv, forges):
+    """Run main.py with `argv` and return its metrics; exits if the command fails."""
+    calls_before = sum(forge.api_calls for forge in forges)
+    git_log = os.path.join(work, 'git-calls.log')
+    open(git_log, 'w').close()
+    log_path = os.path.join(work, f"{argv[0]}.log")
+    started = time.perf_counter()
+    with open(log_path, 'w') as out:
+        proc = subprocess.Popen([sys.executable, os.path.join(ROOT, 'main.py')] + argv, cwd=work,
+                                env=dict(env, GL2GH_BENCH_GIT_LOG=git_log), stdout=out, stderr=subprocess.STDOUT)
+        # wait4 reports the peak RSS of the tool itself, or of the largest git process it waited for.
+        _, status, usage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        with open(log_path) as f:
+            sys.exit(f"`{' '.join(argv[:1])}` failed with exit code {proc.returncode}:\n{f.read()[-4000:]}")
+    with open(git_log) as f:
+        git_calls = sum(1 for _ in f)
+    return {
+        'seconds': round(seconds, 3),
+        'api_calls': sum(forge.api_calls for forge in forges) - calls_before,
+        'git_calls': git_calls,
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+    }
+
+
+def _git_shim(work):
+    """Put a `git` wrapper first on PATH that logs each invocation before running the real git."""
+    real_git = shutil.which('git')
+    shim_dir = os.path.join(work, 'bin')
+    os.makedirs(shim_dir, exist_ok=True)
+    shim = os.path.join(shim_dir, 'git')
+    with open(shim, 'w') as f:
+        f.write(f'#!/bin/sh\necho "$1" >> "$GL2GH_BENCH_GIT_LOG"\nexec "{real_git}" "$@"\n')
+    os.chmod(shim, 0o755)
+    return shim_dir
+
+
+def _git(*args):
+    subprocess.run(['git'] + list(args), check=True, stdout=subprocess.DEVNULL)
+
+
+def _format_row(key, metrics):
+    rate = f"{metrics['mrs_per_sec']:>9.1f} MR/s" if 'mrs_per_sec' in metrics else ' ' * 14
+    return (f"{key:<12} {metrics['seconds']:>8.2f}s {rate} {metrics['api_calls']:>7} api "
+            f"{metrics['git_calls']:>6} git {metrics['peak_rss_mb']:>8.1f} MB")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
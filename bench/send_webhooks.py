@@ -0,0 +1,105 @@
+"""Fake GitLab webhook sender for exercising `main.py serve`.
+
+Posts Merge Request events (each MR `--repeat` times, as GitLab does when an MR is edited repeatedly) and Push
+events shaped like GitLab's payloads, then waits until the daemon's queue is drained:
+
+    python bench/send_webhooks.py --url http://127.0.0.1:8080/ --project group/project --mrs 1-50 --repeat 3 --pushes 5
+"""
+import argparse
+import http.client
+import json
+import sys
+import time
+import urllib.parse
+
+
+def build_args():
+    parser = argparse.ArgumentParser(description="Send fake GitLab webhooks to a gl2gh serve daemon.")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/", help="Webhook endpoint of the daemon")
+    parser.add_argument("--project", required=True, help="GitLab project path with namespace the events are for")
+    parser.add_argument("--project-id", dest="project_id", type=int, default=1, help="GitLab project id (default: 1)")
+    parser.add_argument("--mrs", default="", help="MR IIDs to send events for, e.g. 1-50 or 3,7,9")
+    parser.add_argument("--repeat", type=int, default=1, help="Events sent per MR (default: 1)")
+    parser.add_argument("--pushes", type=int, default=0, help="Push events to send (default: 0)")
+    parser.add_argument("--secret", help="Value of the X-Gitlab-Token header")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds to wait for the queue to drain")
+    return parser
+
+
+def main():
+    args = build_args().parse_args()
+    sender = Sender(args.url, args.project, args.project_id, args.secret)
+    started = time.monotonic()
+    iids = parse_iids(args.mrs)
+    for _ in range(args.repeat):
+        for iid in iids:
+            sender.merge_request(iid)
+    for n in range(args.pushes):
+        sender.push("refs/heads/main", f"{n:040x}")
+    print(f"Sent {sender.sent} events in {time.monotonic() - started:.2f}s")
+    if not sender.wait_idle(args.timeout):
+        print(f"Queue not drained after {args.timeout}s", file=sys.stderr)
+        return 1
+    print(f"Queue drained {time.monotonic() - started:.2f}s after the first event")
+    return 0
+
+
+class Sender:
+    def __init__(self, url, project, project_id=1, secret=None):
+        self.url = urllib.parse.urlsplit(url)
+        self.project = {'id': project_id, 'path_with_namespace': project}
+        self.secret = secret
+        self.sent = 0
+
+    def merge_request(self, iid, action='update'):
+        return self.post('Merge Request Hook', {
+            'object_kind': 'merge_request', 'event_type': 'merge_request', 'project': self.project,
+            'object_attributes': {'iid': iid, 'action': action, 'state': 'opened'}})
+
+    def push(self, ref, after):
+        return self.post('Push Hook', {'object_kind': 'push', 'event_name': 'push', 'ref': ref, 'after': after,
+                                       'project': self.project})
+
+    def post(self, event, payload):
+        headers = {'Content-Type': 'application/json', 'X-Gitlab-Event': event}
+        if self.secret:
+            headers['X-Gitlab-Token'] = self.secret
+        status, body = self._request('POST', json.dumps(payload).encode('utf-8'), headers)
+        if status != 202:
+            raise RuntimeError(f"Webhook rejected with {status}: {body}")
+        self.sent += 1
+        return body
+
+    def stats(self):
+        return self._request('GET', None, {})[1]
+
+    def wait_idle(self, timeout):
+        """Wait until the daemon has no pending or running jobs. Returns False on timeout."""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = self.stats()
+            if not stats.get('pending') and not stats.get('running'):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def _request(self, method, body, headers):
+        conn = http.client.HTTPConnection(self.url.netloc, timeout=30)
+        try:
+            conn.request(method, self.url.path or '/', body=body, headers=headers)
+            resp = conn.getresponse()
+            return resp.status, json.loads(resp.read() or b'{}')
+        finally:
+            conn.close()
+
+
+def parse_iids(spec):
+    iids = []
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        start, _, end = part.partition('-')
+        iids += range(int(start), int(end or start) + 1)
+    return iids
+
+
+if __name__ == "__main__":
+    sys.exit(main())
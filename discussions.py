@@ -0,0 +1,138 @@
+import logging as log
+import re
+
+import gh
+import gl
+
+
+# Every copied comment ends with this marker, so reruns without a state DB can tell what is already on the PR.
+MARKER = '<!-- gl2gh:{} -->'
+_MARKER_RE = re.compile(r'<!-- gl2gh:((?:note|approval):\d+) -->')
+# GitHub rejects comment bodies over 65536 characters; GitLab notes may be much longer.
+MAX_BODY_CHARS = 60000
+
+
+def sync_mr_notes(gitlab_repo, mr, gh_owner, gh_repo, pr, store=None):
+    """Copy the discussions, comments and approvals of a MR to its PR. Returns True if everything was copied.
+
+    Discussions are streamed from GitLab a page at a time and their notes posted one by one in GitLab's order;
+    callers sync different PRs concurrently. Diff notes become review comments on the same line, with the replies
+    in their thread, and fall back to a conversation comment naming the file and line when GitHub rejects the
+    position. Approvals become comment-only reviews. System notes are skipped. Copied notes are recorded in
+    `store`; without one, the markers of the comments already on the PR are read first.
+    """
+    iid = mr.get('iid')
+    number = pr.get('number')
+    try:
+        copied = _CopiedNotes(gh_owner, gh_repo, mr, number, store)
+    except RuntimeError as e:
+        # Without the full list of copied notes, every note not seen would be posted again.
+        log.error(str(e))
+        return False
+    posted = 0
+    failures = 0
+    try:
+        for discussion in gl.iter_mr_discussions(gitlab_repo, iid):
+            thread = None
+            notes = [note for note in discussion.get('notes') or [] if not note.get('system')]
+            for n, note in enumerate(notes):
+                key = f"note:{note.get('id')}"
+                done = copied.get(key)
+                if done is None:
+                    done = _post_note(gh_owner, gh_repo, number, note, key, thread)
+                    if done is None:
+                        failures += 1
+                        continue
+                    copied.add(key, *done)
+                    posted += 1
+                if n == 0 and done[1] == 'review_comment':
+                    thread = done[0]
+    except RuntimeError as e:
+        log.error(str(e))
+        failures += 1
+
+    approvers = gl.get_mr_approvals(gitlab_repo, iid)
+    if approvers is None:
+        failures += 1
+    for user in approvers or []:
+        key = f"approval:{user.get('id')}"
+        if copied.get(key):
+            continue
+        review = gh.create_review(gh_owner, gh_repo, number, _with_marker(f"Approved on GitLab by {_who(user)}.", key))
+        if review is None:
+            failures += 1
+            continue
+        copied.add(key, review.get('id'), 'review')
+        posted += 1
+
+    if posted or failures:
+        log.info(f"Copied {posted} comments and approvals of MR !{iid} to PR #{number}"
+                 + (f"; {failures} failed" if failures else ''))
+    return not failures
+
+
+class _CopiedNotes:
+    """Note key -> (GitHub id, kind) of what was already copied to one PR, kept in the state store if there is one.
+
+    A store that has nothing for the MR yet is seeded from the PR's markers, so PRs whose comments were copied
+    before the store existed are not commented twice.
+    """
+
+    def __init__(self, owner, repo, mr, number, store=None):
+        self._mr = mr
+        self._store = store
+        self._known = {}
+        if store is None or not store.has_copied_notes(mr):
+            for kind, comment in gh.iter_pr_comments(owner, repo, number):
+                match = _MARKER_RE.search(comment.get('body') or '')
+                if match:
+                    self.add(match.group(1), comment.get('id'), kind)
+
+    def get(self, key):
+        if self._store:
+            return self._store.copied_note(self._mr, key)
+        return self._known.get(key)
+
+    def add(self, key, github_id, kind):
+        if self._store:
+            self._store.record_note(self._mr, key, github_id, kind)
+        else:
+            self._known[key] = (github_id, kind)
+
+
+def _post_note(owner, repo, number, note, key, thread=None):
+    """Post one GitLab note to the PR. Returns (github_id, kind), or None on failure."""
+    if thread is not None:
+        comment = gh.reply_to_review_comment(owner, repo, number, thread, _note_body(note, key))
+        if comment:
+            return comment.get('id'), 'review_comment'
+
+    position = (note.get('position') or {}) if note.get('type') == 'DiffNote' else {}
+    line = position.get('new_line') or position.get('old_line')
+    path = position.get('new_path') if position.get('new_line') else position.get('old_path')
+    if thread is None and line and path and position.get('head_sha'):
+        comment = gh.create_review_comment(owner, repo, number, _note_body(note, key), position['head_sha'], path,
+                                           line, 'RIGHT' if position.get('new_line') else 'LEFT')
+        if comment:
+            return comment.get('id'), 'review_comment'
+
+    where = f" on `{path}` line {line}" if line and path else ''
+    comment = gh.create_issue_comment(owner, repo, number, _note_body(note, key, where))
+    return (comment.get('id'), 'issue_comment') if comment else None
+
+
+def _note_body(note, key, where=''):
+    body = note.get('body') or ''
+    if len(body) > MAX_BODY_CHARS:
+        body = body[:MAX_BODY_CHARS] + '\n\n*(truncated; see the original on GitLab)*'
+    header = f"**{_who(note.get('author') or {})}** commented on GitLab{where} at {note.get('created_at')}:"
+    return _with_marker(f"{header}\n\n{body}", key)
+
+
+def _who(user):
+    name = user.get('name') or user.get('username') or 'unknown'
+    return f"{name} (@{user['username']})" if user.get('username') and user.get('name') else name
+
+
+def _with_marker(text, key):
+    return f"{text}\n\n{MARKER.format(key)}"
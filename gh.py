@@ -1,23 +1,68 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import json
 import logging as log
 import os
+import re
 import subprocess
 import sys
-import urllib.request
-import urllib.error
+import threading
+import time
+import zlib
+
+from gl import CLONE_LOCK, CLOSED_MR_STATES
+import aio_http
+import http_cache
+import metrics
+import refs
+import steps
+import tokens
 
 
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
+# GITHUB_TOKEN plus the read-only tokens of GITHUB_TOKENS / GITHUB_TOKENS_FILE (see tokens.TokenPool).
+TOKENS = tokens.TokenPool.from_env('GITHUB', GITHUB_TOKEN, 'token {}')
 LOCAL_CLONE_DIR = os.getenv('LOCAL_CLONE_DIR', 'repo')
-
-
-def ensure_repo(gh_repo):
+# Overridable so the tool can be pointed at local stand-in servers (see bench/).
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+GITHUB_URL = os.getenv('GITHUB_URL', 'https://github.com').rstrip('/')
+GITHUB_REMOTE = 'github'
+MIRRORED_REF_PREFIXES = ('refs/heads/', 'refs/tags/')
+PUSHED_REFS_FILE = 'gl2gh-pushed-refs.json'
+# Chunked mirror push: temporary refs on GitHub, checkpoint file in the clone, first step and retries per step.
+CHUNK_REF_PREFIX = 'refs/gl2gh-chunks/'
+CHUNK_PROGRESS_FILE = 'gl2gh-chunk-progress.json'
+CHUNK_FIRST_STEP = 256
+CHUNK_PUSH_ATTEMPTS = 3
+PUSH_CHUNK_SIZE = 500
+# Sharded mirror push (push_repo with jobs > 1): tries per shard before the push is given up.
+PUSH_SHARD_ATTEMPTS = 3
+# `git push --porcelain` flags meaning the remote ref now matches: fast-forward, forced, new, up to date.
+PUSH_OK_FLAGS = (' ', '+', '*', '=')
+# Branches resolved per GraphQL query by remote_state.
+GRAPHQL_BATCH_SIZE = 100
+# Seconds a failed listing of open PRs is reported to later callers again before it is retried.
+PR_INDEX_RETRY_SECONDS = 60
+
+# Matches the provenance footer written by sync_mr_to_pr: (gitlab project, MR iid).
+_PROVENANCE_RE = re.compile(r"Imported from GitLab project (\S+) MR !(\d+) ")
+_pr_indexes = {}
+_pr_indexes_lock = threading.Lock()
+_pr_index_locks = {}
+_pr_index_builds = {}
+_pr_index_failures = {}
+
+
+def ensure_repo(gh_repo, create=True):
     owner, repo = _parse_owner_repo(gh_repo)
     log.info(f"Checking if GitHub repo '{owner}/{repo}' exists...")
     code, body = _api_request(f"/repos/{owner}/{repo}")
     if code == 200:
         log.info("GitHub repository exists.")
         return owner, repo
+    if code == 404 and not create:
+        log.error(f"GitHub repository '{owner}/{repo}' does not exist.")
+        sys.exit(1)
 
     auth_user = _authenticated_user()
     log.info(f"Authenticated GitHub user: {auth_user or '<unknown>'}")
@@ -60,98 +105,650 @@ def ensure_repo(gh_repo):
         sys.exit(1)
 
 
-def push_repo(gh_owner, gh_repo):
+def push_repo(gh_owner, gh_repo, chunk_bytes=None, jobs=1):
+    """Mirror the branches and tags of LOCAL_CLONE_DIR to GitHub.
+
+    The refs pushed by the last successful mirror are recorded in the clone, so later runs only push the refs
+    that changed since then (and delete the ones that disappeared). Without that record the refs GitHub already has
+    (ls-remote) stand in for it, and nothing is deleted: GitHub may hold branches of its own, such as the fork MR
+    branches pushed by sync. GitLab-internal refs of
+    the mirror cache (refs/merge-requests, refs/keep-around, ...) are not pushed.
+    With `chunk_bytes`, branch history is first pushed in packs of about that size (see _push_history_in_chunks).
+    With `jobs` > 1, the refs are pushed in shards over up to `jobs` connections at once (see _push_refs_sharded).
+    """
     log.info(f"Pushing to GitHub repository '{gh_repo}' ...")
     if not os.path.isdir(LOCAL_CLONE_DIR):
         log.error(f"Repository directory '{LOCAL_CLONE_DIR}' does not exist. Cannot push to GitHub.")
         sys.exit(1)
     owner, repo = gh_owner, gh_repo
-    remote_url = f"https://{GITHUB_TOKEN}@github.com/{owner}/{repo}.git"
-    if _remote_exists("origin"):
-        log.info("Updating existing 'origin' remote to point to the target repo.")
-        try:
-            _set_remote_url("origin", remote_url)
-        except subprocess.CalledProcessError as e:
-            log.error(f"Failed to update remote 'origin': {e}")
+    remote_url = _git_url(owner, repo, GITHUB_TOKEN)
+    try:
+        _set_remote_url(GITHUB_REMOTE, remote_url)
+    except subprocess.CalledProcessError as e:
+        log.error(f"Failed to set remote '{GITHUB_REMOTE}': {e}")
+        sys.exit(1)
+    # Push-only remote: without a fetch refspec git keeps no refs/remotes/github/* for the mirror fetch to prune.
+    metrics.run(["git", "-C", LOCAL_CLONE_DIR, "config", "--unset-all", f"remote.{GITHUB_REMOTE}.fetch"], check=False)
+    _cleanup_remote_lock_files(GITHUB_REMOTE)
+
+    current = _mirrored_refs()
+    previous = _load_pushed_refs(owner, repo)
+    if previous is None:
+        # Without a record only the refs GitHub lacks are pushed, and nothing is deleted.
+        remote = _remote_mirrored_refs()
+        previous = {ref: sha for ref, sha in remote.items() if ref in current}
+    if chunk_bytes:
+        _push_history_in_chunks(owner, repo, current, previous, chunk_bytes)
+    if jobs > 1:
+        failed = _push_refs_sharded(owner, repo, _changed_refspecs(current, previous), jobs)
+        if failed:
+            # Record what did get pushed, so the next run only pushes the refs of the failed shards.
+            pushed = dict(current)
+            for ref in failed:
+                if ref in previous:
+                    pushed[ref] = previous[ref]
+                else:
+                    pushed.pop(ref, None)
+            _save_pushed_refs(owner, repo, pushed)
+            log.error(f"Failed to push {len(failed)} refs to GitHub; rerun to push the failed shards.")
             sys.exit(1)
     else:
-        try:
-            subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "add", "origin", remote_url], check=True)
-        except subprocess.CalledProcessError as e:
-            log.error(f"Failed to add remote 'origin': {e}")
-            sys.exit(1)
-    _cleanup_origin_lock_files()
+        _push_refs(owner, repo, current, previous)
+    _save_pushed_refs(owner, repo, current)
+    if chunk_bytes:
+        _delete_chunk_refs(owner, repo)
+
+
+def _push_refs(owner, repo, current, previous):
+    """Push the refs that changed since `previous` over one connection at a time."""
+    refspecs = _changed_refspecs(current, previous)
+    if not refspecs:
+        log.info(f"GitHub repository '{owner}/{repo}' is already up to date.")
+        return
+    log.info(f"Pushing {len(refspecs)} changed refs to GitHub repository '{owner}/{repo}'.")
+    if len(refspecs) > PUSH_CHUNK_SIZE and not any(refspec.startswith(':') for refspec in refspecs):
+        # Many updates and no deletions (e.g. a first push): the namespace patterns push the same in one command,
+        # without matching thousands of explicit refspecs against every ref. No --prune, so nothing is deleted.
+        refspecs = [f"+{ns}*:{ns}*" for ns in MIRRORED_REF_PREFIXES]
     try:
-        subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "push", "--mirror", "origin"], check=True)
+        for i in range(0, len(refspecs), PUSH_CHUNK_SIZE):
+            metrics.run(["git", "-C", LOCAL_CLONE_DIR, "push", GITHUB_REMOTE] + refspecs[i:i + PUSH_CHUNK_SIZE],
+                        check=True)
     except subprocess.CalledProcessError as e:
         log.error(f"Failed to push to GitHub: {e}")
         sys.exit(1)
 
 
-def push_branch_from_local(owner, repo, branch):
-    existed_before_push = False
-    try:
-        if _branch_exists(owner, repo, branch):
-            log.info(f"Branch '{branch}' already exists on {owner}/{repo}.")
-            existed_before_push = True
-    except Exception as e:
-        log.warning(f"Could not determine if branch '{branch}' exists before push: {e}")
+def _changed_refspecs(current, previous):
+    """Refspecs that bring refs `previous` ({ref: sha}) on GitHub to `current`: updates, then deletions."""
+    refspecs = [f"+{ref}:{ref}" for ref, sha in sorted(current.items()) if previous.get(ref) != sha]
+    return refspecs + [f":{ref}" for ref in sorted(previous) if ref not in current]
+
 
-    masked = f"https://***@github.com/{owner}/{repo}.git"
-    log.info(f"Pushing local branch '{branch}' to remote {owner}/{repo} (remote URL masked: {masked})")
-    remote_url = f"https://{GITHUB_TOKEN}@github.com/{owner}/{repo}.git"
+def _remote_mirrored_refs():
+    """Return {refname: sha} of the branches and tags on GitHub, for a push without a record."""
     try:
-        subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "push", remote_url, f"{branch}:{branch}"], check=True)
+        result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "ls-remote", "--refs", GITHUB_REMOTE]
+                             + [f"{ns}*" for ns in MIRRORED_REF_PREFIXES],
+                             check=True, stdout=subprocess.PIPE, text=True)
     except subprocess.CalledProcessError as e:
-        log.error(f"Failed to push branch '{branch}' to {owner}/{repo}: {e}")
-        return False
+        log.error(f"Failed to list the refs of the GitHub repository: {e}")
+        sys.exit(1)
+    return {ref: sha for sha, ref in (line.split('\t', 1) for line in result.stdout.splitlines())}
+
+
+def _push_refs_sharded(owner, repo, refspecs, jobs):
+    """Push `refspecs` in shards over up to `jobs` connections at once. Returns the refs of the shards that failed.
+
+    Branches go first and tags second, so tag packs mostly find their commits on GitHub already. Each namespace is
+    split into `jobs` shards by a hash of the ref name. Shards that fail are retried on their own, up to
+    PUSH_SHARD_ATTEMPTS times in all. Every shard attempt is logged with its duration.
+    """
+    if not refspecs:
+        log.info(f"GitHub repository '{owner}/{repo}' is already up to date.")
+        return set()
+    log.info(f"Pushing {len(refspecs)} changed refs to GitHub repository '{owner}/{repo}' over {jobs} connections.")
+    failed = set()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for prefix in MIRRORED_REF_PREFIXES:
+            shards = {}
+            for refspec in refspecs:
+                ref = refspec.rsplit(':', 1)[1]
+                if ref.startswith(prefix):
+                    shards.setdefault(zlib.crc32(ref.encode('utf-8')) % jobs, []).append(refspec)
+            names = {n: f"{prefix.split('/')[1]} {n + 1}/{jobs}" for n in shards}
+            pending = sorted(shards)
+            for attempt in range(1, PUSH_SHARD_ATTEMPTS + 1):
+                if attempt > 1:
+                    log.warning(f"Retrying {len(pending)} failed shards of {prefix}* "
+                                f"(attempt {attempt}/{PUSH_SHARD_ATTEMPTS})")
+                    time.sleep(2 ** (attempt - 2))
+                results = list(pool.map(lambda n: _push_shard(names[n], shards[n], attempt), pending))
+                pending = [n for n, ok in zip(pending, results) if not ok]
+                if not pending:
+                    break
+            failed.update(refspec.rsplit(':', 1)[1] for n in pending for refspec in shards[n])
+    return failed
+
+
+def _push_shard(name, refspecs, attempt):
+    """Push the refspecs of one shard, PUSH_CHUNK_SIZE per `git push`. Returns True on success."""
+    started = time.monotonic()
+    with metrics.span('phase', 'push_shard', phase='push_shard') as span:
+        span.set(shard=name, refs=len(refspecs), attempt=attempt)
+        for i in range(0, len(refspecs), PUSH_CHUNK_SIZE):
+            result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "push", "--quiet", GITHUB_REMOTE]
+                                 + refspecs[i:i + PUSH_CHUNK_SIZE],
+                                 check=False, stderr=subprocess.PIPE, text=True)
+            if result.returncode != 0:
+                log.warning(f"Shard {name}: push of {len(refspecs)} refs failed after "
+                            f"{time.monotonic() - started:.1f}s (attempt {attempt}): {result.stderr.strip()}")
+                return False
+    log.info(f"Shard {name}: pushed {len(refspecs)} refs in {time.monotonic() - started:.1f}s (attempt {attempt})")
+    return True
+
+
+def _push_history_in_chunks(owner, repo, refs, previous, chunk_bytes):
+    """Push the first-parent history of every branch that GitHub lacks, one size-bounded step at a time.
+
+    Each step force-pushes a commit to a temporary ref under CHUNK_REF_PREFIX, so the pack only holds the objects
+    added since the previous step. The number of commits per step is re-estimated from the size of the last one
+    and shrunk when a pack would exceed `chunk_bytes` (as measured by `rev-list --disk-usage`). Pushed commits are checkpointed in the clone, so a
+    failed run resumes from the last step. A single commit larger than `chunk_bytes` is still pushed on its own.
+    """
+    progress = _load_chunk_progress(owner, repo)
+    known = set(previous.values()) | set(progress.values())
+    for ref, sha in sorted(refs.items()):
+        if not ref.startswith('refs/heads/') or sha in known:
+            continue
+        commits = _git_lines("rev-list", "--first-parent", "--reverse", "--ignore-missing", "--stdin",
+                             input=_revs(sha, known))
+        if not commits:
+            continue
+        chunk_ref = CHUNK_REF_PREFIX + ref[len('refs/heads/'):]
+        log.info(f"Pushing {len(commits)} commits of '{ref}' to {owner}/{repo} in chunks of up to {chunk_bytes >> 20} MB")
+        start, step = 0, CHUNK_FIRST_STEP
+        while start < len(commits):
+            end = min(start + step, len(commits)) - 1
+            size = int(_git_lines("rev-list", "--objects", "--disk-usage", "--ignore-missing", "--stdin",
+                                  input=_revs(commits[end], known))[0])
+            # Aim the next step at ~80% of the limit, assuming the commits just measured are typical.
+            fitting = max(1, int((end - start + 1) * chunk_bytes * 0.8 / max(size, 1)))
+            if size > chunk_bytes and end > start:
+                step = min(fitting, end - start)
+                continue
+            _push_chunk(f"+{commits[end]}:{chunk_ref}", end + 1, len(commits), size)
+            known.add(commits[end])
+            progress[ref] = commits[end]
+            _save_chunk_progress(owner, repo, progress)
+            start = end + 1
+            step = fitting
+
+
+def _push_chunk(refspec, done, total, size):
+    for attempt in range(CHUNK_PUSH_ATTEMPTS):
+        result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "push", "--quiet", GITHUB_REMOTE, refspec], check=False)
+        if result.returncode == 0:
+            log.info(f"Pushed history up to commit {done}/{total} ({size / 2 ** 20:.1f} MB)")
+            return
+        log.warning(f"Chunk push {refspec} failed (attempt {attempt + 1}/{CHUNK_PUSH_ATTEMPTS})")
+        time.sleep(2 ** attempt)
+    log.error("Failed to push history chunk; rerun to resume from the last pushed chunk.")
+    sys.exit(1)
+
+
+def _delete_chunk_refs(owner, repo):
+    """Remove the temporary chunk refs from GitHub and forget the checkpoints once the real refs are pushed."""
+    progress = _load_chunk_progress(owner, repo)
+    if progress:
+        refspecs = [f":{CHUNK_REF_PREFIX}{ref[len('refs/heads/'):]}" for ref in sorted(progress)]
+        result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "push", "--quiet", GITHUB_REMOTE] + refspecs, check=False)
+        if result.returncode != 0:
+            log.warning(f"Could not delete temporary {CHUNK_REF_PREFIX}* refs on {owner}/{repo}; they are harmless.")
+    try:
+        os.remove(os.path.join(_git_dir(), CHUNK_PROGRESS_FILE))
+    except FileNotFoundError:
+        pass
+
+
+def _load_chunk_progress(owner, repo):
+    """Return {branch ref: last commit pushed to its chunk ref} of an unfinished chunked push to owner/repo."""
+    path = os.path.join(_git_dir(), CHUNK_PROGRESS_FILE)
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        log.warning(f"Ignoring unreadable chunk checkpoint {path}: {e}")
+        return {}
+    if state.get('target') != f"{owner}/{repo}".lower():
+        return {}
+    return state.get('refs') or {}
+
+
+def _save_chunk_progress(owner, repo, progress):
+    path = os.path.join(_git_dir(), CHUNK_PROGRESS_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'target': f"{owner}/{repo}".lower(), 'refs': progress}, f)
+    os.replace(tmp_path, path)
+
 
-    re_exists = _branch_exists(owner, repo, branch)
-    if re_exists:
-        if not existed_before_push:
-            log.info(f"Successfully pushed branch '{branch}' to {owner}/{repo}.")
-        return True
+def _revs(tip, exclude):
+    """rev-list --stdin input: `tip` minus everything reachable from `exclude`."""
+    return ''.join([f"{tip}\n"] + [f"^{sha}\n" for sha in exclude])
 
-    log.error(f"Branch '{branch}' still not visible on GitHub after push attempt.")
-    return False
+
+def _git_lines(*args, input=None):
+    result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, *args], input=input, check=True,
+                         stdout=subprocess.PIPE, text=True)
+    return result.stdout.split()
+
+
+def push_branch_from_local(owner, repo, branch):
+    """Push one local branch to GitHub. Returns True if the branch is on GitHub afterwards."""
+    return branch in push_branches_from_local(owner, repo, [branch])
+
+
+def push_branches_from_local(owner, repo, branches):
+    """Push local branches to GitHub. Returns the set of branches that are on GitHub afterwards (pushed, or already
+    up to date). See push_branches_steps.
+    """
+    with CLONE_LOCK:
+        return steps.run(push_branches_steps(owner, repo, branches))
+
+
+def push_branches_steps(owner, repo, branches):
+    """Steps (see steps.py) of push_branches_from_local, with as few `git push` invocations as possible.
+
+    Branches are sent PUSH_CHUNK_SIZE refspecs per push and the per-ref outcome is read from `--porcelain` output,
+    so no API round trips are needed to verify them.
+    """
+    masked = _git_url(owner, repo, '***')
+    remote_url = _git_url(owner, repo, GITHUB_TOKEN)
+    pushed = set()
+    branches = list(dict.fromkeys(branches))
+    for i in range(0, len(branches), PUSH_CHUNK_SIZE):
+        chunk = branches[i:i + PUSH_CHUNK_SIZE]
+        log.info(f"Pushing {len(chunk)} local branches to remote {owner}/{repo} (remote URL masked: {masked})")
+        refspecs = [f"refs/heads/{branch}:refs/heads/{branch}" for branch in chunk]
+        try:
+            _, out, err = yield steps.git(LOCAL_CLONE_DIR, "push", "--porcelain", remote_url, *refspecs)
+        except Exception as e:
+            log.error(f"Failed to push branches to {owner}/{repo}: {e}")
+            continue
+        statuses = _parse_push_porcelain(out)
+        if not statuses and len(chunk) > 1:
+            # git rejected the whole command (e.g. one refspec has no local branch); isolate the bad ones.
+            log.warning(f"Batched push of {len(chunk)} branches failed; retrying them one by one.")
+            for branch in chunk:
+                pushed.update((yield from push_branches_steps(owner, repo, [branch])))
+            continue
+        pushed.update(_push_outcomes(owner, repo, chunk, statuses, err))
+    return pushed
+
+
+def _push_outcomes(owner, repo, branches, statuses, stderr):
+    """Log the porcelain status of each pushed branch. Returns the branches that are on GitHub afterwards."""
+    pushed = set()
+    for branch in branches:
+        flag, summary = statuses.get(f"refs/heads/{branch}", (None, None))
+        if flag in PUSH_OK_FLAGS:
+            pushed.add(branch)
+            if flag == '=':
+                log.info(f"Branch '{branch}' already up to date on {owner}/{repo}.")
+            else:
+                log.info(f"Successfully pushed branch '{branch}' to {owner}/{repo}.")
+        elif flag is None:
+            log.error(f"Failed to push branch '{branch}' to {owner}/{repo}: {stderr.strip()}")
+        else:
+            log.error(f"Failed to push branch '{branch}' to {owner}/{repo}: {summary}")
+    return pushed
+
+
+def remote_state(owner, repo, branches):
+    """Look up the GitHub side of many branches with batched GraphQL queries. See remote_state_steps."""
+    return steps.run(remote_state_steps(owner, repo, branches))
+
+
+def remote_state_steps(owner, repo, branches):
+    """Steps (see steps.py) of remote_state; the asyncio driver runs the queries of all chunks concurrently.
+
+    Returns {branch: {'oid': head commit SHA or None if the branch does not exist, 'pr': open PR from that branch
+    (REST-shaped dict with number, html_url, title, body, head.ref, base.ref) or None}}. Up to GRAPHQL_BATCH_SIZE
+    branches are resolved per query using aliases. Branches of a failed query are left out of the result.
+    """
+    branches = list(dict.fromkeys(branches))
+    chunks = [branches[i:i + GRAPHQL_BATCH_SIZE] for i in range(0, len(branches), GRAPHQL_BATCH_SIZE)]
+    responses = yield [_graphql(*_remote_state_query(owner, repo, chunk)) for chunk in chunks]
+    state = {}
+    for chunk, (code, body, _) in zip(chunks, responses):
+        data = _graphql_data(code, body)
+        if data is not None:
+            state.update(_parse_remote_state(owner, repo, chunk, data))
+    return state
+
+
+def _remote_state_query(owner, repo, branches):
+    """Build the aliased GraphQL (query, variables) resolving head OID and open PR of each branch."""
+    params = ['$owner: String!', '$repo: String!']
+    fields = []
+    variables = {'owner': owner, 'repo': repo}
+    for n, branch in enumerate(branches):
+        params += [f'$r{n}: String!', f'$h{n}: String!']
+        variables[f'r{n}'] = f"refs/heads/{branch}"
+        variables[f'h{n}'] = branch
+        fields.append(f'b{n}: ref(qualifiedName: $r{n}) {{ target {{ oid }} }} '
+                      f'p{n}: pullRequests(headRefName: $h{n}, states: OPEN, first: 5) {{ nodes {{ '
+                      f'number url title body baseRefName headRefName headRepository {{ nameWithOwner }} }} }}')
+    query = f"query({', '.join(params)}) {{ repository(owner: $owner, name: $repo) {{ {' '.join(fields)} }} }}"
+    return query, variables
+
+
+def _parse_remote_state(owner, repo, branches, data):
+    state = {}
+    repository = data.get('repository') or {}
+    for n, branch in enumerate(branches):
+        ref = repository.get(f'b{n}')
+        prs = [pr for pr in ((repository.get(f'p{n}') or {}).get('nodes') or [])
+               if ((pr.get('headRepository') or {}).get('nameWithOwner') or '').lower() == f"{owner}/{repo}".lower()]
+        state[branch] = {
+            'oid': ((ref or {}).get('target') or {}).get('oid'),
+            'pr': _rest_shaped_pr(prs[0]) if prs else None,
+        }
+    return state
 
 
 def sync_mr_to_pr(gitlab_repo, mr, gh_owner, gh_repo):
-    """Convert a GitLab MR (dict as returned by GitLab API) to a GitHub PR.
+    """Convert a GitLab MR (dict as returned by GitLab API) to a GitHub PR. See sync_mr_to_pr_steps."""
+    return steps.run(sync_mr_to_pr_steps(gitlab_repo, mr, gh_owner, gh_repo))
+
+
+def sync_mr_to_pr_steps(gitlab_repo, mr, gh_owner, gh_repo):
+    """Steps (see steps.py) of sync_mr_to_pr.
     mr: the MR dict from GitLab. gitlab_repo: original project identifier (path or url) for reference.
-    user_map: optional dict mapping gitlab usernames to github logins.
-    Returns True on success, False on failure.
+    An existing PR is brought up to date with the fields plan_pr_update reports as changed.
+    Returns the PR dict (existing or newly created) on success, None on failure.
     """
-    title = mr.get('title')
-    description = mr.get('description') or ''
     iid = mr.get('iid')
     source_branch = mr.get('source_branch')
-    target_branch = mr.get('target_branch')
+    title, body = _pr_title_body(gitlab_repo, mr)
+
+    try:
+        index = yield steps.call(_open_pr_index, _open_pr_index_async, gh_owner, gh_repo)
+    except RuntimeError as e:
+        log.error(f"Cannot check for an open PR of MR !{iid}: {e}")
+        return None
+    existing_pr = index.find(gitlab_repo, iid, source_branch)
+    if existing_pr:
+        changes = plan_pr_update(gitlab_repo, mr, existing_pr)
+        if changes:
+            return (yield from _update_pull_request(gh_owner, gh_repo, existing_pr, changes))
+        log.info(f"Open PR for MR !{iid} already exists: #{existing_pr.get('number')} - {existing_pr.get('html_url')}")
+        return existing_pr
+
+    pr = yield from _create_pull_request(gh_owner, gh_repo, source_branch, mr.get('target_branch'), title, body)
+    if pr is None:
+        log.error(f"Failed to create PR for MR !{iid}")
+        return None
+    index.add(pr)
+
+    log.info(f"Synchronized MR !{iid} -> PR on {gh_owner}/{gh_repo}")
+    return pr
+
+
+def plan_pr_update(gitlab_repo, mr, pr):
+    """Return the PATCH payload that brings `pr` in line with `mr`: the changed title, body and base branch, or
+    `{'state': 'closed'}` once the MR is closed or merged. An empty dict means the PR needs no write.
+    """
+    if mr.get('state') in CLOSED_MR_STATES:
+        return {'state': 'closed'} if pr.get('state', 'open') == 'open' else {}
+    title, body = _pr_title_body(gitlab_repo, mr)
+    changes = {}
+    if (pr.get('title') or '') != (title or ''):
+        changes['title'] = title
+    # GitHub may hand back the body with CRLF line endings.
+    if (pr.get('body') or '').replace('\r\n', '\n').strip() != body.replace('\r\n', '\n').strip():
+        changes['body'] = body
+    if mr.get('target_branch') and (pr.get('base') or {}).get('ref') != mr.get('target_branch'):
+        changes['base'] = mr.get('target_branch')
+    return changes
+
+
+def update_pull_request(owner, repo, pr, changes):
+    """PATCH `changes` (from plan_pr_update) onto `pr`. Returns the updated PR dict, or None on failure."""
+    return steps.run(_update_pull_request(owner, repo, pr, changes))
+
+
+def _update_pull_request(owner, repo, pr, changes):
+    code, resp, _ = yield _api(f"/repos/{owner}/{repo}/pulls/{pr.get('number')}", method='PATCH', data=changes)
+    return _updated_pr(owner, repo, pr, changes, code, resp)
+
+
+def forget_open_prs(owner, repo, before=None):
+    """Drop the cached open-PR index of owner/repo, or only if it was built before `before` (time.monotonic()), so
+    the next use lists the open PRs again. Long-running callers use it to see PRs that others opened, closed or
+    retargeted since.
+    """
+    key = f"{owner}/{repo}".lower()
+    with _pr_indexes_lock:
+        index = _pr_indexes.get(key)
+        if index is not None and (before is None or index.built_at < before):
+            del _pr_indexes[key]
+
+
+def open_prs_by_mr(owner, repo, gitlab_repo):
+    """Return {MR iid: open PR} for the open PRs of owner/repo imported from `gitlab_repo`."""
+    return _open_pr_index(owner, repo).imported_from(gitlab_repo)
+
+
+def _updated_pr(owner, repo, pr, changes, code, resp):
+    if code != 200 or not isinstance(resp, dict):
+        log.error(f"Failed to update PR #{pr.get('number')} ({', '.join(changes)}): status={code} body={resp}")
+        return None
+    log.info(f"Updated {', '.join(changes)} of PR #{pr.get('number')} - {pr.get('html_url')}")
+    index = _pr_indexes.get(f"{owner}/{repo}".lower())
+    if index is not None and changes.get('state') == 'closed':
+        index.discard(pr)
+    elif index is not None:
+        index.add(resp)
+    return resp
+
+
+def create_issue_comment(owner, repo, number, body):
+    """Comment on the conversation of PR `number`. Returns the comment dict, or None on failure."""
+    code, resp = _api_request(f"/repos/{owner}/{repo}/issues/{number}/comments", method='POST', data={'body': body})
+    return _created(code, resp, f"comment on PR #{number}")
+
+
+def create_review_comment(owner, repo, number, body, commit_id, path, line, side='RIGHT'):
+    """Comment on `line` of `path` in the diff of PR `number` at `commit_id`. Returns the comment dict, or None
+    on failure (GitHub answers 422 when the line is not part of the diff).
+    """
+    data = {'body': body, 'commit_id': commit_id, 'path': path, 'line': line, 'side': side}
+    code, resp = _api_request(f"/repos/{owner}/{repo}/pulls/{number}/comments", method='POST', data=data)
+    return _created(code, resp, f"review comment on {path}:{line} of PR #{number}", quiet=code == 422)
+
+
+def reply_to_review_comment(owner, repo, number, comment_id, body):
+    """Reply in the thread of review comment `comment_id`. Returns the comment dict, or None on failure."""
+    code, resp = _api_request(f"/repos/{owner}/{repo}/pulls/{number}/comments/{comment_id}/replies",
+                              method='POST', data={'body': body})
+    return _created(code, resp, f"reply to review comment {comment_id} of PR #{number}")
+
+
+def create_review(owner, repo, number, body):
+    """Submit a comment-only review on PR `number`. Returns the review dict, or None on failure."""
+    code, resp = _api_request(f"/repos/{owner}/{repo}/pulls/{number}/reviews", method='POST',
+                              data={'body': body, 'event': 'COMMENT'})
+    return _created(code, resp, f"review of PR #{number}")
+
+
+def iter_pr_comments(owner, repo, number):
+    """Yield ('issue_comment' | 'review_comment' | 'review', dict) for everything already posted on PR `number`."""
+    for comment in _iter_pages(f"/repos/{owner}/{repo}/issues/{number}/comments"):
+        yield 'issue_comment', comment
+    for comment in _iter_pages(f"/repos/{owner}/{repo}/pulls/{number}/comments"):
+        yield 'review_comment', comment
+    for review in _iter_pages(f"/repos/{owner}/{repo}/pulls/{number}/reviews"):
+        yield 'review', review
+
+
+def _created(code, resp, what, quiet=False):
+    if code in (200, 201) and isinstance(resp, dict):
+        return resp
+    if not quiet:
+        log.error(f"Failed to create {what}: status={code} body={resp}")
+    return None
+
+
+def _pr_title_body(gitlab_repo, mr):
+    """Return the (title, body) of the PR for a MR; the body ends with the provenance footer."""
+    description = mr.get('description') or ''
     author = mr.get('author', {}) or {}
     author_name = author.get('name') or author.get('username')
-    web_url = mr.get('web_url')
+    provenance = (f"\n\n---\nImported from GitLab project {gitlab_repo} MR !{mr.get('iid')} by {author_name}. "
+                  f"Original: {mr.get('web_url')}")
+    return mr.get('title'), description + provenance
 
-    provenance = f"\n\n---\nImported from GitLab project {gitlab_repo} MR !{iid} by {author_name}. Original: {web_url}"
-    body = (description or '') + provenance
 
-    try:
-        code_prs, prs = _api_request(f"/repos/{gh_owner}/{gh_repo}/pulls?state=open")
-        if code_prs == 200 and isinstance(prs, list):
-            for existing_pr in prs:
-                if (existing_pr.get('title') or '').strip() == (title or '').strip():
-                    log.info(f"Open PR with title `{title}` already exists: #{existing_pr.get('number')} - {existing_pr.get('html_url')}")
-                    return True
-    except Exception as e:
-        log.warning(f"Failed to check existing PRs before creating PR: {e}")
+class _OpenPrIndex:
+    """Open PRs of one repository keyed by head branch and by the GitLab MR embedded in the provenance footer.
+    Only PRs whose head branch is in the repository itself are keyed by head, since a fork may have a branch of the
+    same name.
+    """
 
+    def __init__(self, full_name):
+        self._full_name = full_name.lower()
+        self.built_at = time.monotonic()
+        self._by_head = {}
+        self._by_mr = {}
+        self._lock = threading.Lock()
+
+    def add(self, pr):
+        head = pr.get('head') or {}
+        head_repo = ((head.get('repo') or {}).get('full_name') or '').lower()
+        match = _PROVENANCE_RE.search(pr.get('body') or '')
+        with self._lock:
+            if head.get('ref') and head_repo == self._full_name:
+                self._by_head[head['ref']] = pr
+            if match:
+                self._by_mr[(match.group(1), match.group(2))] = pr
+
+    def discard(self, pr):
+        with self._lock:
+            for index in (self._by_head, self._by_mr):
+                for key in [key for key, value in index.items() if value.get('number') == pr.get('number')]:
+                    del index[key]
+
+    def imported_from(self, gitlab_repo):
+        with self._lock:
+            return {int(iid): pr for (project, iid), pr in self._by_mr.items() if project == str(gitlab_repo)}
+
+    def find(self, gitlab_repo, iid, head):
+        """Return the open PR imported from `gitlab_repo` MR `iid`, or opened from branch `head` of this repository;
+        None if absent.
+        """
+        with self._lock:
+            return self._by_mr.get((str(gitlab_repo), str(iid))) or self._by_head.get(head)
+
+
+def _open_pr_index(owner, repo):
+    """Return the open-PR index of owner/repo, listing every page of open PRs on first use in this run.
+    Only a complete listing is kept; raises RuntimeError if a page cannot be fetched.
+    """
+    key = f"{owner}/{repo}".lower()
+    with _pr_indexes_lock:
+        lock = _pr_index_locks.setdefault(key, threading.Lock())
+    # Per repository, so listing the PRs of one does not hold up callers of another.
+    with lock:
+        index = _pr_indexes.get(key)
+        if index is None:
+            index = steps.run(_list_open_prs(owner, repo))
+            with _pr_indexes_lock:
+                _pr_indexes[key] = index
+        return index
+
+
+async def _open_pr_index_async(owner, repo):
+    """asyncio twin of _open_pr_index; concurrent callers share a single listing, and its failure."""
+    key = f"{owner}/{repo}".lower()
+    index = _pr_indexes.get(key)
+    if index is not None:
+        return index
+    build = _pr_index_builds.get(key)
+    if build is None:
+        build = _pr_index_builds[key] = asyncio.ensure_future(steps.run_async(_list_open_prs(owner, repo)))
+    try:
+        index = await build
+    finally:
+        _pr_index_builds.pop(key, None)
+    with _pr_indexes_lock:
+        _pr_indexes[key] = index
+    return index
+
+
+def _list_open_prs(owner, repo):
+    """Steps listing every page of open PRs of owner/repo into a new _OpenPrIndex. Raises RuntimeError if a page
+    cannot be fetched: with a partial index, sync would open duplicates of the PRs it missed. For
+    PR_INDEX_RETRY_SECONDS after a failure the same error is raised without listing again, so the MRs of a batch do
+    not each wait for the retries of a listing that keeps failing.
+    """
+    key = f"{owner}/{repo}".lower()
+    failed_at, error = _pr_index_failures.get(key, (None, None))
+    if failed_at is not None and time.monotonic() - failed_at < PR_INDEX_RETRY_SECONDS:
+        raise RuntimeError(error)
+    index = _OpenPrIndex(f"{owner}/{repo}")
+    count = 0
+    next_path = f"/repos/{owner}/{repo}/pulls?state=open&per_page=100"
+    while next_path:
+        code, body, headers = yield _api(next_path)
+        try:
+            _check_page(next_path, code, body)
+        except RuntimeError as e:
+            _pr_index_failures[key] = (time.monotonic(), str(e))
+            raise
+        for pr in body:
+            index.add(pr)
+            count += 1
+        next_path = _next_page_path(headers)
+    log.info(f"Indexed {count} open PRs on {owner}/{repo}")
+    return index
+
+
+def _iter_pages(path, per_page=100):
+    """Yield the items of a paginated GitHub list endpoint, following the Link rel="next" header.
+    Raises RuntimeError if a page cannot be fetched.
+    """
+    sep = '&' if '?' in path else '?'
+    next_path = f"{path}{sep}per_page={per_page}"
+    while next_path:
+        code, body, headers = _api_call(next_path)
+        yield from _check_page(next_path, code, body)
+        next_path = _next_page_path(headers)
+
+
+def _check_page(path, code, body):
+    """Return the items of a list page, or raise RuntimeError if the request failed."""
+    if code != 200 or not isinstance(body, list):
+        raise RuntimeError(f"Failed to list `{path}` on GitHub: status={code} body={body}")
+    return body
+
+
+def _next_page_path(headers):
+    """Return the API path of the `rel="next"` page from a Link header, or None on the last page."""
+    for link in (headers.get('Link') or '').split(','):
+        parts = link.split(';')
+        if len(parts) >= 2 and any(p.strip() == 'rel="next"' for p in parts[1:]):
+            url = parts[0].strip().lstrip('<').rstrip('>')
+            return url.split(GITHUB_API_URL, 1)[-1]
+    return None
 
-    pr = _create_pull_request(gh_owner, gh_repo, source_branch, target_branch, title, body)
-    if pr is None:
-        log.error(f"Failed to create PR for MR !{iid}")
-        return False
 
-    log.info(f"Synchronized MR !{iid} -> PR on {gh_owner}/{gh_repo}")
-    return True
+def _git_url(owner, repo, token):
+    scheme, host = GITHUB_URL.split('://', 1)
+    return f"{scheme}://{token}@{host}/{owner}/{repo}.git"
 
 
 def _parse_owner_repo(url):
@@ -170,7 +767,39 @@ def _parse_owner_repo(url):
 
 def _api_request(path, method='GET', data=None, headers=None):
     """Make a request to the GitHub REST API and return (status_code, json_body-or-None)."""
-    url = f"https://api.github.com{path}"
+    code, body, _ = _api_call(path, method=method, data=data, headers=headers)
+    return code, body
+
+
+def _api_call(path, method='GET', data=None, headers=None):
+    """Same as _api_request but returns (status_code, json_body-or-None, response_headers).
+    Response headers are empty on connection errors.
+    """
+    url, body, req_headers = _build_api_request(path, data, headers)
+    try:
+        response = http_cache.request(method, url, body=body, headers=req_headers, identity=GITHUB_TOKEN or '',
+                                      tokens=TOKENS)
+        return _decode_api_response(*response)
+    except Exception as e:
+        log.error(f"GitHub API request failed: {e}")
+        return None, None, {}
+
+
+async def _api_call_async(path, method='GET', data=None, headers=None):
+    """asyncio twin of _api_call."""
+    url, body, req_headers = _build_api_request(path, data, headers)
+    try:
+        response = await aio_http.request(method, url, body=body, headers=req_headers, identity=GITHUB_TOKEN or '',
+                                          tokens=TOKENS)
+        return _decode_api_response(*response)
+    except Exception as e:
+        log.error(f"GitHub API request failed: {e}")
+        return None, None, {}
+
+
+def _build_api_request(path, data, headers):
+    """Return (url, body_bytes-or-None, headers) for a GitHub REST API call."""
+    url = f"{GITHUB_API_URL}{path}"
     req_headers = {
         'Authorization': f'token {GITHUB_TOKEN}',
         'Accept': 'application/vnd.github+json',
@@ -183,17 +812,45 @@ def _api_request(path, method='GET', data=None, headers=None):
         req_headers['Content-Type'] = 'application/json'
     else:
         body = None
-    req = urllib.request.Request(url, data=body, headers=req_headers, method=method)
-    try:
-        with urllib.request.urlopen(req) as resp:
-            resp_body = resp.read().decode('utf-8')
-            return resp.getcode(), json.loads(resp_body) if resp_body else None
-    except urllib.error.HTTPError as e:
-        err_body = e.read().decode('utf-8')
-        return e.code, json.loads(err_body) if err_body else None
-    except Exception as e:
-        log.error(f"GitHub API request failed: {e}")
-        return None, None
+    return url, body, req_headers
+
+
+def _decode_api_response(code, resp_headers, resp_body):
+    resp_body = resp_body.decode('utf-8')
+    return code, json.loads(resp_body) if resp_body else None, resp_headers
+
+
+def _api(path, method='GET', data=None):
+    """Call (see steps.py) of a GitHub REST API request; its result is that of _api_call."""
+    return steps.call(_api_call, _api_call_async, path, method=method, data=data)
+
+
+def _graphql(query, variables=None):
+    """Call of a GitHub GraphQL query; pass its (code, body, headers) result to _graphql_data."""
+    return _api('/graphql', method='POST', data={'query': query, 'variables': variables or {}})
+
+
+def _graphql_data(code, body):
+    """Return the `data` object of a GraphQL response, or None if the query failed."""
+    if code != 200 or not isinstance(body, dict) or body.get('data') is None:
+        log.warning(f"GitHub GraphQL query failed: status={code} body={body}")
+        return None
+    if body.get('errors'):
+        log.warning(f"GitHub GraphQL query returned errors: {body['errors']}")
+    return body['data']
+
+
+def _rest_shaped_pr(node):
+    """Convert a GraphQL PullRequest node to the REST fields the rest of this module reads."""
+    return {
+        'number': node.get('number'),
+        'html_url': node.get('url'),
+        'title': node.get('title'),
+        'body': node.get('body'),
+        'head': {'ref': node.get('headRefName'),
+                 'repo': {'full_name': (node.get('headRepository') or {}).get('nameWithOwner')}},
+        'base': {'ref': node.get('baseRefName')},
+    }
 
 
 def _authenticated_user():
@@ -205,37 +862,25 @@ def _authenticated_user():
     return None
 
 
-def _branch_exists(owner, repo, branch):
-    """Return True if branch exists on GitHub, False otherwise."""
-    headers = {'Authorization': f'token {GITHUB_TOKEN}'}
-    code, body = _api_request(f"/repos/{owner}/{repo}/branches/{branch}", headers=headers)
-    if code == 200:
-        log.info(f"Branch '{branch}' exists on {owner}/{repo}.")
-        return True
-    if code == 404:
-        log.info(f"Branch '{branch}' does not exist on GitHub for {owner}/{repo}.")
-        return False
-
-    log.warning(f"Unexpected response checking branch '{branch}' on {owner}/{repo}: status={code} body={body}")
-    return False
-
-
-def _remote_exists(name):
-    try:
-        result = subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "get-url", name], check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.returncode == 0
-    except Exception as e:
-        log.warning(f"Unable to determine if remote '{name}' exists: {e}")
-        return False
+def _set_remote_url(name, url):
+    """Point remote `name` at `url`, adding the remote if it does not exist, with a single git call."""
+    metrics.run(["git", "-C", LOCAL_CLONE_DIR, "config", f"remote.{name}.url", url], check=True)
 
 
-def _set_remote_url(name, url):
-    subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "set-url", name, url], check=True)
+def _parse_push_porcelain(output):
+    """Parse `git push --porcelain` output into {remote_ref: (flag, summary)}."""
+    statuses = {}
+    for line in output.splitlines():
+        parts = line.split('\t')
+        if len(parts) < 3 or len(parts[0]) != 1:
+            continue
+        flag, refs, summary = parts[0], parts[1], parts[2]
+        statuses[refs.rsplit(':', 1)[-1]] = (flag, summary)
+    return statuses
 
 
-def _cleanup_origin_lock_files():
-    git_dir = os.path.join(LOCAL_CLONE_DIR, '.git')
-    origin_refs = os.path.join(git_dir, 'refs', 'remotes', 'origin')
+def _cleanup_remote_lock_files(name):
+    origin_refs = os.path.join(_git_dir(), 'refs', 'remotes', name)
     if not os.path.isdir(origin_refs):
         return
     for root, _, files in os.walk(origin_refs):
@@ -249,16 +894,59 @@ def _cleanup_origin_lock_files():
                     log.warning(f"Could not remove stale lock {lock_path}: {e}")
 
 
+def _git_dir():
+    """Return the git directory of LOCAL_CLONE_DIR (the folder itself for a bare mirror)."""
+    dot_git = os.path.join(LOCAL_CLONE_DIR, '.git')
+    return dot_git if os.path.isdir(dot_git) else LOCAL_CLONE_DIR
+
+
+def _mirrored_refs():
+    """Return {refname: sha} for the refs of LOCAL_CLONE_DIR that push_repo mirrors to GitHub."""
+    return refs.index_for(LOCAL_CLONE_DIR).refs(*MIRRORED_REF_PREFIXES)
+
+
+def _load_pushed_refs(owner, repo):
+    """Return the refs recorded by the last successful push_repo to owner/repo, or None if there is no record."""
+    path = os.path.join(_git_dir(), PUSHED_REFS_FILE)
+    try:
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        log.warning(f"Ignoring unreadable push record {path}: {e}")
+        return None
+    if state.get('target') != f"{owner}/{repo}".lower():
+        return None
+    return state.get('refs') or {}
+
+
+def _save_pushed_refs(owner, repo, refs):
+    path = os.path.join(_git_dir(), PUSHED_REFS_FILE)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'target': f"{owner}/{repo}".lower(), 'refs': refs}, f)
+    os.replace(tmp_path, path)
+
+
 def _create_pull_request(owner, repo, head, base, title, body):
     log.info(f"Creating pull request on {owner}/{repo}: {title} ({head} -> {base})")
 
-    payload = {
+    code, resp, _ = yield _api(f"/repos/{owner}/{repo}/pulls", method='POST', data=_pr_payload(head, base, title, body))
+    return _created_pr(code, resp)
+
+
+def _pr_payload(head, base, title, body):
+    return {
         "title": title,
         "body": body,
         "head": head,
         "base": base
     }
-    code, resp = _api_request(f"/repos/{owner}/{repo}/pulls", method='POST', data=payload)
+
+
+def _created_pr(code, resp):
+    """Return the PR dict of a create-PR response, or None (logged) if it failed."""
     if code in (200, 201):
         log.info(f"Created PR #{resp.get('number')} at {resp.get('html_url')}")
         return resp
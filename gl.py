@@ -1,20 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
 import json
 import logging as log
 import os
 import shutil
 import subprocess
 import sys
-import urllib.request
-import urllib.error
+import threading
 import urllib.parse
-import uuid
+
+import aio_http
+import http_cache
+import metrics
+import refs
+import steps
+import tokens
 
 
 GITLAB_TOKEN = os.getenv('GITLAB_TOKEN')
+# GITLAB_TOKEN plus the read-only tokens of GITLAB_TOKENS / GITLAB_TOKENS_FILE (see tokens.TokenPool).
+TOKENS = tokens.TokenPool.from_env('GITLAB', GITLAB_TOKEN, 'Bearer {}')
 LOCAL_CLONE_DIR = os.getenv('LOCAL_CLONE_DIR', 'repo')
+# Serializes git commands that mutate LOCAL_CLONE_DIR when MRs are synced from several threads.
+CLONE_LOCK = threading.RLock()
+# Number of MR heads fetched per `git fetch` by ensure_local_branches.
+FETCH_BATCH_SIZE = 200
+# MR states whose PR is closed. MRs in any other state but `opened` (e.g. `locked`, while GitLab merges them) are
+# left alone.
+CLOSED_MR_STATES = ('closed', 'merged')
+
+
+def clone_repo(gl_repo, clone_filter=None):
+    """Mirror the GitLab repository into LOCAL_CLONE_DIR.
+
+    LOCAL_CLONE_DIR is kept between runs as a bare `--mirror` cache: when it already mirrors `gl_repo` only an
+    incremental `git fetch --prune` is done. A fresh clone is made when the folder is missing, is not a mirror
+    of this project (e.g. a working-tree clone from an older version) or turns out to be corrupt.
 
+    With a `clone_filter` ('blob:none' or 'tree:0') the mirror is a partial clone: GitLab stays its promisor remote, and
+    the objects left out are fetched on demand, e.g. by a push that needs them. A full mirror also serves a
+    filtered request; a partial one is re-cloned when a full mirror is wanted.
+    """
+    scheme, rest = gl_repo.split('://', 1)
+    clone_url = f"{scheme}://oauth2:{GITLAB_TOKEN}@{rest}"
+    if _is_mirror_of(clone_url, partial_ok=clone_filter is not None):
+        log.info(f"Updating GitLab mirror cache in '{LOCAL_CLONE_DIR}' folder ...")
+        try:
+            metrics.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "set-url", "origin", clone_url], check=True)
+            metrics.run(["git", "-C", LOCAL_CLONE_DIR, "fetch", "--prune", "origin"], check=True)
+            refs.forget(LOCAL_CLONE_DIR)
+            return
+        except subprocess.CalledProcessError as e:
+            fsck = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "fsck", "--connectivity-only", "--no-dangling"],
+                               check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            if fsck.returncode == 0:
+                log.error(f"GitLab fetch failed: {e}")
+                sys.exit(1)
+            log.warning(f"Mirror cache '{LOCAL_CLONE_DIR}' is corrupt; re-cloning from scratch")
 
-def clone_repo(gl_repo):
     log.info(f"Cloning GitLab repository into '{LOCAL_CLONE_DIR}' folder ...")
     if os.path.exists(LOCAL_CLONE_DIR):
         try:
@@ -27,56 +70,198 @@ def clone_repo(gl_repo):
             log.error(f"Failed to remove existing '{LOCAL_CLONE_DIR}' folder: {e}")
             sys.exit(1)
     try:
-        subprocess.run(["git", "clone", f"https://oauth2:{GITLAB_TOKEN}@{gl_repo.split('https://')[1]}", LOCAL_CLONE_DIR], check=True)
+        metrics.run(["git", "clone", "--mirror"] + ([f"--filter={clone_filter}"] if clone_filter else [])
+                    + [clone_url, LOCAL_CLONE_DIR], check=True)
     except subprocess.CalledProcessError as e:
         log.error(f"GitLab clone failed: {e}")
         sys.exit(1)
+    finally:
+        refs.forget(LOCAL_CLONE_DIR)
+
+
+def _is_mirror_of(clone_url, partial_ok=False):
+    """Return True if LOCAL_CLONE_DIR is a usable bare mirror whose origin is `clone_url` (credentials ignored).
+    A partial clone only counts with `partial_ok`.
+    """
+    if not os.path.isdir(LOCAL_CLONE_DIR):
+        return False
+    bare = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "rev-parse", "--is-bare-repository"],
+                       check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if bare.returncode != 0 or bare.stdout.strip() != 'true':
+        return False
+    mirror = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "config", "--get", "remote.origin.mirror"],
+                         check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    origin = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "config", "--get", "remote.origin.url"],
+                         check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if mirror.stdout.strip() != 'true' or origin.returncode != 0:
+        return False
+    if not partial_ok and _is_partial_clone():
+        log.info(f"Mirror cache '{LOCAL_CLONE_DIR}' is a partial clone; re-cloning it in full")
+        return False
+    return _strip_credentials(origin.stdout.strip()) == _strip_credentials(clone_url)
+
+
+def _is_partial_clone():
+    promisor = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "config", "--get", "remote.origin.promisor"],
+                           check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return promisor.stdout.strip() == 'true'
+
+
+def _strip_credentials(url):
+    p = urllib.parse.urlsplit(url)
+    return p._replace(netloc=p.netloc.rsplit('@', 1)[-1]).geturl()
 
 
 def get_mr(gl_repo, mr_url):
     """Fetch a single Merge Request by project (url/path or id) and MR URL. Returns dict or None."""
-    project_id = _parse_pid(gl_repo)
-    gl_host = _parse_host(gl_repo)
     iid = _parse_iid(mr_url)
     if not iid:
         log.error(f"Failed to parse IID from MR URL `{mr_url}`")
         return None
-    path = f"/projects/{project_id}/merge_requests/{iid}"
-    code, body = _api_request(path, gl_host)
+    return get_mr_by_iid(gl_repo, iid)
+
+
+def get_mr_by_iid(gl_repo, iid):
+    """Fetch a single Merge Request by project (url/path or id) and IID. Returns dict or None."""
+    path = f"/projects/{_parse_pid(gl_repo)}/merge_requests/{iid}"
+    code, body = _api_request(path, _parse_host(gl_repo))
     if code == 200:
         return body
-    log.error(f"Failed to fetch Merge Request `{mr_url}` from GitLab project {gl_repo}: status={code} body={body}")
+    log.error(f"Failed to fetch Merge Request !{iid} from GitLab project {gl_repo}: status={code} body={body}")
+    return None
+
+
+def iter_mr_discussions(gl_repo, iid, per_page=100):
+    """Yield the discussions of a Merge Request, oldest first, each with its `notes`.
+
+    Pages are requested one at a time as the caller consumes them, so only one page is held in memory.
+    Raises RuntimeError if a page cannot be fetched, since the caller would otherwise miss the rest silently.
+    """
+    gl_host = _parse_host(gl_repo)
+    next_path = f"/projects/{_parse_pid(gl_repo)}/merge_requests/{iid}/discussions?per_page={per_page}"
+    while next_path:
+        code, body, headers = _api_call(next_path, gl_host)
+        if code != 200 or not isinstance(body, list):
+            raise RuntimeError(f"Failed to list discussions of MR !{iid} at `{next_path}`: status={code} body={body}")
+        yield from body
+        next_path = _next_page_path(headers, gl_host)
+
+
+def get_mr_approvals(gl_repo, iid):
+    """Return the users who approved a Merge Request (list of user dicts), or None on failure."""
+    path = f"/projects/{_parse_pid(gl_repo)}/merge_requests/{iid}/approvals"
+    code, body = _api_request(path, _parse_host(gl_repo))
+    if code == 200 and isinstance(body, dict):
+        return [approval.get('user') or {} for approval in body.get('approved_by') or []]
+    log.error(f"Failed to fetch approvals of MR !{iid} from GitLab project {gl_repo}: status={code} body={body}")
     return None
 
 
-def list_mrs(gl_repo, state='opened'):
-    """List merge requests for a project. Returns list of MR dicts (may be empty)."""
+def iter_mrs(gl_repo, state='opened', per_page=100, workers=4, updated_after=None):
+    """Yield every merge request of a project, following GitLab pagination.
+    With `updated_after` (ISO 8601), only MRs updated since then are listed.
+
+    The first page tells us X-Total-Pages; the remaining pages are then fetched concurrently and their MRs
+    are yielded as soon as each page arrives (so not in page order). GitLab omits the totals for very large
+    result sets (over 10,000 rows), in which case the `Link: rel="next"` header is followed page by page.
+    Raises RuntimeError if a page cannot be fetched, so callers never act on a silently truncated listing.
+    """
+    path, gl_host = _mrs_path(gl_repo, state, per_page, updated_after)
+    code, body, headers = _api_call(f"{path}&page=1", gl_host)
+    yield from _mrs_page(gl_repo, f"{path}&page=1", code, body)
+
+    pages = _numbered_pages(path, headers)
+    if pages is not None:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_api_request, page, gl_host): page for page in pages}
+            for future in as_completed(futures):
+                yield from _mrs_page(gl_repo, futures[future], *future.result())
+        return
+
+    next_path = _next_page_path(headers, gl_host)
+    while next_path:
+        code, body, headers = _api_call(next_path, gl_host)
+        yield from _mrs_page(gl_repo, next_path, code, body)
+        next_path = _next_page_path(headers, gl_host)
+
+
+async def iter_mrs_async(gl_repo, state='opened', per_page=100, updated_after=None):
+    """asyncio twin of iter_mrs: an async generator yielding MRs as their pages arrive. Only the requests differ."""
+    path, gl_host = _mrs_path(gl_repo, state, per_page, updated_after)
+    code, body, headers = await _api_call_async(f"{path}&page=1", gl_host)
+    for mr in _mrs_page(gl_repo, f"{path}&page=1", code, body):
+        yield mr
+
+    pages = _numbered_pages(path, headers)
+    if pages is not None:
+        requests = [asyncio.ensure_future(_page_async(page, gl_host)) for page in pages]
+        try:
+            for request in asyncio.as_completed(requests):
+                page, (code, body, _) = await request
+                for mr in _mrs_page(gl_repo, page, code, body):
+                    yield mr
+        finally:
+            for request in requests:
+                request.cancel()
+        return
+
+    next_path = _next_page_path(headers, gl_host)
+    while next_path:
+        code, body, headers = await _api_call_async(next_path, gl_host)
+        for mr in _mrs_page(gl_repo, next_path, code, body):
+            yield mr
+        next_path = _next_page_path(headers, gl_host)
+
+
+async def _page_async(path, gl_host):
+    return path, await _api_call_async(path, gl_host)
+
+
+def _numbered_pages(path, headers):
+    """Return the paths of pages 2.. of a listing whose first page answered with `headers`, or None when GitLab
+    left out X-Total-Pages and the `next` links must be followed instead.
+    """
+    total_pages = headers.get('X-Total-Pages', '')
+    if not total_pages.isdigit():
+        return None
+    return [f"{path}&page={page}" for page in range(2, int(total_pages) + 1)]
+
+
+def _mrs_page(gl_repo, path, code, body):
+    """Return the MRs of a listing page, or raise RuntimeError if the page failed."""
+    if code != 200 or not isinstance(body, list):
+        raise RuntimeError(f"Failed to list Merge Requests for project {gl_repo} at `{path}`: status={code} body={body}")
+    return body
+
+
+def _mrs_path(gl_repo, state, per_page, updated_after):
+    """Return (API path without page, GitLab host) for listing the MRs of a project."""
     project_id = _parse_pid(gl_repo)
     gl_host = _parse_host(gl_repo)
-    path = f"/projects/{project_id}/merge_requests?state={state}&per_page=99"
-    code, body = _api_request(path, gl_host)
-    if code == 200 and isinstance(body, list):
-        return body
-    log.error(f"Failed to list Merge Requests for project {gl_repo}: status={code} body={body}")
-    return []
+    path = f"/projects/{project_id}/merge_requests?state={state}&per_page={per_page}"
+    if updated_after:
+        path += f"&updated_after={urllib.parse.quote(updated_after)}"
+    return path, gl_host
 
 
 def ensure_local_branch(branch, web_url):
     """Ensure that the given branch exists in the local clone; if not, create it from remote."""
 
     if not os.path.isdir(LOCAL_CLONE_DIR):
-        log.error(f"Local clone directory '{LOCAL_CLONE_DIR}' not found; cannot push branch '{branch}'.")
+        log.error(f"Local clone directory '{LOCAL_CLONE_DIR}' not found; cannot push branch '{branch}'. "
+                  "Run `clone` first, or sync with --clone-filter.")
         return False
 
     try:
-        deleted = _delete_local_branch(branch)
-        if not deleted:
-            log.error(f"Failed to delete existing local branch `{branch}` before recreating.")
-            return False
+        with CLONE_LOCK:
+            deleted = _delete_local_branch(branch)
+            if not deleted:
+                log.error(f"Failed to delete existing local branch `{branch}` before recreating.")
+                return False
 
-        created = _ensure_local_branch_from_remote(branch, web_url)
-        if not created:
-            return False
+            created = _ensure_local_branch_from_remote(branch, web_url)
+            if not created:
+                return False
     except Exception as e:
         log.error(f"Failed to verify local branch '{branch}': {e}")
         return False
@@ -84,29 +269,137 @@ def ensure_local_branch(branch, web_url):
     return True
 
 
+def ensure_local_branches(mrs):
+    """Create or reset the local source branch of every MR in one batch. Returns the set of MR IIDs that are ready.
+    See ensure_local_branches_steps.
+    """
+    with CLONE_LOCK:
+        return steps.run(ensure_local_branches_steps(mrs))
+
+
+def ensure_local_branches_steps(mrs):
+    """Steps (see steps.py) of ensure_local_branches.
+
+    All MR heads of a project are fetched with a single `git fetch` of GitLab's `refs/merge-requests/<iid>/head`
+    refs (these also exist for MRs opened from forks), then every `refs/heads/<source_branch>` is written with one
+    `git update-ref --stdin`. If a batched fetch fails, its MRs are retried one by one so a single broken MR
+    does not fail the others. Callers must not run batches that share a source branch concurrently.
+    """
+    if not os.path.isdir(LOCAL_CLONE_DIR):
+        log.error(f"Local clone directory '{LOCAL_CLONE_DIR}' not found; cannot create MR branches. "
+                  "Run `clone` first, or sync with --clone-filter.")
+        return set()
+
+    ready = set()
+    for remote_url, batch in _plan_mr_fetches(mrs):
+        code, _, err = yield _fetch_mr_heads(remote_url, batch)
+        if code == 0:
+            fetched = batch
+        else:
+            log.warning(f"Batched fetch of {len(batch)} MR heads failed; retrying them one by one: {err.strip()}")
+            fetched = []
+            for mr in batch:
+                code, _, err = yield _fetch_mr_heads(remote_url, [mr])
+                if code == 0:
+                    fetched.append(mr)
+                else:
+                    log.error(f"Failed to fetch MR head !{mr.get('iid')}: {err.strip()}")
+        ready.update((yield from _update_mr_branches(fetched)))
+    return ready
+
+
+def _plan_mr_fetches(mrs):
+    """Group MRs by project clone URL into fetch batches of FETCH_BATCH_SIZE. Returns [(remote_url, [mr, ...]), ...].
+    MRs whose source branch cannot be created safely are reported and left out.
+    """
+    by_project = {}
+    claimed = {}
+    for mr in mrs:
+        iid, branch = mr.get('iid'), mr.get('source_branch')
+        remote_url = _project_git_url(mr.get('web_url') or '')
+        if not remote_url or not branch:
+            log.error(f"Cannot locate the source project or branch of MR !{iid} ('{mr.get('web_url')}')")
+            continue
+        if branch in claimed:
+            log.error(f"Source branch '{branch}' of MR !{iid} is also the source of MR !{claimed[branch]}; skipping MR !{iid}.")
+            continue
+        if mr.get('source_project_id') != mr.get('project_id') and branch == mr.get('target_branch'):
+            log.error(f"MR !{iid} comes from a fork branch named like its target '{branch}'; skipping it to protect the target branch.")
+            continue
+        claimed[branch] = iid
+        by_project.setdefault(remote_url, []).append(mr)
+    return [(remote_url, project_mrs[i:i + FETCH_BATCH_SIZE])
+            for remote_url, project_mrs in by_project.items()
+            for i in range(0, len(project_mrs), FETCH_BATCH_SIZE)]
+
+
+def _fetch_mr_heads(remote_url, mrs):
+    """Call fetching `refs/merge-requests/<iid>/head` of the given MRs into the same local refs."""
+    refspecs = [f"+{_mr_head_ref(mr)}:{_mr_head_ref(mr)}" for mr in mrs]
+    return steps.git(LOCAL_CLONE_DIR, "fetch", "--no-tags", "--refmap=", remote_url, *refspecs)
+
+
+def _update_mr_branches(mrs):
+    """Steps pointing refs/heads/<source_branch> at each fetched MR head in one update-ref transaction.
+    Returns the ready IIDs.
+    """
+    if not mrs:
+        return set()
+    commands, ready, updates = yield steps.call(_mr_branch_updates, None, mrs)
+    if commands:
+        code, _, err = yield steps.git(LOCAL_CLONE_DIR, "update-ref", "--stdin", input=commands)
+        if code != 0:
+            log.error(f"Failed to update local MR branches: {err.strip()}")
+            return set()
+        _record_ref_updates(updates)
+    log.info(f"Prepared local branches for {len(ready)} merge requests")
+    return ready
+
+
+def _mr_branch_updates(mrs):
+    """Build `update-ref --stdin` commands pointing the source branch of each fetched MR at its head, leaving out
+    branches that are already there. Heads are resolved through the clone's ref index, without a git process per
+    batch. Returns (commands, ready IIDs, {branch ref: sha}).
+    """
+    index = refs.index_for(LOCAL_CLONE_DIR)
+    updates = {}
+    ready = set()
+    for mr in mrs:
+        sha = index.resolve(_mr_head_ref(mr))
+        if not sha:
+            log.error(f"MR !{mr.get('iid')} head ref is missing after fetch.")
+            continue
+        branch_ref = f"refs/heads/{mr.get('source_branch')}"
+        if index.sha(branch_ref) != sha:
+            updates[branch_ref] = sha
+        ready.add(mr.get('iid'))
+    return ''.join(f"update {ref} {sha}\n" for ref, sha in updates.items()), ready, updates
+
+
+def _record_ref_updates(updates):
+    index = refs.index_for(LOCAL_CLONE_DIR)
+    for ref, sha in updates.items():
+        index.updated(ref, sha)
+
+
+def _mr_head_ref(mr):
+    return f"refs/merge-requests/{mr.get('iid')}/head"
+
+
 def _delete_local_branch(branch):
-    """Delete local branch if it exists. Returns True if branch deleted or did not exist, False on error."""
+    """Delete local branch if it exists. Returns True if branch deleted or did not exist, False on error.
+    Only the ref is removed; HEAD and any working tree are left alone, since the sync flow only pushes refs.
+    """
     try:
-        exists = subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "rev-parse", "--verify", f"refs/heads/{branch}"],
-                                check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if exists.returncode == 0:
-            cur = subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "rev-parse", "--abbrev-ref", "HEAD"],
-                                 check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True).stdout.strip()
-            if cur == branch:
-                switched = False
-                for candidate in ("main", "master"):
-                    cand = subprocess.run(
-                        ["git", "-C", LOCAL_CLONE_DIR, "rev-parse", "--verify", f"refs/heads/{candidate}"],
-                        check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-                    if cand.returncode == 0:
-                        subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "checkout", candidate], check=False)
-                        switched = True
-                        break
-                if not switched:
-                    tmp_branch = f"tmp_switch_{uuid.uuid4().hex[:8]}"
-                    subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "checkout", "-b", tmp_branch], check=False)
-            subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "branch", "-D", branch], check=False)
-            log.info(f"Deleted local branch '{branch}'")
+        index = refs.index_for(LOCAL_CLONE_DIR)
+        if not index.exists(f"refs/heads/{branch}"):
+            return True
+        result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "update-ref", "-d", f"refs/heads/{branch}"],
+                             check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode != 0:
+            log.warning(f"Failed to delete local branch '{branch}': {result.stderr.strip()}")
+            return False
+        index.updated(f"refs/heads/{branch}", None)
         return True
     except Exception as e:
         log.warning(f"Failed to delete local branch '{branch}': {e}")
@@ -114,61 +407,88 @@ def _delete_local_branch(branch):
 
 
 def _ensure_local_branch_from_remote(branch, web_url):
-    """Try to create a local branch by fetching from a remote. Returns True if branch created, False otherwise."""
+    """Try to create a local branch by fetching it from the MR's project straight into refs/heads.
+    Returns True if branch created, False otherwise.
+    """
     try:
         if not web_url:
             log.error("Branch not found on origin and no web_url provided to locate source project.")
             return False
 
-        p = urllib.parse.urlparse(web_url)
-        path = (p.path or '').split('/-/')[0].lstrip('/')
-        if not path:
+        remote_url = _project_git_url(web_url)
+        if not remote_url:
             log.error(f"Failed to parse project path from web_url '{web_url}'")
             return False
 
-        host = _parse_host(web_url)
-        host_netloc = urllib.parse.urlparse(host).netloc
-        remote_repo_path = path
-
-        if GITLAB_TOKEN:
-            remote_url = f"https://oauth2:{GITLAB_TOKEN}@{host_netloc}/{remote_repo_path}.git"
+        # Fetch by URL into the local branch: no temporary remote and no checkout. The empty --refmap skips
+        # remote-tracking refs, and --update-head-ok allows updating the branch HEAD points at in a working clone.
+        result = metrics.run(["git", "-C", LOCAL_CLONE_DIR, "fetch", "--no-tags", "--refmap=", "--update-head-ok",
+                                 remote_url, f"+refs/heads/{branch}:refs/heads/{branch}"],
+                             check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            refs.index_for(LOCAL_CLONE_DIR).resolve(f"refs/heads/{branch}")
+            log.info(f"Created local branch '{branch}' from {_strip_credentials(remote_url)}")
+            return True
+        if "couldn't find remote ref" in result.stderr:
+            log.error(f"Branch '{branch}' not found on origin or source remote ({_strip_credentials(remote_url)}).")
         else:
-            remote_url = f"https://{host_netloc}/{remote_repo_path}.git"
-
-        tmp_remote = f"tmp_remote_{uuid.uuid4().hex[:8]}"
-        try:
-            subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "add", tmp_remote, remote_url], check=True)
-        except subprocess.CalledProcessError as e:
-            log.error(f"Failed to add temporary remote '{tmp_remote}' -> {remote_url}: {e}")
-            return False
-
-        try:
-            ls2 = subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "ls-remote", "--heads", tmp_remote, branch],
-                                 check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if ls2.returncode == 0 and ls2.stdout.strip():
-                log.info(f"Branch '{branch}' found on remote {tmp_remote}; fetching...")
-                subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "fetch", tmp_remote, f"refs/heads/{branch}:refs/remotes/{tmp_remote}/{branch}"], check=True)
-                subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "checkout", "-b", branch, "--track", f"{tmp_remote}/{branch}"], check=True)
-                log.info(f"Created local branch '{branch}' tracking {tmp_remote}/{branch}")
-                return True
-            else:
-                log.error(f"Branch '{branch}' not found on origin or source remote ({remote_url}).")
-                return False
-        except subprocess.CalledProcessError as e:
-            log.error(f"Failed to fetch/create branch '{branch}' from remote {tmp_remote}: {e}")
-            return False
-        finally:
-            subprocess.run(["git", "-C", LOCAL_CLONE_DIR, "remote", "remove", tmp_remote], check=False)
+            log.error(f"Failed to fetch/create branch '{branch}' from {_strip_credentials(remote_url)}: {result.stderr.strip()}")
+        return False
 
     except Exception as e:
         log.error(f"Unexpected error while ensuring branch from remote: {e}")
         return False
 
 
+def _project_git_url(web_url):
+    """Return the authenticated clone URL of the project owning a MR `web_url`, or None if it cannot be parsed."""
+    p = urllib.parse.urlparse(web_url)
+    path = (p.path or '').split('/-/')[0].lstrip('/')
+    if not path:
+        return None
+
+    host = urllib.parse.urlparse(_parse_host(web_url))
+    if GITLAB_TOKEN:
+        return f"{host.scheme}://oauth2:{GITLAB_TOKEN}@{host.netloc}/{path}.git"
+    return f"{host.scheme}://{host.netloc}/{path}.git"
+
+
 def _api_request(path, gl_host, method='GET', data=None, headers=None):
     """Make a request to the GitLab REST API and return (status_code, json_body-or-None).
     path should start with '/'. Example: '/projects/:id/merge_requests'.
     """
+    code, body, _ = _api_call(path, gl_host, method=method, data=data, headers=headers)
+    return code, body
+
+
+def _api_call(path, gl_host, method='GET', data=None, headers=None):
+    """Same as _api_request but returns (status_code, json_body-or-None, response_headers).
+    Response headers are needed for pagination (X-Total-Pages, Link); they are empty on connection errors.
+    """
+    url, body, req_headers = _build_api_request(path, gl_host, data, headers)
+    try:
+        response = http_cache.request(method, url, body=body, headers=req_headers, identity=GITLAB_TOKEN or '',
+                                      tokens=TOKENS)
+        return _decode_api_response(*response)
+    except Exception as e:
+        log.error(f"GitLab API request failed: {e}")
+        return None, None, {}
+
+
+async def _api_call_async(path, gl_host, method='GET', data=None, headers=None):
+    """asyncio twin of _api_call."""
+    url, body, req_headers = _build_api_request(path, gl_host, data, headers)
+    try:
+        response = await aio_http.request(method, url, body=body, headers=req_headers, identity=GITLAB_TOKEN or '',
+                                          tokens=TOKENS)
+        return _decode_api_response(*response)
+    except Exception as e:
+        log.error(f"GitLab API request failed: {e}")
+        return None, None, {}
+
+
+def _build_api_request(path, gl_host, data, headers):
+    """Return (url, body_bytes-or-None, headers) for a GitLab REST API call."""
     url = f"{gl_host}/api/v4{path}"
     req_headers = {
         'User-Agent': 'gl2gh-automator',
@@ -176,8 +496,6 @@ def _api_request(path, gl_host, method='GET', data=None, headers=None):
     }
     if GITLAB_TOKEN:
         req_headers['Authorization'] = f'Bearer {GITLAB_TOKEN}'
-    else:
-        pass
     if headers:
         req_headers.update(headers)
     if data is not None:
@@ -185,17 +503,27 @@ def _api_request(path, gl_host, method='GET', data=None, headers=None):
         req_headers['Content-Type'] = 'application/json'
     else:
         body = None
-    req = urllib.request.Request(url, data=body, headers=req_headers, method=method)
-    try:
-        with urllib.request.urlopen(req) as resp:
-            resp_body = resp.read().decode('utf-8')
-            return resp.getcode(), json.loads(resp_body) if resp_body else None
-    except urllib.error.HTTPError as e:
-        err_body = e.read().decode('utf-8')
-        return e.code, json.loads(err_body) if err_body else None
-    except Exception as e:
-        log.error(f"GitLab API request failed: {e}")
-        return None, None
+    return url, body, req_headers
+
+
+def _decode_api_response(code, resp_headers, resp_body):
+    resp_body = resp_body.decode('utf-8')
+    return code, json.loads(resp_body) if resp_body else None, resp_headers
+
+
+def _next_page_path(headers, gl_host):
+    """Return the API path of the `rel="next"` page from a Link header, or None on the last page."""
+    for link in (headers.get('Link') or '').split(','):
+        parts = link.split(';')
+        if len(parts) < 2 or not any(p.strip() == 'rel="next"' for p in parts[1:]):
+            continue
+        url = parts[0].strip().lstrip('<').rstrip('>')
+        prefix = f"{gl_host}/api/v4"
+        if url.startswith(prefix):
+            return url[len(prefix):]
+        p = urllib.parse.urlparse(url)
+        return p.path.split('/api/v4', 1)[-1] + (f"?{p.query}" if p.query else '')
+    return None
 
 
 def _parse_pid(gl_repo):
@@ -204,7 +532,7 @@ def _parse_pid(gl_repo):
     If gl_repo looks numeric, returns it unchanged.
     """
     repo = gl_repo
-    if repo.startswith('https://'):
+    if repo.startswith(('https://', 'http://')):
         if 'gitlab.com/' in repo:
             repo = repo.split('gitlab.com/')[-1]
         else:
@@ -223,7 +551,7 @@ def _parse_host(gl_repo):
     if not repo:
         return 'https://gitlab.com'
 
-    if repo.startswith('https://'):
+    if repo.startswith(('https://', 'http://')):
         p = urllib.parse.urlparse(repo)
         scheme = p.scheme or 'https'
         netloc = p.netloc
@@ -0,0 +1,159 @@
+import email.message
+import hashlib
+import json
+import logging as log
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import metrics
+import ratelimit
+
+
+CACHE_DIR = os.getenv('GL2GH_CACHE_DIR')
+CACHE_MAX_BYTES = int(os.getenv('GL2GH_CACHE_MAX_MB', '256')) * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    headers TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+_conn = None
+_lock = threading.Lock()
+
+
+def request(method, url, body=None, headers=None, identity='', tokens=None):
+    """Send an API request, revalidating GET responses against the on-disk cache; same contract as ratelimit.request.
+
+    Cached 200 responses carrying an ETag or Last-Modified are replayed with If-None-Match / If-Modified-Since, and a
+    304 is answered from the cache (GitHub does not count conditional 304s against the rate limit). `identity` is the
+    credential the request is made with: entries are keyed by URL and a hash of it, so tokens never share responses
+    and are never written to disk. Without GL2GH_CACHE_DIR the cache is disabled. `tokens` is passed on to
+    ratelimit.request.
+    """
+    with api_span(method, url) as span:
+        key, cached, req_headers = prepare(method, url, headers, identity)
+        status, resp_headers, resp_body = ratelimit.request(method, url, body=body, headers=req_headers,
+                                                            tokens=tokens)
+        record_response(span, url, body, status, resp_body)
+        return complete(key, cached, status, resp_headers, resp_body)
+
+
+def api_span(method, url):
+    """Return the metrics span an API request is timed under (also used by aio_http)."""
+    if not metrics.ENABLED:
+        return metrics.span('api', method)
+    p = urllib.parse.urlsplit(url)
+    return metrics.span('api', f"{method} {p.path}", host=p.netloc, method=method)
+
+
+def record_response(span, url, body, status, resp_body):
+    """Add the outcome of an API request to its span and the byte counters."""
+    if not metrics.ENABLED:
+        return
+    span.label(status=status)
+    span.set(url=url)
+    host = urllib.parse.urlsplit(url).netloc
+    metrics.inc('gl2gh_api_bytes_sent_total', len(body or b''), host=host)
+    metrics.inc('gl2gh_api_bytes_received_total', len(resp_body), host=host)
+
+
+def prepare(method, url, headers, identity):
+    """Look up a request in the cache. Returns (key, cached_entry, request_headers); key is None when not cacheable.
+    The returned headers carry the conditional-request validators of the cached entry.
+    """
+    if method != 'GET' or not CACHE_DIR:
+        return None, None, headers
+
+    key = hashlib.sha256(f"{hashlib.sha256(identity.encode()).hexdigest()} {url}".encode()).hexdigest()
+    cached = _lookup(key)
+    req_headers = dict(headers or {})
+    if cached:
+        if cached['etag']:
+            req_headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            req_headers['If-Modified-Since'] = cached['last_modified']
+    return key, cached, req_headers
+
+
+def complete(key, cached, status, resp_headers, resp_body):
+    """Store a fresh response or answer a 304 from the cached entry. Returns (status, headers, body) for the caller."""
+    if key is None:
+        return status, resp_headers, resp_body
+    if status == 304 and cached:
+        _touch(key)
+        # A 304 may omit entity headers such as Link, so the stored ones are replayed with the fresh ones on top.
+        merged = email.message.Message()
+        fresh = {name.lower() for name in resp_headers.keys()}
+        for name, value in cached['headers']:
+            if name.lower() not in fresh:
+                merged[name] = value
+        for name, value in resp_headers.items():
+            merged[name] = value
+        return 200, merged, cached['body']
+    if status == 200 and (resp_headers.get('ETag') or resp_headers.get('Last-Modified')):
+        _store(key, resp_headers, resp_body)
+    return status, resp_headers, resp_body
+
+
+def _connection():
+    global _conn
+    if _conn is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _conn = sqlite3.connect(os.path.join(CACHE_DIR, 'responses.sqlite3'), timeout=30, check_same_thread=False)
+        _conn.executescript(SCHEMA)
+    return _conn
+
+
+def _lookup(key):
+    try:
+        with _lock:
+            row = _connection().execute(
+                "SELECT etag, last_modified, headers, body FROM responses WHERE key = ?", (key,)).fetchone()
+    except sqlite3.Error as e:
+        log.warning(f"Response cache lookup failed: {e}")
+        return None
+    if not row:
+        return None
+    return {'etag': row[0], 'last_modified': row[1], 'headers': json.loads(row[2]), 'body': row[3]}
+
+
+def _touch(key):
+    try:
+        with _lock, _connection() as conn:
+            conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+    except sqlite3.Error as e:
+        log.warning(f"Response cache update failed: {e}")
+
+
+def _store(key, headers, body):
+    """Insert or replace a response, then evict least recently used entries beyond CACHE_MAX_BYTES."""
+    if len(body) > CACHE_MAX_BYTES:
+        return
+    try:
+        with _lock, _connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, etag, last_modified, headers, body, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, headers.get('ETag'), headers.get('Last-Modified'), json.dumps(list(headers.items())),
+                 body, len(body), time.time()))
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total <= CACHE_MAX_BYTES:
+                return
+            for evict_key, size in conn.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall():
+                conn.execute("DELETE FROM responses WHERE key = ?", (evict_key,))
+                total -= size
+                if total <= CACHE_MAX_BYTES:
+                    break
+    except sqlite3.Error as e:
+        log.warning(f"Response cache store failed: {e}")
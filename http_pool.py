@@ -0,0 +1,163 @@
+import gzip
+import http.client
+import logging as log
+import select
+import threading
+import urllib.parse
+import urllib.request
+import zlib
+
+
+MAX_IDLE_PER_HOST = 16
+MAX_REDIRECTS = 5
+TIMEOUT = 60
+# Methods a server may safely receive twice; only these are resent when a connection drops after the request was
+# written, because the server may have processed it.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def request(method, url, body=None, headers=None):
+    """Send an HTTP request over a pooled keep-alive connection and return (status, headers, body_bytes).
+
+    HTTP error statuses are returned, not raised; connection failures raise (OSError / http.client.HTTPException).
+    gzip/deflate responses are decoded transparently. GET/HEAD redirects are followed.
+    Safe to call from any number of threads.
+    """
+    req_headers = {'Accept-Encoding': 'gzip, deflate'}
+    if headers:
+        req_headers.update(headers)
+    for _ in range(MAX_REDIRECTS + 1):
+        status, resp_headers, resp_body = _pool_for(url).request(method, url, body, req_headers)
+        location = resp_headers.get('Location')
+        if status in (301, 302, 303, 307, 308) and location and method in ('GET', 'HEAD'):
+            url = urllib.parse.urljoin(url, location)
+            continue
+        return status, resp_headers, resp_body
+    raise http.client.HTTPException(f"Too many redirects for {method} {url}")
+
+
+def close_all():
+    """Close every idle pooled connection (e.g. before exiting or after forking)."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+def _pool_for(url):
+    p = urllib.parse.urlsplit(url)
+    key = (p.scheme, p.netloc)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = _HostPool(p.scheme, p.netloc)
+        return pool
+
+
+class _HostPool:
+    """Idle keep-alive connections to one scheme://host:port."""
+
+    def __init__(self, scheme, netloc):
+        self.scheme = scheme
+        self.netloc = netloc
+        self._idle = []
+        self._lock = threading.Lock()
+        self._proxy = _proxy_for(scheme, netloc)
+
+    def request(self, method, url, body, headers):
+        p = urllib.parse.urlsplit(url)
+        target = p.path or '/'
+        if p.query:
+            target += f"?{p.query}"
+        if self._proxy and self.scheme == 'http':
+            target = url
+
+        conn, reused = self._acquire()
+        written = False
+        try:
+            conn.request(method, target, body=body, headers=headers)
+            written = True
+            return self._receive(conn)
+        except (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if not reused or (written and method not in IDEMPOTENT_METHODS):
+                raise
+            # The server dropped an idle keep-alive connection; retry once on a fresh one.
+            log.debug(f"Stale keep-alive connection to {self.netloc}; reconnecting")
+            conn = self._connect()
+            try:
+                conn.request(method, target, body=body, headers=headers)
+                return self._receive(conn)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def _receive(self, conn):
+        resp = conn.getresponse()
+        data = decode_body(resp.read(), resp.getheader('Content-Encoding'))
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return resp.status, resp.msg, data
+
+    def _acquire(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn = self._idle.pop()
+            if conn.sock is not None and not select.select([conn.sock], [], [], 0)[0]:
+                return conn, True
+            # Readable while idle: the server closed it (or sent something unasked). Not worth a stale-retry.
+            conn.close()
+        return self._connect(), False
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < MAX_IDLE_PER_HOST:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+        if not self._proxy:
+            return cls(self.netloc, timeout=TIMEOUT)
+        proxy = urllib.parse.urlsplit(self._proxy)
+        if self.scheme == 'https':
+            conn = cls(proxy.netloc, timeout=TIMEOUT)
+            conn.set_tunnel(self.netloc)
+            return conn
+        return http.client.HTTPConnection(proxy.netloc, timeout=TIMEOUT)
+
+
+def _proxy_for(scheme, netloc):
+    """Honour http(s)_proxy / no_proxy the same way urllib.request.urlopen does."""
+    host = netloc.rsplit('@', 1)[-1]
+    if urllib.request.proxy_bypass(host.split(':', 1)[0]):
+        return None
+    return urllib.request.getproxies().get(scheme)
+
+
+def decode_body(data, encoding):
+    """Undo a gzip/deflate Content-Encoding."""
+    encoding = (encoding or '').strip().lower()
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    if encoding == 'deflate':
+        return zlib.decompress(data)
+    return data
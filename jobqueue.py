@@ -0,0 +1,189 @@
+import contextlib
+import json
+import logging as log
+import sqlite3
+import threading
+import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    gitlab_repo TEXT NOT NULL,
+    github_repo TEXT NOT NULL,
+    iid INTEGER NOT NULL DEFAULT 0,
+    after INTEGER,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    updated_at REAL NOT NULL,
+    UNIQUE (kind, gitlab_repo, github_repo, iid)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id);
+"""
+# Job kinds: mirror a project, list its open MRs (enqueueing one `mr` job each), relay one MR.
+KINDS = ('clone', 'list', 'mr')
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def open_queue(spec):
+    """Open the job queue named by `spec`: a SQLite file path, or a `sqlite:///path` URL. Other backends can be
+    added here as long as they provide JobQueue's methods. Raises ValueError for an unknown scheme.
+    """
+    scheme, sep, rest = spec.partition('://')
+    if not sep:
+        return JobQueue(spec)
+    if scheme == 'sqlite':
+        return JobQueue(rest[1:] if rest.startswith('/') else rest)
+    raise ValueError(f"Unsupported queue backend '{scheme}'")
+
+
+class JobQueue:
+    """Migration jobs in a SQLite file that any number of `worker` processes, on one machine or on several sharing
+    the file, claim from.
+
+    A claimed job is leased to its worker until `lease_expires`. The worker keeps renewing the lease while it runs
+    the job. A job whose lease ran out is claimed again by the next worker, up to `max_attempts` times in all.
+    Every change is made in an immediate transaction, so two workers never claim the same job. The file needs
+    working POSIX locks, which some network filesystems do not provide.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(SCHEMA)
+
+    def add(self, kind, gitlab_repo, github_repo, iid=0, after=None, max_attempts=3):
+        """Queue a job and return its id. A job that already finished (done or failed) is queued again; one that is
+        pending or running is left alone.
+        """
+        with self._transaction() as conn:
+            self._insert(conn, [(kind, gitlab_repo, github_repo, iid, after, max_attempts)])
+            return conn.execute(
+                "SELECT id FROM jobs WHERE kind = ? AND gitlab_repo = ? AND github_repo = ? AND iid = ?",
+                (kind, gitlab_repo, github_repo, iid)).fetchone()[0]
+
+    def add_mrs(self, gitlab_repo, github_repo, iids, max_attempts=3):
+        """Queue an `mr` job for each of `iids` in one transaction, as `add` does."""
+        with self._transaction() as conn:
+            self._insert(conn, [('mr', gitlab_repo, github_repo, iid, None, max_attempts) for iid in iids])
+
+    def claim(self, owner, lease, limit=1):
+        """Lease the oldest claimable job to `owner` for `lease` seconds, plus up to `limit - 1` more `mr` jobs of
+        the same project when it is one. Returns the claimed jobs as dicts (an empty list when none is claimable).
+
+        A job is claimable when it is pending, or running with an expired lease, and the job it runs after is done.
+        Jobs that used up their attempts, or whose prerequisite failed, are marked failed on the way.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', updated_at = ?, "
+                "result = coalesce(result, '{\"error\": \"lease expired on the last attempt\"}') "
+                "WHERE state = 'running' AND lease_expires < ? AND attempts >= max_attempts", (now, now))
+            conn.execute(
+                "UPDATE jobs SET state = 'failed', updated_at = ?, result = '{\"error\": \"prerequisite job failed\"}' "
+                "WHERE state = 'pending' AND after IN (SELECT id FROM jobs WHERE state = 'failed')", (now,))
+            claimable = ("(state = 'pending' OR (state = 'running' AND lease_expires < ?)) "
+                         "AND (after IS NULL OR after IN (SELECT id FROM jobs WHERE state = 'done'))")
+            first = conn.execute(f"SELECT * FROM jobs WHERE {claimable} ORDER BY id LIMIT 1", (now,)).fetchone()
+            if first is None:
+                return []
+            jobs = [first]
+            if first['kind'] == 'mr' and limit > 1:
+                jobs += conn.execute(
+                    f"SELECT * FROM jobs WHERE {claimable} AND kind = 'mr' AND gitlab_repo = ? AND github_repo = ? "
+                    "AND id != ? ORDER BY id LIMIT ?",
+                    (now, first['gitlab_repo'], first['github_repo'], first['id'], limit - 1)).fetchall()
+            conn.executemany(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_owner = ?, lease_expires = ?, "
+                "updated_at = ? WHERE id = ?", [(owner, now + lease, now, job['id']) for job in jobs])
+        return [dict(job, attempts=job['attempts'] + 1) for job in jobs]
+
+    def renew(self, owner, ids, lease):
+        """Extend the leases `owner` holds on the jobs `ids`. Returns the ids whose lease it still holds."""
+        now = time.time()
+        held = set()
+        with self._transaction() as conn:
+            for job_id in ids:
+                if conn.execute("UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                                "WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                                (now + lease, now, job_id, owner)).rowcount:
+                    held.add(job_id)
+        return held
+
+    def finish(self, owner, job, ok, result=None):
+        """Record the outcome of a claimed job. A failed job is queued again until it used up its attempts.
+        Returns False if `owner` lost the lease in the meantime (the outcome is then dropped).
+        """
+        state = 'done' if ok else 'failed' if job['attempts'] >= job['max_attempts'] else 'pending'
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, lease_owner = NULL, lease_expires = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND state = 'running'",
+                (state, json.dumps(result) if result is not None else None, time.time(), job['id'], owner)).rowcount
+        if not updated:
+            log.warning(f"Lost the lease of job {job['id']} ({job['kind']} {job['gitlab_repo']} {job['iid']}); "
+                        "its outcome is dropped")
+        return bool(updated)
+
+    def counts(self):
+        """Return {state: number of jobs} for every state."""
+        with self._lock:
+            rows = self._conn.execute("SELECT state, count(*) FROM jobs GROUP BY state").fetchall()
+        return {state: 0 for state in STATES} | {row[0]: row[1] for row in rows}
+
+    @contextlib.contextmanager
+    def leased(self, owner, jobs, lease):
+        """Keep renewing `owner`'s leases on `jobs` every third of `lease` seconds while the block runs."""
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(lease / 3):
+                try:
+                    lost = {job['id'] for job in jobs} - self.renew(owner, [job['id'] for job in jobs], lease)
+                except sqlite3.Error as e:
+                    log.warning(f"Failed to renew job leases: {e}")
+                    continue
+                if lost:
+                    log.warning(f"Lost the lease of jobs {sorted(lost)}")
+
+        thread = threading.Thread(target=beat, name='lease-heartbeat', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _insert(conn, jobs):
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO jobs (kind, gitlab_repo, github_repo, iid, after, max_attempts, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (kind, gitlab_repo, github_repo, iid) DO UPDATE SET "
+            "state = 'pending', attempts = 0, after = excluded.after, max_attempts = excluded.max_attempts, "
+            "lease_owner = NULL, lease_expires = NULL, result = NULL, updated_at = excluded.updated_at "
+            "WHERE jobs.state IN ('done', 'failed')",
+            [job + (now,) for job in jobs])
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
@@ -1,13 +1,39 @@
+import aio_engine
 from args import build_args
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import discussions
+import fcntl
+import functools
 import gh
 import gl
+import jobqueue
+import json
 import logging as log
+import manifest
+import metrics
+import multiprocessing
 import os
+import planner
+import ratelimit
+import re
+import socket
+import state
+import steps
+import sys
+import time
+import urllib.parse
+import webhook
 
 
 GITLAB_TOKEN = os.getenv('GITLAB_TOKEN')
 GITHUB_TOKEN = os.getenv('GITHUB_TOKEN')
 
+# How often an idle `worker` polls the queue for jobs that became claimable.
+WORKER_POLL_SECONDS = 5
+
+# Set in `migrate` worker processes: caps the clone steps running at once across all workers.
+_clone_slots = None
+
 
 def main():
     if not GITLAB_TOKEN:
@@ -22,65 +48,526 @@ def main():
     args = build_args().parse_args()
 
     if args.command == 'clone':
-        gl.clone_repo(args.gitlab_repo)
+        if args.push_jobs < 1:
+            log.error(f"--push-jobs must be at least 1, got {args.push_jobs}")
+            return False
+        with metrics.span('phase', 'clone', phase='clone'):
+            gl.clone_repo(args.gitlab_repo)
         gh_owner, gh_repo = gh.ensure_repo(args.github_repo)
-        gh.push_repo(gh_owner, gh_repo)
+        with metrics.span('phase', 'push_repo', phase='push_repo'):
+            gh.push_repo(gh_owner, gh_repo, chunk_bytes=_chunk_bytes(args.chunk_mb), jobs=args.push_jobs)
         return True
 
     if args.command == 'sync':
-        gh_owner, gh_repo = gh.ensure_repo(args.github_repo)
+        gh_owner, gh_repo = gh.ensure_repo(args.github_repo, create=not args.plan)
+        if args.plan:
+            return planner.print_plan(args.gitlab_repo, gh_owner, gh_repo, args.mr_url, args.state_db)
+        if args.clone_filter:
+            with metrics.span('phase', 'clone', phase='clone'):
+                gl.clone_repo(args.gitlab_repo, args.clone_filter)
         if args.mr_url:
             mr = gl.get_mr(args.gitlab_repo, args.mr_url)
             if not mr:
                 log.error(f"Merge request {args.mr_url} not found.")
                 return False
+            if mr.get('state') in gl.CLOSED_MR_STATES:
+                return not planner.close_prs_of_closed_mrs(args.gitlab_repo, gh_owner, gh_repo, [mr])
+            if mr.get('state') != 'opened':
+                log.info(f"Merge request {args.mr_url} is {mr.get('state')}; nothing to sync.")
+                return True
 
             branch = mr.get('source_branch')
             web_url = mr.get('web_url')
-            created = gl.ensure_local_branch(branch, web_url)
+            with metrics.span('phase', 'fetch', phase='fetch'):
+                created = gl.ensure_local_branch(branch, web_url)
             if not created:
                 log.error(f"Failed to ensure local branch '{branch}' for MR '{args.mr_url}'")
                 return False
 
-            branch_ok = gh.push_branch_from_local(gh_owner, gh_repo, branch)
+            with metrics.span('phase', 'push', phase='push'):
+                branch_ok = gh.push_branch_from_local(gh_owner, gh_repo, branch)
             if not branch_ok:
                 log.error(f"Head branch '{branch}' is not available on GitHub for {gh_owner}/{gh_repo} and could not be pushed.")
                 return False
 
-            success = gh.sync_mr_to_pr(args.gitlab_repo, mr, gh_owner, gh_repo)
+            with metrics.span('phase', 'create_pr', phase='create_pr') as span:
+                span.set(iid=mr.get('iid'))
+                success = gh.sync_mr_to_pr(args.gitlab_repo, mr, gh_owner, gh_repo)
             if not success:
                 log.error("Failed to sync MR to PR")
                 return True
+            if args.notes and not discussions.sync_mr_notes(args.gitlab_repo, mr, gh_owner, gh_repo, success):
+                log.error("Failed to copy some comments of the MR to the PR")
+                return False
         elif args.mr_all:
-            mrs = gl.list_mrs(args.gitlab_repo)
-            failures = 0
-            for mr in mrs:
-                branch = mr.get('source_branch')
-                web_url = mr.get('web_url')
-                created = gl.ensure_local_branch(branch, web_url)
-                if not created:
-                    log.error(f"Failed to ensure local branch '{branch}' for MR '{args.mr_url}'")
-                    failures += 1
-                    continue
-
-                branch_ok = gh.push_branch_from_local(gh_owner, gh_repo, branch)
-                if not branch_ok:
-                    log.error(
-                        f"Head branch '{branch}' is not available on GitHub for {gh_owner}/{gh_repo} and could not be pushed.")
-                    failures += 1
-                    continue
-
-                success = gh.sync_mr_to_pr(args.gitlab_repo, mr, gh_owner, gh_repo)
-                if not success:
-                    failures += 1
-            if failures:
-                log.error(f"Failed to sync {failures} merge requests")
+            if args.workers < 1:
+                log.error(f"--workers must be at least 1, got {args.workers}")
                 return False
+            if args.engine == 'asyncio':
+                return aio_engine.sync_all_mrs(args.gitlab_repo, gh_owner, gh_repo, args.workers, args.state_db,
+                                               args.notes)
+            return _sync_all_mrs(args.gitlab_repo, gh_owner, gh_repo, args.workers, args.state_db, args.notes)
         return True
 
+    if args.command == 'migrate':
+        return _migrate(args)
+
+    if args.command == 'enqueue':
+        return _enqueue(args)
+
+    if args.command == 'worker':
+        return _worker(args)
+
+    if args.command == 'serve':
+        return _serve(args)
+
     log.error("Unknown command or missing subcommand")
     return False
 
 
+def _sync_all_mrs(gitlab_repo, gh_owner, gh_repo, workers, state_db=None, notes=False):
+    """Relay every open MR of `gitlab_repo` to a PR. Returns True if all of them were synced.
+
+    MR branches are checked on GitHub, fetched and pushed in batches while later pages are still being listed; PRs
+    are then created on `workers` threads, and existing PRs are only written to when the MR changed (see
+    gh.plan_pr_update); PRs of MRs closed or merged on GitLab are closed. With `state_db`, only MRs updated since the
+    last complete run are listed and MRs already relayed at their current `updated_at` are skipped. With `notes`, each worker also copies its MR's comments and
+    approvals, so PRs are commented concurrently while the comments of one PR keep their order.
+    """
+    store = state.SyncState(state_db, gitlab_repo, f"{gh_owner}/{gh_repo}") if state_db else None
+    updated_after = store.watermark() if store else None
+    started = state.listing_start()
+    failures = 0
+    skipped = 0
+    total = 0
+    closed = []
+    open_iids = set()
+    listed = True
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        listing = gl.iter_mrs(gitlab_repo, state=planner.listing_state(updated_after), updated_after=updated_after)
+        try:
+            for batch in _batched(listing, gl.FETCH_BATCH_SIZE):
+                total += len(batch)
+                closed += [mr for mr in batch if mr.get('state') in gl.CLOSED_MR_STATES]
+                batch = [mr for mr in batch if mr.get('state') == 'opened']
+                open_iids.update(mr.get('iid') for mr in batch)
+                if store:
+                    pending = [mr for mr in batch if not store.is_synced(mr)]
+                    skipped += len(batch) - len(pending)
+                    batch = pending
+                failed, todo = _prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store, keep_current=notes)
+                failures += len(failed)
+                futures += [pool.submit(_sync_mr, gitlab_repo, mr, gh_owner, gh_repo, store, pr, notes)
+                            for mr, pr in todo]
+        except RuntimeError as e:
+            # The MRs listed so far are still synced, but the run is incomplete: the watermark must not move.
+            log.error(str(e))
+            failures += 1
+            listed = False
+        for future in as_completed(futures):
+            if not future.result():
+                failures += 1
+    failures += planner.close_prs_of_closed_mrs(gitlab_repo, gh_owner, gh_repo, closed,
+                                                open_iids if listed and not updated_after else None)
+    if skipped:
+        log.info(f"Skipped {skipped} of {total} merge requests unchanged since the last sync")
+    if failures:
+        if listed:
+            log.error(f"Failed to sync {failures} of {total} merge requests")
+        else:
+            log.error(f"Could not list every merge request; {failures - 1} of the {total} listed failed to sync")
+        return False
+    # Only a complete run moves the watermark, so an interrupted run is resumed from the same listing.
+    if store:
+        store.set_watermark(started)
+    return True
+
+
+def _prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store=None, keep_current=False):
+    """Bring the GitHub head branches of a batch of MRs up to date; see planner.prepare_mr_batch."""
+    return steps.run(planner.prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store, keep_current),
+                     gl.CLONE_LOCK)
+
+
+def _sync_mr(gitlab_repo, mr, gh_owner, gh_repo, store=None, pr=None, notes=False):
+    """Open the PR for a single MR whose head branch is already on GitHub, unless its open `pr` is known, and with
+    `notes` copy the MR's comments to it. Runs on the worker pool. Returns True on success, False on failure.
+    """
+    try:
+        if pr is None:
+            with metrics.span('phase', 'create_pr', phase='create_pr') as span:
+                span.set(iid=mr.get('iid'))
+                pr = gh.sync_mr_to_pr(gitlab_repo, mr, gh_owner, gh_repo)
+        if pr is None:
+            return False
+        if notes:
+            with metrics.span('phase', 'notes', phase='notes') as span:
+                span.set(iid=mr.get('iid'))
+                if not discussions.sync_mr_notes(gitlab_repo, mr, gh_owner, gh_repo, pr, store):
+                    return False
+        if store:
+            store.record(mr, pr.get('number'))
+        return True
+    except Exception as e:
+        log.error(f"Unexpected error while syncing MR '{mr.get('web_url')}': {e}")
+        return False
+
+
+def _chunk_bytes(chunk_mb):
+    return chunk_mb * 1024 * 1024 if chunk_mb else None
+
+
+def _migrate(args):
+    """Run the manifest's clone/sync steps for every project in a pool of worker processes.
+
+    Each project gets its own directory under --work-dir holding its mirror clone, sync state DB and log, so
+    workers never share a LOCAL_CLONE_DIR. Returns True if every project succeeded.
+    """
+    for name in ('processes', 'max_clones', 'workers', 'push_jobs'):
+        if getattr(args, name) < 1:
+            log.error(f"--{name.replace('_', '-')} must be at least 1, got {getattr(args, name)}")
+            return False
+    try:
+        projects = manifest.load(args.manifest)
+    except (OSError, ValueError) as e:
+        log.error(f"Cannot read manifest: {e}")
+        return False
+    if not projects:
+        log.error(f"Manifest {args.manifest} lists no projects")
+        return False
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    ctx = multiprocessing.get_context('spawn')
+    clone_slots = ctx.BoundedSemaphore(args.max_clones)
+    api_slots = ctx.BoundedSemaphore(args.max_api_calls) if args.max_api_calls else None
+    log.info(f"Migrating {len(projects)} projects with {args.processes} processes")
+    results = []
+    with ProcessPoolExecutor(max_workers=args.processes, mp_context=ctx, initializer=_init_migrate_worker,
+                             initargs=(clone_slots, api_slots)) as pool:
+        futures = {pool.submit(_migrate_project, project, args.work_dir, args.workers, args.engine,
+                               _chunk_bytes(args.chunk_mb), args.push_jobs, args.clone_filter): project
+                   for project in projects}
+        for future in as_completed(futures):
+            project = futures[future]
+            try:
+                result = future.result()
+                metrics.merge(result.pop('metrics'))
+            except Exception as e:
+                # The worker process died (e.g. killed by the OOM killer); the project's log may tell why.
+                result = dict(project, ok=False, error=f"worker failed: {e!r}", seconds=None, log=None)
+            results.append(result)
+            if result['ok']:
+                log.info(f"{result['gitlab_repo']} -> {result['github_repo']}: done in {result['seconds']:.1f}s")
+            else:
+                log.error(f"{result['gitlab_repo']} -> {result['github_repo']}: {result['error']} (log: {result['log']})")
+
+    failed = [result for result in results if not result['ok']]
+    log.info(f"Migrated {len(results) - len(failed)} of {len(results)} projects")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(sorted(results, key=lambda r: r['github_repo'].lower()), f, indent=2)
+        log.info(f"Wrote migration report to {args.report}")
+    return not failed
+
+
+def _init_migrate_worker(clone_slots, api_slots):
+    global _clone_slots
+    _clone_slots = clone_slots
+    # The parent writes the trace and metrics files, with the data each project returns.
+    metrics.detach()
+    ratelimit.set_global_slots(api_slots)
+
+
+def _migrate_project(project, work_dir, workers, engine, chunk_bytes=None, push_jobs=1, clone_filter=None):
+    """Run the steps of one manifest entry in its own directory. Runs in a `migrate` worker process.
+    Returns the project's report entry, with the trace and metrics it recorded (metrics.take) under 'metrics'.
+    """
+    project_dir = _project_dir(work_dir, project['github_repo'])
+    os.makedirs(project_dir, exist_ok=True)
+    gl.LOCAL_CLONE_DIR = gh.LOCAL_CLONE_DIR = os.path.join(project_dir, 'repo')
+    log_path = os.path.join(project_dir, 'migrate.log')
+    log_file = open(log_path, 'a', encoding='utf-8')
+    # git writes its progress to the inherited stdout/stderr; send it to the project's log as well.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log_file.fileno(), 1)
+    os.dup2(log_file.fileno(), 2)
+    handler = log.StreamHandler(log_file)
+    handler.setFormatter(log.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    root = log.getLogger()
+    root.handlers = [handler]
+    root.setLevel(log.INFO)
+
+    started = time.monotonic()
+    error = None
+    try:
+        log.info(f"Migrating {project['gitlab_repo']} -> {project['github_repo']} ({', '.join(project['steps'])})")
+        gh_owner, gh_repo = gh.ensure_repo(project['github_repo'])
+        if 'clone' in project['steps']:
+            with _clone_slots:
+                gl.clone_repo(project['gitlab_repo'])
+                gh.push_repo(gh_owner, gh_repo, chunk_bytes=chunk_bytes, jobs=push_jobs)
+        if 'sync' in project['steps']:
+            if not os.path.isdir(gl.LOCAL_CLONE_DIR):
+                # A sync-only entry in a fresh work dir: MR heads are fetched into a clone of our own.
+                with _clone_slots:
+                    gl.clone_repo(project['gitlab_repo'], clone_filter)
+            sync_all_mrs = aio_engine.sync_all_mrs if engine == 'asyncio' else _sync_all_mrs
+            if not sync_all_mrs(project['gitlab_repo'], gh_owner, gh_repo, workers,
+                                os.path.join(project_dir, 'sync-state.sqlite3')):
+                error = "some merge requests failed to sync"
+    except SystemExit:
+        error = "a step failed"
+    except Exception as e:
+        log.exception(f"Unexpected error while migrating {project['gitlab_repo']}")
+        error = f"unexpected error: {e}"
+    finally:
+        handler.flush()
+        log_file.close()
+    return dict(project, ok=error is None, error=error, seconds=round(time.monotonic() - started, 3), log=log_path,
+                metrics=metrics.take())
+
+
+def _project_dir(work_dir, github_repo):
+    return os.path.join(work_dir, re.sub(r'[^A-Za-z0-9._-]+', '_', github_repo))
+
+
+def _enqueue(args):
+    """Queue the clone/sync steps of the manifest's projects (or of one project) for `worker` processes.
+
+    A `clone` step becomes a clone job. A `sync` step becomes a list job, run after the clone job when there is
+    one, which queues an `mr` job per open MR when a worker runs it.
+    """
+    if args.max_attempts < 1:
+        log.error(f"--max-attempts must be at least 1, got {args.max_attempts}")
+        return False
+    if args.manifest:
+        try:
+            projects = manifest.load(args.manifest)
+        except (OSError, ValueError) as e:
+            log.error(f"Cannot read manifest: {e}")
+            return False
+    elif args.gitlab_repo and args.github_repo:
+        projects = [{'gitlab_repo': args.gitlab_repo, 'github_repo': args.github_repo, 'steps': args.steps}]
+    else:
+        log.error("Pass --manifest, or both --gitlab-repo and --github-repo")
+        return False
+    try:
+        queue = jobqueue.open_queue(args.queue)
+    except ValueError as e:
+        log.error(str(e))
+        return False
+    for project in projects:
+        clone = None
+        if 'clone' in project['steps']:
+            clone = queue.add('clone', project['gitlab_repo'], project['github_repo'], max_attempts=args.max_attempts)
+        if 'sync' in project['steps']:
+            queue.add('list', project['gitlab_repo'], project['github_repo'], after=clone,
+                      max_attempts=args.max_attempts)
+    log.info(f"Queued {len(projects)} projects in {args.queue}: {queue.counts()}")
+    queue.close()
+    return True
+
+
+def _worker(args):
+    """Claim and run jobs from the queue until none is pending or running. Returns False if any job failed.
+
+    Jobs are leased for --lease seconds and the lease is renewed while they run, so the jobs of a worker that died
+    are claimed again by another one once its lease expired. `mr` jobs are claimed up to --batch at a time from one
+    project and synced like a batch of `sync --mr-all`. Each worker keeps its own clones under --work-dir.
+    """
+    for name in ('lease', 'batch', 'workers', 'push_jobs'):
+        if getattr(args, name) < 1:
+            log.error(f"--{name.replace('_', '-')} must be at least 1, got {getattr(args, name)}")
+            return False
+    try:
+        queue = jobqueue.open_queue(args.queue)
+    except ValueError as e:
+        log.error(str(e))
+        return False
+    os.makedirs(args.work_dir, exist_ok=True)
+    lock_file = open(os.path.join(args.work_dir, '.lock'), 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        log.error(f"Another worker is using --work-dir {args.work_dir}; give each worker its own")
+        return False
+
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    log.info(f"Worker {owner} polling {args.queue}")
+    while True:
+        jobs = queue.claim(owner, args.lease, limit=args.batch)
+        if not jobs:
+            counts = queue.counts()
+            if not counts['pending'] and not counts['running']:
+                break
+            # Jobs wait for their prerequisite, or are leased to other workers that may still die.
+            time.sleep(WORKER_POLL_SECONDS)
+            continue
+        started = time.monotonic()
+        with queue.leased(owner, jobs, args.lease):
+            errors = _run_jobs(queue, jobs, args)
+        seconds = round(time.monotonic() - started, 3)
+        for job in jobs:
+            error = errors.get(job['id'])
+            queue.finish(owner, job, error is None, {'ok': error is None, 'error': error, 'seconds': seconds,
+                                                     'worker': owner})
+            if error:
+                log.error(f"{job['kind']} job {job['id']} ({job['gitlab_repo']} {job['iid'] or ''}) failed on "
+                          f"attempt {job['attempts']} of {job['max_attempts']}: {error}")
+    log.info(f"Queue drained: {counts}")
+    queue.close()
+    lock_file.close()
+    return not counts['failed']
+
+
+def _run_jobs(queue, jobs, args):
+    """Run claimed jobs, all of one kind and project. Returns {job id: error} for the jobs that failed."""
+    job = jobs[0]
+    project_dir = _project_dir(args.work_dir, job['github_repo'])
+    os.makedirs(project_dir, exist_ok=True)
+    gl.LOCAL_CLONE_DIR = gh.LOCAL_CLONE_DIR = os.path.join(project_dir, 'repo')
+    try:
+        gh_owner, gh_repo = gh.ensure_repo(job['github_repo'])
+        if job['kind'] == 'clone':
+            with metrics.span('phase', 'clone', phase='clone'):
+                gl.clone_repo(job['gitlab_repo'])
+            with metrics.span('phase', 'push_repo', phase='push_repo'):
+                gh.push_repo(gh_owner, gh_repo, chunk_bytes=_chunk_bytes(args.chunk_mb), jobs=args.push_jobs)
+            return {}
+        if job['kind'] == 'list':
+            return _run_list_job(queue, job, gh_owner, gh_repo)
+        return _run_mr_jobs(jobs, project_dir, gh_owner, gh_repo, args)
+    except SystemExit:
+        error = "a step failed"
+    except Exception as e:
+        log.exception(f"Unexpected error while running {job['kind']} jobs of {job['gitlab_repo']}")
+        error = f"unexpected error: {e}"
+    return {job['id']: error for job in jobs}
+
+
+def _run_list_job(queue, job, gh_owner, gh_repo):
+    """Queue an `mr` job for every open MR of the project, and close the PRs of MRs no longer open."""
+    open_iids = set()
+    try:
+        for batch in _batched(gl.iter_mrs(job['gitlab_repo'], state='opened'), gl.FETCH_BATCH_SIZE):
+            iids = [mr.get('iid') for mr in batch]
+            queue.add_mrs(job['gitlab_repo'], job['github_repo'], iids, max_attempts=job['max_attempts'])
+            open_iids.update(iids)
+    except RuntimeError as e:
+        # The MRs queued so far stay queued; PRs are only closed after a complete listing.
+        log.error(str(e))
+        return {job['id']: f"listing failed: {e}"}
+    log.info(f"Queued {len(open_iids)} open merge requests of {job['gitlab_repo']}")
+    if planner.close_prs_of_closed_mrs(job['gitlab_repo'], gh_owner, gh_repo, [], open_iids):
+        return {job['id']: "some PRs of closed merge requests failed to close"}
+    return {}
+
+
+def _run_mr_jobs(jobs, project_dir, gh_owner, gh_repo, args):
+    """Relay the MRs of a batch of `mr` jobs of one project. Returns {job id: error} for the MRs that failed."""
+    gitlab_repo = jobs[0]['gitlab_repo']
+    if not os.path.isdir(gl.LOCAL_CLONE_DIR):
+        # The clone job may have run on another worker; MR heads are fetched into a clone of our own.
+        gl.clone_repo(gitlab_repo, args.clone_filter)
+    store = state.SyncState(os.path.join(project_dir, 'sync-state.sqlite3'), gitlab_repo, f"{gh_owner}/{gh_repo}")
+    errors = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        mrs = list(pool.map(functools.partial(gl.get_mr_by_iid, gitlab_repo), [job['iid'] for job in jobs]))
+        jobs_by_iid = {}
+        closed = []
+        batch = []
+        for job, mr in zip(jobs, mrs):
+            if not mr:
+                errors[job['id']] = "merge request not found"
+            elif mr.get('state') in gl.CLOSED_MR_STATES:
+                closed.append(mr)
+            elif mr.get('state') == 'opened' and not store.is_synced(mr):
+                batch.append(mr)
+            jobs_by_iid[job['iid']] = job
+        if planner.close_prs_of_closed_mrs(gitlab_repo, gh_owner, gh_repo, closed):
+            errors.update({jobs_by_iid[mr.get('iid')]['id']: "failed to close the PR" for mr in closed})
+        failed, todo = _prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store, keep_current=args.notes)
+        errors.update({jobs_by_iid[mr.get('iid')]['id']: "failed to push the head branch" for mr in failed})
+        futures = {pool.submit(_sync_mr, gitlab_repo, mr, gh_owner, gh_repo, store, pr, args.notes): mr
+                   for mr, pr in todo}
+        for future in as_completed(futures):
+            if not future.result():
+                errors[jobs_by_iid[futures[future].get('iid')]['id']] = "failed to sync the PR"
+    store.close()
+    return errors
+
+
+def _serve(args):
+    """Keep the mirror clone warm and sync MRs as GitLab webhooks arrive, until interrupted."""
+    host, _, port = args.listen.rpartition(':')
+    if not port.isdigit():
+        log.error(f"--listen must be HOST:PORT or PORT, got '{args.listen}'")
+        return False
+    if args.workers < 1:
+        log.error(f"--workers must be at least 1, got {args.workers}")
+        return False
+    gh_owner, gh_repo = gh.ensure_repo(args.github_repo)
+    store = state.SyncState(args.state_db, args.gitlab_repo, f"{gh_owner}/{gh_repo}") if args.state_db else None
+    _refresh_mirror(args.gitlab_repo, gh_owner, gh_repo, args.clone_filter)
+    project = urllib.parse.unquote(gl._parse_pid(args.gitlab_repo))
+    handle = functools.partial(_handle_webhook_job, args.gitlab_repo, gh_owner, gh_repo, store, args.notes,
+                               args.clone_filter)
+    webhook.serve(host or '127.0.0.1', int(port), handle, project,
+                  secret=os.getenv('GL2GH_WEBHOOK_SECRET'), debounce=args.debounce, workers=args.workers)
+    return True
+
+
+def _handle_webhook_job(gitlab_repo, gh_owner, gh_repo, store, notes, clone_filter, job):
+    kind, iid = job
+    if kind == 'mr':
+        # The daemon outlives its PR index: PRs opened, closed or retargeted by other runs since must be seen.
+        gh.forget_open_prs(gh_owner, gh_repo, before=time.monotonic())
+        with metrics.span('phase', 'webhook_mr', phase='webhook_mr') as span:
+            span.set(iid=iid)
+            _sync_mr_by_iid(gitlab_repo, iid, gh_owner, gh_repo, store, notes)
+    else:
+        with metrics.span('phase', 'webhook_mirror', phase='webhook_mirror'):
+            _refresh_mirror(gitlab_repo, gh_owner, gh_repo, clone_filter)
+
+
+def _refresh_mirror(gitlab_repo, gh_owner, gh_repo, clone_filter=None):
+    """Incrementally fetch the mirror clone from GitLab and push the changed refs to GitHub."""
+    with gl.CLONE_LOCK:
+        gl.clone_repo(gitlab_repo, clone_filter)
+        gh.push_repo(gh_owner, gh_repo)
+
+
+def _sync_mr_by_iid(gitlab_repo, iid, gh_owner, gh_repo, store=None, notes=False):
+    """Relay one MR from its current state on GitLab. Returns True on success (or if there was nothing to do)."""
+    mr = gl.get_mr_by_iid(gitlab_repo, iid)
+    if not mr:
+        return False
+    if mr.get('state') != 'opened':
+        log.info(f"MR !{iid} is {mr.get('state')}")
+        return mr.get('state') not in gl.CLOSED_MR_STATES or not planner.close_prs_of_closed_mrs(
+            gitlab_repo, gh_owner, gh_repo, [mr])
+    if store and store.is_synced(mr):
+        log.info(f"MR !{iid} is unchanged since the last sync")
+        return True
+    # Held across fetch and push so a concurrent mirror refresh cannot prune the branch in between.
+    with gl.CLONE_LOCK:
+        failed, todo = _prepare_mr_batch(gitlab_repo, [mr], gh_owner, gh_repo, store, keep_current=notes)
+    return not failed and all(_sync_mr(gitlab_repo, mr, gh_owner, gh_repo, store, pr, notes) for mr, pr in todo)
+
+
+def _batched(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,56 @@
+import csv
+import os
+
+
+STEPS = ('clone', 'sync')
+
+
+def load(path):
+    """Read a migration manifest. Returns a list of {'gitlab_repo', 'github_repo', 'steps'} dicts.
+
+    CSV manifests need a header with `gitlab_repo` and `github_repo` columns and may add a `steps` column
+    ("clone", "sync" or "clone sync"; both when empty). YAML manifests (.yaml/.yml, requires PyYAML) are a list of
+    mappings with the same keys, optionally under a top-level `projects` key; `steps` may also be a list.
+    Raises ValueError on a malformed manifest.
+    """
+    if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+        rows = _load_yaml(path)
+    else:
+        with open(path, newline='', encoding='utf-8') as f:
+            rows = [row for row in csv.DictReader(f) if any((v or '').strip() for v in row.values())]
+
+    projects = []
+    targets = set()
+    for n, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            raise ValueError(f"{path}: entry {n} is not a mapping")
+        gitlab_repo = str(row.get('gitlab_repo') or '').strip()
+        github_repo = str(row.get('github_repo') or '').strip()
+        if not gitlab_repo or not github_repo:
+            raise ValueError(f"{path}: entry {n} needs both gitlab_repo and github_repo")
+        if github_repo.lower() in targets:
+            raise ValueError(f"{path}: entry {n} targets {github_repo} again")
+        targets.add(github_repo.lower())
+        steps = row.get('steps') or STEPS
+        if isinstance(steps, str):
+            steps = steps.replace(',', ' ').replace(';', ' ').split()
+        unknown = set(steps) - set(STEPS)
+        if unknown:
+            raise ValueError(f"{path}: entry {n} has unknown steps {', '.join(sorted(unknown))}")
+        projects.append({'gitlab_repo': gitlab_repo, 'github_repo': github_repo,
+                         'steps': [step for step in STEPS if step in steps]})
+    return projects
+
+
+def _load_yaml(path):
+    try:
+        import yaml
+    except ImportError:
+        raise ValueError(f"{path}: YAML manifests need PyYAML (pip install pyyaml); use a CSV manifest instead")
+    with open(path, encoding='utf-8') as f:
+        data = yaml.safe_load(f) or []
+    if isinstance(data, dict):
+        data = data.get('projects') or []
+    if not isinstance(data, list):
+        raise ValueError(f"{path}: expected a list of projects")
+    return data
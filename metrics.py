@@ -0,0 +1,228 @@
+import asyncio
+import atexit
+import json
+import logging as log
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+TRACE_FILE = os.getenv('GL2GH_TRACE')
+METRICS_FILE = os.getenv('GL2GH_METRICS')
+ENABLED = bool(TRACE_FILE or METRICS_FILE)
+# Spans beyond this many are still counted in the metrics but left out of the trace file.
+MAX_TRACE_EVENTS = 1_000_000
+
+HELP = {
+    'gl2gh_api_seconds': 'Duration of API requests, including retries and rate-limit waits.',
+    'gl2gh_api_bytes_sent_total': 'Request body bytes sent to the APIs.',
+    'gl2gh_api_bytes_received_total': 'Response body bytes received from the APIs (after decompression).',
+    'gl2gh_api_retries_total': 'API requests retried by the rate-limit scheduler.',
+    'gl2gh_api_token_requests_total': 'API requests sent with each token of a pool (0 is the primary token).',
+    'gl2gh_git_seconds': 'Duration of git subprocesses.',
+    'gl2gh_phase_seconds': 'Duration of sync phases.',
+}
+
+_t0 = time.perf_counter()
+_events = []
+_counters = {}
+_summaries = {}
+_lock = threading.Lock()
+
+
+def span(cat, name, **labels):
+    """Time a block as a trace event of category `cat`, and add it to the `gl2gh_<cat>_seconds` summary.
+
+    Labels become Prometheus labels and trace args; `set()` adds trace-only args and `label()` more labels from
+    inside the block. When neither GL2GH_TRACE nor GL2GH_METRICS is set this returns a shared no-op object.
+    """
+    if not ENABLED:
+        return _NOOP_SPAN
+    return _Span(cat, name, labels)
+
+
+def inc(name, value=1, **labels):
+    """Add `value` to the counter `name`."""
+    if not ENABLED:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def run(cmd, **kwargs):
+    """subprocess.run for git commands, timed as a `git` span labelled with the subcommand and exit code."""
+    if not ENABLED:
+        return subprocess.run(cmd, **kwargs)
+    command = git_command(cmd)
+    with span('git', command, command=command) as s:
+        try:
+            result = subprocess.run(cmd, **kwargs)
+        except subprocess.CalledProcessError as e:
+            s.label(exit_code=e.returncode)
+            raise
+        s.label(exit_code=result.returncode)
+        return result
+
+
+def git_command(cmd):
+    """Return the git subcommand of an argv, skipping `git` and its global -C/-c options."""
+    args = iter(cmd[1:] if cmd and os.path.basename(cmd[0]) == 'git' else cmd)
+    for arg in args:
+        if arg in ('-C', '-c'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return 'git'
+
+
+def write():
+    """Write the trace and the Prometheus summary to the configured files ('-' writes to stderr)."""
+    if not ENABLED:
+        return
+    with _lock:
+        events = list(_events)
+        text = _prometheus_text()
+    if TRACE_FILE:
+        try:
+            with open(TRACE_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+            log.info(f"Wrote {len(events)} trace events to {TRACE_FILE}")
+        except OSError as e:
+            log.error(f"Failed to write trace file '{TRACE_FILE}': {e}")
+    if METRICS_FILE == '-':
+        sys.stderr.write(text)
+    elif METRICS_FILE:
+        try:
+            with open(METRICS_FILE, 'w', encoding='utf-8') as f:
+                f.write(text)
+        except OSError as e:
+            log.error(f"Failed to write metrics file '{METRICS_FILE}': {e}")
+
+
+def detach():
+    """Stop this process from writing the files at exit, for a worker process whose data the parent merges in
+    (see take and merge); otherwise every process would overwrite the same files with its own part."""
+    atexit.unregister(write)
+
+
+def take():
+    """Return the data recorded so far and clear it, for merge() in the parent process. None when disabled."""
+    if not ENABLED:
+        return None
+    with _lock:
+        data = {'t0': _t0, 'events': list(_events), 'counters': dict(_counters), 'summaries': dict(_summaries)}
+        _events.clear()
+        _counters.clear()
+        _summaries.clear()
+    return data
+
+
+def merge(data):
+    """Add data returned by take() in another process to this one's trace and metrics."""
+    if not data:
+        return
+    # perf_counter is the system-wide monotonic clock, so only the processes' start offsets differ.
+    shift = round((data['t0'] - _t0) * 1e6)
+    with _lock:
+        room = max(0, MAX_TRACE_EVENTS - len(_events))
+        _events.extend(dict(event, ts=event['ts'] + shift) for event in data['events'][:room])
+        for key, value in data['counters'].items():
+            _counters[key] = _counters.get(key, 0) + value
+        for key, (total, count) in data['summaries'].items():
+            summary = _summaries.setdefault(key, [0.0, 0])
+            summary[0] += total
+            summary[1] += count
+
+
+class _Span:
+    __slots__ = ('cat', 'name', 'labels', 'args', 'start')
+
+    def __init__(self, cat, name, labels):
+        self.cat = cat
+        self.name = name
+        self.labels = labels
+        self.args = {}
+
+    def set(self, **args):
+        self.args.update(args)
+
+    def label(self, **labels):
+        self.labels.update(labels)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        key = (f"gl2gh_{self.cat}_seconds", tuple(sorted((k, v) for k, v in self.labels.items())))
+        event = {'name': self.name, 'cat': self.cat, 'ph': 'X', 'pid': os.getpid(), 'tid': _trace_tid(),
+                 'ts': round((self.start - _t0) * 1e6), 'dur': round(duration * 1e6),
+                 'args': {**self.labels, **self.args}}
+        with _lock:
+            total = _summaries.setdefault(key, [0.0, 0])
+            total[0] += duration
+            total[1] += 1
+            if len(_events) < MAX_TRACE_EVENTS:
+                _events.append(event)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **args):
+        pass
+
+    def label(self, **labels):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def _trace_tid():
+    """Thread id, or the asyncio task id so that concurrent tasks get their own track in the trace viewer."""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return id(task) if task is not None else threading.get_ident()
+
+
+def _prometheus_text():
+    lines = []
+    for name in sorted({key[0] for key in _summaries}):
+        lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} summary"]
+        for (metric, labels), (total, count) in sorted(_summaries.items(), key=str):
+            if metric == name:
+                lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+    for name in sorted({key[0] for key in _counters}):
+        lines += [f"# HELP {name} {HELP.get(name, name)}", f"# TYPE {name} counter"]
+        for (metric, labels), value in sorted(_counters.items(), key=str):
+            if metric == name:
+                lines.append(f"{name}{_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+if ENABLED:
+    atexit.register(write)
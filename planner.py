@@ -0,0 +1,163 @@
+import functools
+import itertools
+import logging as log
+
+import gh
+import gl
+import metrics
+import state
+import steps
+
+
+def listing_state(updated_after=None):
+    """Return the `state=` MRs are listed with: only open MRs on a full run, but every MR updated since
+    `updated_after` on an incremental one, so MRs closed or merged since the last run are seen too.
+    """
+    return 'all' if updated_after else 'opened'
+
+
+def close_prs_of_closed_mrs(gitlab_repo, gh_owner, gh_repo, closed, open_iids=None, plan=None):
+    """Close the open PRs of the `closed` (closed or merged) MRs. With `open_iids`, the complete set of open MRs,
+    every other open PR imported from `gitlab_repo` is checked against its MR too. With a `plan` list, the closes
+    are appended to it instead. Returns the number of PRs that failed to close (1 if the open PRs could not be
+    listed).
+    """
+    if not closed and open_iids is None:
+        return 0
+    try:
+        prs = gh.open_prs_by_mr(gh_owner, gh_repo, gitlab_repo)
+    except RuntimeError as e:
+        log.error(str(e))
+        return 1
+    if open_iids is not None:
+        listed = {mr.get('iid') for mr in closed}
+        orphans = sorted(set(prs) - set(open_iids) - listed)
+        closed = closed + [mr for mr in map(functools.partial(gl.get_mr_by_iid, gitlab_repo), orphans) if mr]
+    failures = 0
+    for mr in closed:
+        pr = prs.get(mr.get('iid'))
+        changes = gh.plan_pr_update(gitlab_repo, mr, pr) if pr else None
+        if not changes:
+            continue
+        if plan is not None:
+            plan.append(f"MR !{mr.get('iid')} ({mr.get('state')}): {_describe(pr, changes)}")
+        elif gh.update_pull_request(gh_owner, gh_repo, pr, changes) is None:
+            failures += 1
+    return failures
+
+
+def prepare_mr_batch(gitlab_repo, batch, gh_owner, gh_repo, store=None, keep_current=False):
+    """Steps (see steps.py) bringing the GitHub head branches of a batch of MRs up to date, shared by both sync
+    engines. Returns ([failed mr], [(mr, pr)]) where `pr` is None for MRs that still need a PR call.
+
+    One GraphQL round trip per batch: branches already at the MR head need no fetch or push, and MRs that also have
+    an up-to-date open PR from that branch need no further calls at all, unless `keep_current` returns them with
+    their PR. Fetch and push run as one exclusive block, so no other batch moves the branches in between.
+    """
+    with metrics.span('phase', 'remote_state', phase='remote_state') as span:
+        span.set(mrs=len(batch))
+        remote = yield from gh.remote_state_steps(gh_owner, gh_repo, [mr.get('source_branch') for mr in batch])
+    current = {mr.get('iid') for mr in batch
+               if mr.get('sha') and (remote.get(mr.get('source_branch')) or {}).get('oid') == mr.get('sha')}
+    stale = [mr for mr in batch if mr.get('iid') not in current]
+    ready, pushed = yield steps.exclusive(_update_head_branches(gh_owner, gh_repo, stale, current))
+
+    failed = []
+    todo = []
+    for mr in batch:
+        branch = mr.get('source_branch')
+        if mr.get('iid') not in ready:
+            log.error(f"Failed to ensure local branch '{branch}' for MR '{mr.get('web_url')}'")
+            failed.append(mr)
+            continue
+        if branch not in pushed and mr.get('iid') not in current:
+            log.error(f"Head branch '{branch}' is not available on GitHub for {gh_owner}/{gh_repo} and could not be pushed.")
+            failed.append(mr)
+            continue
+        pr = (remote.get(branch) or {}).get('pr')
+        if pr and mr.get('iid') in current and not gh.plan_pr_update(gitlab_repo, mr, pr):
+            log.info(f"MR !{mr.get('iid')} is up to date in PR #{pr.get('number')} - {pr.get('html_url')}")
+            if keep_current:
+                todo.append((mr, pr))
+            elif store:
+                store.record(mr, pr.get('number'))
+            continue
+        todo.append((mr, None))
+    return failed, todo
+
+
+def _update_head_branches(gh_owner, gh_repo, stale, current):
+    """Steps fetching the heads of the `stale` MRs and pushing them to GitHub. Returns (ready IIDs, pushed branches)."""
+    with metrics.span('phase', 'fetch', phase='fetch') as span:
+        span.set(mrs=len(stale))
+        ready = (yield from gl.ensure_local_branches_steps(stale)) | current
+    with metrics.span('phase', 'push', phase='push') as span:
+        branches = [mr.get('source_branch') for mr in stale if mr.get('iid') in ready]
+        span.set(branches=len(branches))
+        pushed = yield from gh.push_branches_steps(gh_owner, gh_repo, branches)
+    return ready, pushed
+
+
+def print_plan(gitlab_repo, gh_owner, gh_repo, mr_url=None, state_db=None):
+    """Print the writes `sync` would make on GitHub (branch pushes, PRs created, updated or closed) without making
+    any. Reads the same listing and state DB as the real run. Returns False if the MRs could not be listed.
+    """
+    store = state.SyncState(state_db, gitlab_repo, f"{gh_owner}/{gh_repo}") if state_db and not mr_url else None
+    updated_after = store.watermark() if store else None
+    if mr_url:
+        mr = gl.get_mr(gitlab_repo, mr_url)
+        listing = iter([mr] if mr else [])
+    else:
+        listing = gl.iter_mrs(gitlab_repo, state=listing_state(updated_after), updated_after=updated_after)
+    plan = []
+    closed = []
+    open_iids = set()
+    total = 0
+    prs = None
+    try:
+        while batch := list(itertools.islice(listing, gl.FETCH_BATCH_SIZE)):
+            total += len(batch)
+            closed += [mr for mr in batch if mr.get('state') in gl.CLOSED_MR_STATES]
+            batch = [mr for mr in batch if mr.get('state') == 'opened']
+            open_iids.update(mr.get('iid') for mr in batch)
+            batch = [mr for mr in batch if not (store and store.is_synced(mr))]
+            remote = gh.remote_state(gh_owner, gh_repo, [mr.get('source_branch') for mr in batch])
+            if prs is None:
+                prs = gh.open_prs_by_mr(gh_owner, gh_repo, gitlab_repo)
+            for mr in batch:
+                plan += _plan_mr(gitlab_repo, mr, remote.get(mr.get('source_branch')) or {}, prs.get(mr.get('iid')))
+    except RuntimeError as e:
+        # A plan built from part of the listing would leave out MRs, and closes of MRs that are still open.
+        log.error(str(e))
+        if store:
+            store.close()
+        return False
+    close_prs_of_closed_mrs(gitlab_repo, gh_owner, gh_repo, closed,
+                            None if updated_after or mr_url else open_iids, plan)
+    if store:
+        store.close()
+    for line in plan:
+        print(line)
+    log.info(f"{len(plan)} of {total} listed merge requests need writes on {gh_owner}/{gh_repo}")
+    return True
+
+
+def _plan_mr(gitlab_repo, mr, head, pr=None):
+    """Return the plan line of an open MR given its GitHub branch state and PR, or [] if it needs no writes."""
+    branch = mr.get('source_branch')
+    pr = pr or head.get('pr')
+    steps = []
+    if not mr.get('sha') or head.get('oid') != mr.get('sha'):
+        steps.append(f"push branch {branch}")
+    changes = gh.plan_pr_update(gitlab_repo, mr, pr) if pr else None
+    if pr is None:
+        steps.append(f"create PR {branch} -> {mr.get('target_branch')}")
+    elif changes:
+        steps.append(_describe(pr, changes))
+    return [f"MR !{mr.get('iid')}: {'; '.join(steps)}"] if steps else []
+
+
+def _describe(pr, changes):
+    if changes.get('state') == 'closed':
+        return f"close PR #{pr.get('number')}"
+    return f"update {', '.join(changes)} of PR #{pr.get('number')}"
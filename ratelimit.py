@@ -0,0 +1,271 @@
+import contextlib
+import email.utils
+import logging as log
+import math
+import random
+import threading
+import time
+import urllib.parse
+
+import http_pool
+import metrics
+
+
+MAX_CONCURRENCY = 16
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+# GitHub asks clients to wait at least a minute after a secondary rate limit without Retry-After.
+SECONDARY_LIMIT_WAIT = 60.0
+# Below this many remaining requests, calls are spread evenly over the time left until the budget resets.
+LOW_BUDGET = 100
+IDEMPOTENT_METHODS = http_pool.IDEMPOTENT_METHODS
+RETRYABLE_STATUSES = (500, 502, 503, 504)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+# Cross-process cap on requests in flight; set by `migrate` in its worker processes.
+_global_slots = None
+
+
+def request(method, url, body=None, headers=None, tokens=None):
+    """Send an API request through the per-host scheduler; same contract as http_pool.request.
+
+    With a tokens.TokenPool, every attempt is authorized with the token the pool picks, and is scheduled by that
+    token's limiter. Requests wait for a concurrency slot and for the host's rate-limit budget. Rate-limit rejections (429, or 403 with
+    an exhausted budget / secondary-limit message) are retried for every method after Retry-After or the budget reset,
+    because the server did not process them. Server errors and connection failures are retried with jittered
+    exponential backoff only for idempotent methods.
+    """
+    attempt = 0
+    while True:
+        token = tokens.pick(method, url) if tokens else ''
+        limiter = limiter_for(url, token)
+        limiter.acquire()
+        try:
+            with global_slot():
+                response = http_pool.request(method, url, body=body,
+                                             headers=tokens.headers(headers, token) if tokens else headers)
+        except Exception:
+            delay = limiter.failed(method, url, attempt)
+            if delay is None:
+                raise
+        else:
+            delay = limiter.completed(method, url, attempt, *response)
+            if delay is None:
+                return response
+        attempt += 1
+        time.sleep(delay)
+
+
+def set_global_slots(semaphore):
+    """Share a multiprocessing semaphore that every request of this process must hold while it is in flight."""
+    global _global_slots
+    _global_slots = semaphore
+
+
+def global_slot():
+    """Return the cross-process request semaphore as a context manager, or a no-op one when none is set."""
+    return _global_slots if _global_slots is not None else contextlib.nullcontext()
+
+
+def try_global_slot():
+    """Take a cross-process request slot without blocking. Returns True if taken (always True when none is set);
+    release it with release_global_slot()."""
+    return _global_slots is None or _global_slots.acquire(False)
+
+
+def release_global_slot():
+    if _global_slots is not None:
+        _global_slots.release()
+
+
+def limiter_for(url, token=''):
+    """Return the shared limiter of the host of `url`, the API token used on it and the rate-limit resource the
+    request counts against (also used by the asyncio engine); rate-limit budgets are per token and resource."""
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.netloc, token, _resource(parts.path))
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            limiter = _limiters[key] = _HostLimiter(parts.netloc, key[2])
+        return limiter
+
+
+def _resource(path):
+    """Return the rate-limit resource of an API path, as GitHub names it in X-RateLimit-Resource. GitHub's GraphQL
+    and search APIs have budgets of their own, separate from the `core` REST budget."""
+    path = path.rstrip('/')
+    if path.endswith('/graphql'):
+        return 'graphql'
+    if '/search/code' in path:
+        return 'code_search'
+    if '/search/' in path:
+        return 'search'
+    return 'core'
+
+
+class _HostLimiter:
+    """Rate-limit budget and adaptive concurrency limit of one rate-limit resource of an API host."""
+
+    def __init__(self, host, resource='core'):
+        self.host = host
+        self.resource = resource
+        self.limit = max(1, MAX_CONCURRENCY // 2)
+        self._in_flight = 0
+        self._successes = 0
+        self._remaining = None
+        self._reset_at = None
+        self._blocked_until = 0.0
+        self._next_slot = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self.try_acquire()
+                if wait == 0:
+                    return
+                self._cond.wait(timeout=wait)
+
+    def try_acquire(self):
+        """Take a request slot without blocking. Returns 0 when taken, otherwise the seconds to wait before trying
+        again (None when waiting for another request to finish)."""
+        with self._cond:
+            now = time.time()
+            wait = max(self._blocked_until, self._next_slot) - now
+            if wait > 0:
+                return wait
+            if self._in_flight >= self.limit:
+                return None
+            self._in_flight += 1
+            self._next_slot = max(self._next_slot, now) + self._pacing_interval(now)
+            return 0
+
+    def headroom(self):
+        """Sort key of how freely this limiter can send now: not paused, then the budget left after the requests in
+        flight (unknown counts as unlimited), then fewest requests in flight."""
+        with self._cond:
+            now = time.time()
+            remaining = self._remaining
+            if remaining is None or (self._reset_at is not None and self._reset_at <= now):
+                remaining = math.inf
+            return self._blocked_until <= now, remaining - self._in_flight, -self._in_flight
+
+    def completed(self, method, url, attempt, status, headers, body):
+        """Release the slot of a request that got a response. Returns seconds to sleep before retrying it, or None
+        if the response should be returned to the caller."""
+        wait = self.release(status, headers, body)
+        if wait is not None and attempt < MAX_RETRIES:
+            delay = max(wait, _backoff(attempt))
+            metrics.inc('gl2gh_api_retries_total', host=self.host, reason='rate_limit')
+            log.warning(f"Rate limited by {self.host} (status {status}); retrying {method} {url} in {delay:.1f}s")
+            return delay
+        if status in RETRYABLE_STATUSES and method in IDEMPOTENT_METHODS and attempt < MAX_RETRIES:
+            delay = _backoff(attempt)
+            metrics.inc('gl2gh_api_retries_total', host=self.host, reason='server_error')
+            log.warning(f"{method} {url} returned {status}; retrying in {delay:.1f}s")
+            return delay
+        return None
+
+    def failed(self, method, url, attempt):
+        """Release the slot of a request that raised. Returns seconds to sleep before retrying, or None to re-raise."""
+        self.release()
+        if method not in IDEMPOTENT_METHODS or attempt >= MAX_RETRIES:
+            return None
+        delay = _backoff(attempt)
+        metrics.inc('gl2gh_api_retries_total', host=self.host, reason='connection')
+        log.warning(f"{method} {url} failed; retrying in {delay:.1f}s")
+        return delay
+
+    def release(self, status=None, headers=None, body=None):
+        """Record the outcome of a request. Returns seconds to wait before retrying if it was rate limited, else None."""
+        with self._cond:
+            self._in_flight -= 1
+            try:
+                if status is None:
+                    return None
+                now = time.time()
+                self._update_budget(headers, now)
+                wait = _rate_limit_wait(status, headers, body, self._remaining, self._reset_at, now)
+                if wait is not None:
+                    # Multiplicative decrease: halve the allowed concurrency and pause the whole host.
+                    self.limit = max(1, self.limit // 2)
+                    self._successes = 0
+                    self._blocked_until = max(self._blocked_until, now + wait)
+                    log.info(f"Concurrency for {self.host} lowered to {self.limit}")
+                    return wait
+                if self._remaining is None or self._remaining > LOW_BUDGET:
+                    # Additive increase after a full window of successful requests.
+                    self._successes += 1
+                    if self._successes >= self.limit and self.limit < MAX_CONCURRENCY:
+                        self.limit += 1
+                        self._successes = 0
+                return None
+            finally:
+                self._cond.notify_all()
+
+    def _update_budget(self, headers, now):
+        resource = _header(headers, 'X-RateLimit-Resource')
+        if resource is not None and resource != self.resource:
+            # Counted against another budget than the path suggested; it must not pace this one.
+            return
+        remaining = _header(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        reset = _header(headers, 'X-RateLimit-Reset', 'RateLimit-Reset')
+        if remaining is not None and remaining.isdigit():
+            self._remaining = int(remaining)
+        if reset is not None and reset.isdigit():
+            # Both hosts send epoch seconds; tolerate a relative value just in case.
+            self._reset_at = int(reset) if int(reset) > 10 ** 9 else now + int(reset)
+
+    def _pacing_interval(self, now):
+        if self._remaining is None or self._reset_at is None or self._remaining > LOW_BUDGET:
+            return 0.0
+        if self._reset_at <= now:
+            self._remaining = None
+            return 0.0
+        return (self._reset_at - now) / max(self._remaining, 1)
+
+
+def _rate_limit_wait(status, headers, body, remaining, reset_at, now):
+    """Return seconds to wait if the response is a rate-limit rejection, else None."""
+    if status not in (403, 429):
+        return None
+    retry_after = _retry_after(_header(headers, 'Retry-After'), now)
+    text = (body or b'')[:2048].decode('utf-8', 'replace').lower()
+    if status == 403 and remaining != 0 and retry_after is None and 'rate limit' not in text:
+        return None  # an ordinary permission error
+    if retry_after is not None:
+        return retry_after
+    if remaining == 0 and reset_at:
+        return max(0.0, reset_at - now) + 1
+    if 'secondary rate limit' in text:
+        return SECONDARY_LIMIT_WAIT
+    return BACKOFF_BASE
+
+
+def _retry_after(value, now):
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - now)
+    except (TypeError, ValueError):
+        return None
+
+
+def _header(headers, *names):
+    if not headers:
+        return None
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            return value
+    return None
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
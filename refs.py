@@ -0,0 +1,109 @@
+import logging as log
+import subprocess
+import threading
+
+import metrics
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def index_for(repo_dir):
+    """Return the shared RefIndex of the git repository in `repo_dir`."""
+    with _indexes_lock:
+        index = _indexes.get(repo_dir)
+        if index is None:
+            index = _indexes[repo_dir] = RefIndex(repo_dir)
+        return index
+
+
+def forget(repo_dir):
+    """Drop the index of `repo_dir` after its refs changed wholesale (clone, mirror fetch) or it was removed."""
+    with _indexes_lock:
+        index = _indexes.pop(repo_dir, None)
+    if index:
+        index.close()
+
+
+class RefIndex:
+    """Snapshot of the refs of one repository, loaded with a single `git for-each-ref` on first use.
+
+    Existence and SHA queries are answered from memory. Callers that change refs report it with `updated`, so
+    the snapshot stays coherent without reloading; after a fetch or clone, call `forget`. Refs not in the snapshot
+    (e.g. just fetched) and other revisions are resolved by a long-lived `git cat-file --batch-check`, which also
+    sees objects and refs written after it started.
+    """
+
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self._lock = threading.RLock()
+        self._refs = None
+        self._batch = None
+
+    def sha(self, ref):
+        """Return the SHA `ref` (a full refname) points at, or None if it does not exist."""
+        with self._lock:
+            return self._snapshot().get(ref)
+
+    def exists(self, ref):
+        return self.sha(ref) is not None
+
+    def refs(self, *prefixes):
+        """Return {refname: sha} of the refs under any of `prefixes` (every ref without prefixes)."""
+        with self._lock:
+            return {ref: sha for ref, sha in self._snapshot().items() if not prefixes or ref.startswith(prefixes)}
+
+    def updated(self, ref, sha):
+        """Record that `ref` now points at `sha` (None: deleted) after a local update."""
+        with self._lock:
+            if self._refs is None:
+                return
+            if sha:
+                self._refs[ref] = sha
+            else:
+                self._refs.pop(ref, None)
+
+    def resolve(self, rev):
+        """Return the object name `rev` resolves to in the repository right now, or None if it does not. A full
+        refname that resolves is recorded in the snapshot, so later `sha` calls see it without a lookup.
+        """
+        with self._lock:
+            if self._batch is None or self._batch.poll() is not None:
+                self._batch = subprocess.Popen(["git", "-C", self.repo_dir, "cat-file", "--batch-check"],
+                                               stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            metrics.inc('gl2gh_ref_lookups_total', source='cat-file')
+            try:
+                self._batch.stdin.write(f"{rev}\n")
+                self._batch.stdin.flush()
+                line = self._batch.stdout.readline()
+            except OSError as e:
+                log.warning(f"git cat-file --batch-check failed on '{rev}': {e}")
+                self.close()
+                return None
+            sha, _, kind = line.partition(' ')
+            found = line and not kind.startswith(('missing', 'ambiguous'))
+            if rev.startswith('refs/'):
+                self.updated(rev, sha if found else None)
+            return sha if found else None
+
+    def close(self):
+        with self._lock:
+            if self._batch is not None:
+                try:
+                    self._batch.stdin.close()
+                    self._batch.wait(timeout=5)
+                except (OSError, subprocess.TimeoutExpired):
+                    self._batch.kill()
+                self._batch = None
+            self._refs = None
+
+    def _snapshot(self):
+        if self._refs is None:
+            result = metrics.run(["git", "-C", self.repo_dir, "for-each-ref",
+                                  "--format=%(objectname) %(refname)"],
+                                 check=True, stdout=subprocess.PIPE, text=True)
+            self._refs = dict(reversed(line.split(' ', 1)) for line in result.stdout.splitlines())
+        else:
+            metrics.inc('gl2gh_ref_lookups_total', source='index')
+        return self._refs
@@ -0,0 +1,128 @@
+import datetime
+import logging as log
+import sqlite3
+import threading
+
+
+# Subtracted from the start of a run for the next run's `updated_after=`, to cover clock skew between this host
+# and GitLab. MRs in the overlap are listed again and skipped as already synced.
+WATERMARK_MARGIN_SECONDS = 300
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS merge_requests (
+    gitlab_project TEXT NOT NULL,
+    github_repo TEXT NOT NULL,
+    iid INTEGER NOT NULL,
+    updated_at TEXT,
+    head_sha TEXT,
+    pr_number INTEGER,
+    synced_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (gitlab_project, github_repo, iid)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    gitlab_project TEXT NOT NULL,
+    github_repo TEXT NOT NULL,
+    updated_after TEXT NOT NULL,
+    PRIMARY KEY (gitlab_project, github_repo)
+);
+CREATE TABLE IF NOT EXISTS notes (
+    gitlab_project TEXT NOT NULL,
+    github_repo TEXT NOT NULL,
+    iid INTEGER NOT NULL,
+    note_key TEXT NOT NULL,
+    github_id INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    PRIMARY KEY (gitlab_project, github_repo, iid, note_key)
+);
+"""
+
+
+class SyncState:
+    """SQLite record of what previous `sync` runs already relayed from one GitLab project to one GitHub repo.
+
+    Per MR it keeps the last seen `updated_at`, the head SHA that was pushed and the PR number, so unchanged MRs can
+    be skipped. The watermark is the start time of the last complete run (see listing_start) and is passed to GitLab
+    as `updated_after=` to list only MRs that changed since. With `sync --notes` it also maps every copied GitLab note
+    and approval to the GitHub comment or review it became. Safe to share between threads.
+    """
+
+    def __init__(self, path, gitlab_project, github_repo):
+        self.path = path
+        self._key = (str(gitlab_project), str(github_repo).lower())
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def is_synced(self, mr):
+        """Return True if the MR was already relayed to a PR at its current head SHA and `updated_at`. Edits of the
+        title or description, and new comments and approvals, only change the latter.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT head_sha, pr_number, updated_at FROM merge_requests "
+                "WHERE gitlab_project = ? AND github_repo = ? AND iid = ?",
+                (*self._key, mr.get('iid'))).fetchone()
+        return bool(row and row[1] and row[0] and row[0] == mr.get('sha') and row[2] == mr.get('updated_at'))
+
+    def record(self, mr, pr_number):
+        """Remember that the MR at its current head SHA is relayed to PR `pr_number`."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO merge_requests (gitlab_project, github_repo, iid, updated_at, head_sha, pr_number) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (gitlab_project, github_repo, iid) DO UPDATE SET updated_at = excluded.updated_at, "
+                "head_sha = excluded.head_sha, pr_number = excluded.pr_number, synced_at = CURRENT_TIMESTAMP",
+                (*self._key, mr.get('iid'), mr.get('updated_at'), mr.get('sha'), pr_number))
+
+    def copied_note(self, mr, note_key):
+        """Return (github_id, kind) of the GitHub comment a note (`note:<id>` or `approval:<user id>`) of the MR
+        was copied to, or None if it was not copied yet.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT github_id, kind FROM notes WHERE gitlab_project = ? AND github_repo = ? AND iid = ? "
+                "AND note_key = ?", (*self._key, mr.get('iid'), note_key)).fetchone()
+        return tuple(row) if row else None
+
+    def has_copied_notes(self, mr):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM notes WHERE gitlab_project = ? AND github_repo = ? AND iid = ? LIMIT 1",
+                (*self._key, mr.get('iid'))).fetchone()
+        return row is not None
+
+    def record_note(self, mr, note_key, github_id, kind):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO notes (gitlab_project, github_repo, iid, note_key, github_id, kind) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (*self._key, mr.get('iid'), note_key, github_id, kind))
+
+    def watermark(self):
+        """Return the `updated_after` value for the next listing, or None on the first run."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_after FROM watermarks WHERE gitlab_project = ? AND github_repo = ?", self._key).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, updated_after):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO watermarks (gitlab_project, github_repo, updated_after) VALUES (?, ?, ?) "
+                "ON CONFLICT (gitlab_project, github_repo) DO UPDATE SET updated_after = excluded.updated_after",
+                (*self._key, updated_after))
+        log.info(f"Next sync of {self._key[0]} will list MRs updated after {updated_after}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def listing_start():
+    """Return the watermark of a run that starts listing MRs now, in GitLab's ISO 8601 format.
+
+    MRs updated while the listing runs may be missing from it, so the next run must list everything updated
+    after the start, not after the newest `updated_at` seen.
+    """
+    start = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=WATERMARK_MARGIN_SECONDS)
+    return start.strftime('%Y-%m-%dT%H:%M:%S.') + f"{start.microsecond // 1000:03d}Z"
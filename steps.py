@@ -0,0 +1,102 @@
+"""Drivers running the GitLab, GitHub and git logic shared by the thread and asyncio engines.
+
+That logic is written once, as a generator of steps: it yields a Call (or a list of Calls that may run
+concurrently, or an exclusive() block) and is sent back the result, or has the call's exception raised at the
+yield. `run` makes each call on the current thread; `run_async` awaits its asyncio transport instead, so the two
+engines differ only in how requests and git commands are carried out.
+"""
+import asyncio
+import collections
+import contextlib
+import subprocess
+
+import metrics
+
+
+# `blocking(*args, **kwargs)` is the call on a thread; `awaitable` its asyncio twin, or None to run `blocking` in a
+# worker thread under asyncio.
+Call = collections.namedtuple('Call', 'blocking awaitable args kwargs')
+Exclusive = collections.namedtuple('Exclusive', 'steps')
+
+
+def call(blocking, awaitable, *args, **kwargs):
+    return Call(blocking, awaitable, args, kwargs)
+
+
+def git(repo_dir, *args, input=None):
+    """Call running git in `repo_dir`; its result is (returncode, stdout, stderr) as text."""
+    return call(_git, _git_async, repo_dir, *args, input=input)
+
+
+def exclusive(steps):
+    """Wrap steps that must not interleave with other exclusive blocks (e.g. git writes to the local clone);
+    the driver runs them under its lock. Blocks must not be nested.
+    """
+    return Exclusive(steps)
+
+
+def run(steps, lock=None):
+    """Drive `steps` on the current thread and return its result. Exclusive blocks hold `lock`, if given."""
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if isinstance(step, Exclusive):
+                with lock or contextlib.nullcontext():
+                    result = run(step.steps, lock)
+            elif isinstance(step, list):
+                result = [c.blocking(*c.args, **c.kwargs) for c in step]
+            else:
+                result = step.blocking(*step.args, **step.kwargs)
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+
+async def run_async(steps, lock=None):
+    """Drive `steps` on the running event loop and return its result. Calls in a list run concurrently; exclusive
+    blocks hold the asyncio `lock`, if given.
+    """
+    result, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error else steps.send(result)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if isinstance(step, Exclusive):
+                async with lock or contextlib.nullcontext():
+                    result = await run_async(step.steps, lock)
+            elif isinstance(step, list):
+                result = list(await asyncio.gather(*(_call_async(c) for c in step)))
+            else:
+                result = await _call_async(step)
+            error = None
+        except Exception as e:
+            result, error = None, e
+
+
+async def _call_async(c):
+    if c.awaitable is None:
+        return await asyncio.to_thread(c.blocking, *c.args, **c.kwargs)
+    return await c.awaitable(*c.args, **c.kwargs)
+
+
+def _git(repo_dir, *args, input=None):
+    result = metrics.run(["git", "-C", repo_dir, *args], input=input, check=False,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    return result.returncode, result.stdout, result.stderr
+
+
+async def _git_async(repo_dir, *args, input=None):
+    """Run git without blocking the event loop. Returns (returncode, stdout, stderr) as text."""
+    with metrics.span('git', args[0], command=args[0]) as span:
+        proc = await asyncio.create_subprocess_exec(
+            "git", "-C", repo_dir, *args, stdin=asyncio.subprocess.PIPE if input is not None else None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        out, err = await proc.communicate(input.encode('utf-8') if input is not None else None)
+        span.label(exit_code=proc.returncode)
+    return proc.returncode, out.decode('utf-8', 'replace'), err.decode('utf-8', 'replace')
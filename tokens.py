@@ -0,0 +1,58 @@
+import logging as log
+import os
+
+import metrics
+import ratelimit
+
+
+# Methods served by any token of a pool; everything else is a write and uses the primary token.
+READ_METHODS = ('GET', 'HEAD')
+
+
+class TokenPool:
+    """API tokens of one service. `primary` is the designated identity: it makes every write (and the git pushes),
+    so PRs and comments keep one author. Reads go to the token with the most rate-limit budget left.
+
+    Each token gets its own ratelimit limiter. The response cache is keyed by the primary token, so all the tokens
+    of a pool must be able to see the same projects.
+    """
+
+    def __init__(self, primary, extra=(), authorization='token {}', name=''):
+        self.name = name
+        self.primary = primary
+        self.tokens = list(dict.fromkeys(token for token in [primary, *extra] if token))
+        self.authorization = authorization
+
+    @classmethod
+    def from_env(cls, prefix, primary, authorization):
+        """Build the pool of `primary` plus the tokens in <prefix>_TOKENS (comma-separated) and the file named by
+        <prefix>_TOKENS_FILE (one per line; blank lines and # comments are skipped).
+        """
+        extra = [token.strip() for token in os.getenv(f"{prefix}_TOKENS", '').split(',')]
+        path = os.getenv(f"{prefix}_TOKENS_FILE")
+        if path:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    extra += [line.strip() for line in f if not line.lstrip().startswith('#')]
+            except OSError as e:
+                log.error(f"Cannot read {prefix}_TOKENS_FILE '{path}': {e}")
+        return cls(primary, extra, authorization, prefix.lower())
+
+    def pick(self, method, url):
+        """Return the token a request should be sent with."""
+        if len(self.tokens) < 2 or not (method in READ_METHODS or _is_graphql(url)):
+            return self.primary or ''
+        return max(self.tokens, key=lambda token: ratelimit.limiter_for(url, token).headroom())
+
+    def headers(self, headers, token):
+        """Return `headers` authorized with `token`."""
+        if not token:
+            return headers
+        if len(self.tokens) > 1:
+            metrics.inc('gl2gh_api_token_requests_total', pool=self.name, token=self.tokens.index(token))
+        return {**(headers or {}), 'Authorization': self.authorization.format(token)}
+
+
+def _is_graphql(url):
+    # The GraphQL queries of this tool only read; they may use any token like GETs do.
+    return url.rstrip('/').endswith('/graphql')
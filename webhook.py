@@ -0,0 +1,163 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hmac
+import json
+import logging as log
+import threading
+import time
+
+
+# GitLab `X-Gitlab-Event` header values that are queued, and the job they become.
+MR_EVENT = 'Merge Request Hook'
+NOTE_EVENT = 'Note Hook'
+PUSH_EVENTS = ('Push Hook', 'Tag Push Hook')
+MIRROR_JOB = ('mirror', None)
+
+
+def serve(host, port, handle, project, secret=None, debounce=2.0, max_delay=30.0, workers=1):
+    """Accept GitLab webhooks on host:port and run `handle(job)` on `workers` threads until interrupted.
+
+    Merge Request events and comments on MRs become ('mr', iid) jobs and push events the single MIRROR_JOB, so a
+    burst of events for the same MR, or any number of pushes, runs once `debounce` seconds after the last of them
+    (and at most `max_delay` seconds after the first). Events of other projects than `project` (path with namespace
+    or numeric id) are ignored. With `secret`, requests must carry it in X-Gitlab-Token.
+    """
+    queue = WorkQueue(debounce, max_delay)
+    server = ThreadingHTTPServer((host, port), type('Handler', (_Handler,), {
+        'queue': queue, 'project': str(project), 'secret': secret}))
+    server.daemon_threads = True
+    threads = [threading.Thread(target=_work, args=(queue, handle), name=f"webhook-worker-{n}", daemon=True)
+               for n in range(workers)]
+    for thread in threads:
+        thread.start()
+    log.info(f"Listening for GitLab webhooks on http://{host}:{server.server_address[1]}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Shutting down; finishing running jobs")
+    finally:
+        server.server_close()
+        queue.close()
+        for thread in threads:
+            thread.join()
+
+
+class WorkQueue:
+    """Jobs keyed by what they sync. Events for a pending key are merged into it, and a key that is running is
+    run once more after it finishes, so one key never runs twice at the same time."""
+
+    def __init__(self, debounce, max_delay):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self._pending = {}
+        self._running = set()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, key):
+        with self._cond:
+            now = time.monotonic()
+            first, _ = self._pending.get(key, (now, now))
+            self._pending[key] = (first, now)
+            self._cond.notify_all()
+
+    def get(self):
+        """Block until a key is due and not running, mark it running and return it. Returns None once closed."""
+        with self._cond:
+            while not self._closed:
+                now = time.monotonic()
+                due = {key: min(last + self.debounce, first + self.max_delay)
+                       for key, (first, last) in self._pending.items() if key not in self._running}
+                if due:
+                    key = min(due, key=due.get)
+                    if due[key] <= now:
+                        del self._pending[key]
+                        self._running.add(key)
+                        return key
+                    self._cond.wait(due[key] - now)
+                else:
+                    self._cond.wait()
+            return None
+
+    def done(self, key):
+        with self._cond:
+            self._running.discard(key)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'running': len(self._running)}
+
+
+def _work(queue, handle):
+    while True:
+        job = queue.get()
+        if job is None:
+            return
+        try:
+            handle(job)
+        except BaseException as e:
+            # SystemExit included: the git helpers exit on fatal errors, which must not stop the daemon.
+            log.error(f"Job {job} failed: {e!r}")
+        finally:
+            queue.done(job)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    queue = None
+    project = None
+    secret = None
+
+    def do_GET(self):
+        if self.path.rstrip('/') in ('', '/healthz'):
+            return self._reply(200, {'status': 'ok', **self.queue.stats()})
+        self._reply(404, {'error': 'not found'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.secret and not hmac.compare_digest(self.headers.get('X-Gitlab-Token', ''), self.secret):
+            return self._reply(401, {'error': 'invalid X-Gitlab-Token'})
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return self._reply(400, {'error': 'body is not JSON'})
+        if not isinstance(event, dict):
+            return self._reply(400, {'error': 'body is not a JSON object'})
+        job = _job_for(self.headers.get('X-Gitlab-Event', ''), event, self.project)
+        if job is None:
+            return self._reply(202, {'queued': False})
+        self.queue.put(job)
+        self._reply(202, {'queued': True, 'job': list(job)})
+
+    def log_message(self, format, *args):
+        log.debug(f"webhook {self.address_string()}: {format % args}")
+
+    def _reply(self, status, payload):
+        out = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def _job_for(kind, event, project):
+    """Return the job a GitLab webhook event asks for, or None if it is not one this daemon handles."""
+    source = event.get('project') or {}
+    if project not in (str(source.get('path_with_namespace')), str(source.get('id'))):
+        log.info(f"Ignoring {kind or 'event'} for project {source.get('path_with_namespace')}")
+        return None
+    if kind == MR_EVENT:
+        iid = (event.get('object_attributes') or {}).get('iid')
+        return ('mr', int(iid)) if iid is not None else None
+    if kind == NOTE_EVENT:
+        iid = (event.get('merge_request') or {}).get('iid')
+        return ('mr', int(iid)) if iid is not None else None
+    if kind in PUSH_EVENTS:
+        return MIRROR_JOB
+    log.info(f"Ignoring unsupported webhook event '{kind}'")
+    return None